@@ -0,0 +1,116 @@
+
+# Shared solid fill and gradient pictures
+#
+# Every create_solid_fill or create_*_gradient call makes a new server
+# picture, even when an identical one already exists. BrushCache hands
+# out one reference counted picture per distinct set of parameters, and
+# keeps a few unused ones around in case they're needed again.
+
+from collections import OrderedDict
+
+from Xlib.ext import render
+
+def fixed(value):
+	"""Return value as the Fixed (16.16) it's sent as, truncated like render.Fixed."""
+	return int(value * 65536)
+
+def color_key(color):
+	if hasattr(color, 'keys') or hasattr(color, '_data'):
+		return color['red'], color['green'], color['blue'], color['alpha']
+	return tuple(color)
+
+def point_key(point):
+	if hasattr(point, 'keys') or hasattr(point, '_data'):
+		return fixed(point['x']), fixed(point['y'])
+	return fixed(point[0]), fixed(point[1])
+
+def stops_key(stops):
+	array = render.stop_array(stops)
+	if array is not None:
+		# The same key as for the stops as tuples, converted as they're sent
+		offsets = render.fixed_array((array[:, 0], ), 1)[:, 0].tolist()
+		colors = array[:, 1:].astype('=u2').tolist()
+		return tuple(zip(offsets, map(tuple, colors)))
+	return tuple((fixed(offset), color_key(color)) for offset, color in stops)
+
+class BrushCache:
+	"""Reference counted solid fill and gradient pictures of a display.
+
+	Each brush returned by the solid_fill and *_gradient methods must be
+	given back with release() once it's not used anymore. Brushes nobody
+	uses are freed, except for the keep most recently released ones.
+
+	A brush is shared by everyone who asked for the same parameters, so
+	it must not be changed: its repeat, transform, filter and other
+	values are the defaults, and setting them would change every user.
+	Brushes that need them should be created on the display instead.
+	"""
+
+	def __init__(self, display, keep = 64):
+		self.display = display
+		self.keep = keep
+		# key -> [picture, users]
+		self.brushes = {}
+		# picture id -> key
+		self.keys = {}
+		# keys of unused brushes, least recently released first
+		self.unused = OrderedDict()
+		self.created = 0
+		self.avoided = 0
+		self.freed = 0
+
+	def stats(self):
+		return dict(created = self.created, avoided = self.avoided, freed = self.freed,
+			live = len(self.brushes) - len(self.unused), unused = len(self.unused))
+
+	def get(self, key, create, *args):
+		entry = self.brushes.get(key)
+		if entry is None:
+			pict = create(*args)
+			entry = self.brushes[key] = [pict, 0]
+			self.keys[pict.id] = key
+			self.created = self.created + 1
+		else:
+			self.avoided = self.avoided + 1
+			self.unused.pop(key, None)
+		entry[1] = entry[1] + 1
+		return entry[0]
+
+	def solid_fill(self, color):
+		return self.get(('solid', color_key(color)), self.display.xrender_create_solid_fill, color)
+
+	def linear_gradient(self, p1, p2, *stops):
+		key = 'linear', point_key(p1), point_key(p2), stops_key(stops)
+		return self.get(key, self.display.xrender_create_linear_gradient, p1, p2, *stops)
+
+	def radial_gradient(self, inner_center, outer_center, inner_radius, outer_radius, *stops):
+		key = ('radial', point_key(inner_center), point_key(outer_center),
+			fixed(inner_radius), fixed(outer_radius), stops_key(stops))
+		return self.get(key, self.display.xrender_create_radial_gradient,
+			inner_center, outer_center, inner_radius, outer_radius, *stops)
+
+	def conical_gradient(self, center, angle, *stops):
+		key = 'conical', point_key(center), fixed(angle), stops_key(stops)
+		return self.get(key, self.display.xrender_create_conical_gradient, center, angle, *stops)
+
+	def release(self, pict):
+		"""Drop one use of a brush."""
+		key = self.keys[pict.id]
+		entry = self.brushes[key]
+		entry[1] = entry[1] - 1
+		if entry[1] > 0:
+			return
+		self.unused[key] = 1
+		while len(self.unused) > self.keep:
+			self.evict(self.unused.popitem(last = False)[0])
+
+	def evict(self, key):
+		pict = self.brushes.pop(key)[0]
+		del self.keys[pict.id]
+		self.freed = self.freed + 1
+		pict.free()
+
+	def clear(self):
+		"""Free every unused brush."""
+		while self.unused:
+			self.evict(self.unused.popitem()[0])
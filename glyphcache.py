@@ -0,0 +1,147 @@
+
+# Client-side glyph cache on top of render.GlyphSet
+#
+# Glyphs are uploaded lazily the first time a composite_glyphs* call
+# needs them, and the least recently used ones are freed again once
+# the server-side glyph memory goes over the configured budget.
+
+import types
+from collections import OrderedDict
+
+from Xlib.protocol import rq
+
+def glyph_ids(glyphcmd):
+	"""Return the glyph ids drawn by a single glyphcmd, or None for a glyphset switch."""
+	if type(glyphcmd) is types.StringType:
+		return map(ord, glyphcmd)
+	if type(glyphcmd) is types.TupleType:
+		glyphs = glyphcmd[2]
+	elif type(glyphcmd) is types.DictType or isinstance(glyphcmd, rq.DictWrapper):
+		glyphs = glyphcmd['glyphs']
+	else:
+		return None
+	if type(glyphs) is types.StringType:
+		return map(ord, glyphs)
+	return glyphs
+
+class GlyphCache:
+	"""Managed glyph storage for a GlyphSet.
+
+	loader(glyphid) is called for glyphs that are not on the server yet,
+	and must return a (glyphinfo, image) pair as accepted by
+	GlyphSet.add_glyphs. budget is the number of image bytes the cache
+	may keep on the server.
+	"""
+
+	def __init__(self, glyphset, loader, budget):
+		self.glyphset = glyphset
+		self.loader = loader
+		self.budget = budget
+		# glyphid -> image size, least recently used first
+		self.glyphs = OrderedDict()
+		self.used = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def __glyphset__(self):
+		return self.glyphset.__glyphset__()
+
+	def stats(self):
+		return dict(hits = self.hits, misses = self.misses, evictions = self.evictions,
+			glyphs = len(self.glyphs), used = self.used, budget = self.budget)
+
+	def ensure(self, glyphids):
+		"""Make sure that all of glyphids are on the server."""
+		seen = set()
+		order = []
+		missing = []
+		for glyphid in glyphids:
+			if glyphid in seen:
+				continue
+			seen.add(glyphid)
+			order.append(glyphid)
+			if glyphid not in self.glyphs:
+				info, image = self.loader(glyphid)
+				missing.append((glyphid, info, image))
+
+		# Only record the glyphs once they are sent, so that a failing
+		# loader or add_glyphs leaves the cache as it was
+		if missing:
+			self.glyphset.add_glyphs(*missing)
+
+		sizes = dict([(glyphid, len(image)) for glyphid, info, image in missing])
+		self.hits += len(order) - len(missing)
+		self.misses += len(missing)
+		self.used += sum(sizes.values())
+		for glyphid in order:
+			if glyphid in sizes:
+				size = sizes[glyphid]
+			else:
+				size = self.glyphs.pop(glyphid)
+			# (Re)inserting marks the glyph as the most recently used
+			self.glyphs[glyphid] = size
+
+		self.evict(seen)
+
+	def evict(self, keep = ()):
+		"""Free least recently used glyphs until we're within the budget.
+
+		Glyphs in keep are never freed, even if that means going over the budget.
+		"""
+		freed = []
+		for glyphid in self.glyphs.keys():
+			if self.used <= self.budget or glyphid in keep:
+				break
+			self.used -= self.glyphs.pop(glyphid)
+			freed.append(glyphid)
+
+		if freed:
+			self.evictions += len(freed)
+			self.glyphset.free_glyphs(*freed)
+
+	def clear(self):
+		"""Free every glyph held by the cache."""
+		if self.glyphs:
+			self.glyphset.free_glyphs(*self.glyphs.keys())
+		self.glyphs.clear()
+		self.used = 0
+
+	def prepare(self, glyphcmds):
+		"""Upload the glyphs needed by glyphcmds and return them ready for sending.
+
+		GlyphCache instances may be used as glyphset switches in glyphcmds;
+		glyphs following them are managed by that cache.
+		"""
+		cache = self
+		needed = {}
+		cmds = []
+		for glyphcmd in glyphcmds:
+			glyphs = glyph_ids(glyphcmd)
+			if glyphs is not None:
+				if cache is not None:
+					needed.setdefault(cache, []).extend(glyphs)
+			elif isinstance(glyphcmd, GlyphCache):
+				cache = glyphcmd
+				glyphcmd = cache.glyphset
+			else:
+				# A plain glyphset is not managed by any cache
+				cache = None
+			cmds.append(glyphcmd)
+
+		for cache, glyphs in needed.items():
+			cache.ensure(glyphs)
+
+		return cmds
+
+	def composite_glyphs_8(self, pict, op, src, mask_format, src_x, src_y, *glyphcmds):
+		pict.composite_glyphs_8(op, src, mask_format, self.glyphset, src_x, src_y, *self.prepare(glyphcmds))
+
+	def composite_glyphs_16(self, pict, op, src, mask_format, src_x, src_y, *glyphcmds):
+		pict.composite_glyphs_16(op, src, mask_format, self.glyphset, src_x, src_y, *self.prepare(glyphcmds))
+
+	def composite_glyphs_32(self, pict, op, src, mask_format, src_x, src_y, *glyphcmds):
+		pict.composite_glyphs_32(op, src, mask_format, self.glyphset, src_x, src_y, *self.prepare(glyphcmds))
+
+	def composite_glyphs(self, pict, op, src, mask_format, src_x, src_y, *glyphcmds):
+		pict.composite_glyphs(op, src, mask_format, self.glyphset, src_x, src_y, *self.prepare(glyphcmds))
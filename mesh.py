@@ -0,0 +1,260 @@
+
+# Triangle mesh optimizer
+#
+# A Triangles request takes 24 bytes per triangle, while a TriStrip or
+# TriFan takes 8 bytes per triangle once under way. Mesh finds the
+# edges shared between triangles and chains them into fans around
+# vertices with many triangles, and into strips elsewhere. The strips
+# are stitched into a single TriStrip with degenerate triangles, and the
+# triangles that don't chain up are sent with Triangles.
+#
+# Render has no culling, so the winding of the triangles doesn't matter,
+# and degenerate triangles have no area, so they cover nothing.
+
+from Xlib.ext import render
+
+# Smallest number of triangles around a vertex sent as a fan. Lower
+# values turn regular grids into fans, which strip better.
+FanMin = 16
+
+# Smallest number of triangles in a strip; shorter ones don't pay for
+# the two vertices that join them to the rest.
+StripMin = 3
+
+def stitch(strips):
+	"""Join triangle strips into one, with degenerate triangles in between."""
+	points = []
+	for strip in strips:
+		if points:
+			points.append(points[-1])
+			points.append(strip[0])
+		points.extend(strip)
+	return points
+
+def fan_strips(fan):
+	"""Split a fan into strips of two triangles, the most a strip can take from one."""
+	center = fan[0]
+	strips = []
+	for i in range(1, len(fan) - 1, 2):
+		strips.append([fan[i], center] + fan[i + 1:i + 3])
+	return strips
+
+def request_bytes(chunks, header, item):
+	return sum([header + item * len(chunk) for chunk in chunks])
+
+class Mesh:
+	"""Triangles regrouped into a strip, fans and leftover triangles.
+
+	triangles are given as for Picture.triangles, three (x, y) points
+	each. Points are only shared when they are exactly equal. The
+	grouping is done once, and can be drawn any number of times.
+	"""
+
+	def __init__(self, triangles):
+		self.source = [tuple([tuple(p) for p in triangle]) for triangle in triangles]
+		self.vertices = []
+		index = {}
+		tris = []
+		for triangle in self.source:
+			tri = []
+			for point in triangle:
+				i = index.get(point)
+				if i is None:
+					i = index[point] = len(self.vertices)
+					self.vertices.append(point)
+				tri.append(i)
+			# Triangles with a repeated vertex cover nothing
+			if tri[0] != tri[1] and tri[1] != tri[2] and tri[0] != tri[2]:
+				tris.append(tuple(tri))
+		self.tris = tris
+
+		self.used = [0] * len(tris)
+		self.edges = {}
+		self.corners = {}
+		for t, (a, b, c) in enumerate(tris):
+			for edge in ((a, b), (b, c), (c, a)):
+				self.edges.setdefault((min(edge), max(edge)), []).append(t)
+			for v in (a, b, c):
+				self.corners.setdefault(v, []).append(t)
+
+		fans = self.find_fans()
+		strips = self.find_strips()
+		del self.used, self.edges, self.corners
+
+		points = self.vertices
+		self.fans = [[points[v] for v in fan] for fan in fans]
+		chained = [[points[v] for v in strip] for strip in strips if len(strip) - 2 >= StripMin]
+		self.strip = stitch(chained)
+		self.triangles = []
+		for strip in strips:
+			if len(strip) - 2 < StripMin:
+				for i in range(len(strip) - 2):
+					self.triangles.append(tuple([points[v] for v in strip[i:i + 3]]))
+		del self.tris, self.vertices
+
+	def other(self, t, a, b):
+		for v in self.tris[t]:
+			if v != a and v != b:
+				return v
+
+	def next_triangle(self, a, b, used):
+		for t in self.edges[min(a, b), max(a, b)]:
+			if not self.used[t] and t not in used:
+				return t
+		return None
+
+	def extend(self, strip, used):
+		"""Grow strip at its end with unused triangles, adding them to used."""
+		while 1:
+			t = self.next_triangle(strip[-2], strip[-1], used)
+			if t is None:
+				return strip
+			used[t] = 1
+			strip.append(self.other(t, strip[-2], strip[-1]))
+
+	def find_fans(self):
+		fans = []
+		order = sorted(self.corners, key = lambda v: -len(self.corners[v]))
+		for center in order:
+			if len(self.corners[center]) < FanMin:
+				break
+			while 1:
+				fan = self.find_fan(center)
+				if len(fan) - 2 < FanMin:
+					break
+				fans.append(fan)
+		return fans
+
+	def find_fan(self, center):
+		"""Return the longest chain of unused triangles around center, marking them used if long enough."""
+		spokes = {}
+		around = [t for t in self.corners[center] if not self.used[t]]
+		for t in around:
+			for v in self.tris[t]:
+				if v != center:
+					spokes.setdefault(v, []).append(t)
+		best = []
+		seen = {}
+		# Start from the ends of open chains first, then from anywhere on closed ones
+		starts = [t for t in around if [v for v in self.tris[t] if v != center and len(spokes[v]) == 1]]
+		for t in starts + around:
+			if t in seen:
+				continue
+			a, b = [v for v in self.tris[t] if v != center]
+			if len(spokes[b]) == 1:
+				a, b = b, a
+			chain = [t]
+			seen[t] = 1
+			fan = [center, a, b]
+			while 1:
+				following = [u for u in spokes[fan[-1]] if u not in seen]
+				if not following:
+					break
+				t = following[0]
+				seen[t] = 1
+				chain.append(t)
+				fan.append(self.other(t, center, fan[-1]))
+			if len(chain) > len(best):
+				best, best_fan = chain, fan
+		if len(best) < FanMin:
+			return []
+		for t in best:
+			self.used[t] = 1
+		return best_fan
+
+	def find_strips(self):
+		strips = []
+		# Start at the triangles with the fewest neighbours, so that the
+		# middle of the mesh isn't used up before its borders
+		neighbours = [0] * len(self.tris)
+		for tris in self.edges.values():
+			for t in tris:
+				neighbours[t] = neighbours[t] + len(tris) - 1
+		order = sorted(range(len(self.tris)), key = neighbours.__getitem__)
+		for t in order:
+			if self.used[t]:
+				continue
+			a, b, c = self.tris[t]
+			best = None
+			for strip in ([a, b, c], [b, c, a], [c, a, b]):
+				used = {t: 1}
+				strip = self.extend(strip, used)
+				if best is None or len(strip) > len(best[0]):
+					best = strip, used
+			strip, used = best
+			for u in used:
+				self.used[u] = 1
+			# Then grow the other end, which is the start of the reversed strip
+			strip.reverse()
+			used = {}
+			self.extend(strip, used)
+			for u in used:
+				self.used[u] = 1
+			strips.append(strip)
+		return strips
+
+	def stats(self, display):
+		"""Return the request bytes of drawing the mesh, and what Triangles alone would take."""
+		triangle_bytes = request_bytes(render.split_list(display, 24, 24, self.source), 24, 24)
+		mesh_bytes = 0
+		if self.strip:
+			mesh_bytes = request_bytes(render.split_strip(display, 24, self.strip), 24, 8)
+		for fan in self.fans:
+			mesh_bytes = mesh_bytes + request_bytes(render.split_fan(display, 24, fan), 24, 8)
+		if self.triangles:
+			mesh_bytes = mesh_bytes + request_bytes(render.split_list(display, 24, 24, self.triangles), 24, 24)
+		return dict(triangles = len(self.source), strip_points = len(self.strip), fans = len(self.fans),
+			leftovers = len(self.triangles), triangle_bytes = triangle_bytes, mesh_bytes = mesh_bytes,
+			saved = triangle_bytes - mesh_bytes)
+
+	def single_strip(self):
+		"""Return every triangle of the mesh in one strip."""
+		strips = [self.strip] if self.strip else []
+		for fan in self.fans:
+			strips.extend(fan_strips(fan))
+		strips.extend([list(triangle) for triangle in self.triangles])
+		return stitch(strips)
+
+	def draw(self, pict, op, src, mask_format, src_x, src_y):
+		"""Draw the triangles on pict like Picture.triangles, returning the number of bytes saved.
+
+		The source stays aligned as it would be for a single Triangles
+		request. Without a mask format every triangle is composited on
+		its own, so the mesh can be sent as any number of requests. With
+		one, the server composites through one mask per request, so the
+		mesh is sent as a single TriStrip when it fits in a request and
+		is smaller than the Triangles requests; otherwise the triangles
+		are sent as they were given.
+		"""
+		if not self.source:
+			return 0
+		display = pict.display
+		first_x, first_y = render.source_anchor(self.source[0][0])
+		stats = self.stats(display)
+
+		if mask_format:
+			strip = self.single_strip()
+			chunks = render.split_strip(display, 24, strip)
+			size = request_bytes(chunks, 24, 8)
+			if len(chunks) > 1 or size >= stats['triangle_bytes']:
+				pict.triangles(op, src, mask_format, src_x, src_y, *self.source)
+				return 0
+			x, y = render.source_anchor(strip[0])
+			pict.tri_strip(op, src, mask_format, src_x + x - first_x, src_y + y - first_y, *strip)
+			return stats['triangle_bytes'] - size
+
+		if stats['saved'] <= 0:
+			pict.triangles(op, src, mask_format, src_x, src_y, *self.source)
+			return 0
+		# Each request aligns the source with its own first point
+		for chunk in render.split_strip(display, 24, self.strip) if self.strip else []:
+			x, y = render.source_anchor(chunk[0])
+			pict.tri_strip(op, src, mask_format, src_x + x - first_x, src_y + y - first_y, *chunk)
+		for fan in self.fans:
+			for chunk in render.split_fan(display, 24, fan):
+				x, y = render.source_anchor(chunk[0])
+				pict.tri_fan(op, src, mask_format, src_x + x - first_x, src_y + y - first_y, *chunk)
+		for chunk in render.split_list(display, 24, 24, self.triangles) if self.triangles else []:
+			x, y = render.source_anchor(chunk[0][0])
+			pict.triangles(op, src, mask_format, src_x + x - first_x, src_y + y - first_y, *chunk)
+		return stats['saved']
@@ -0,0 +1,110 @@
+
+# Pool of scratch pictures
+#
+# Masks and intermediate pictures are usually needed only for a few
+# requests. Instead of creating a pixmap and picture and freeing them
+# again every time, PicturePool hands out pictures it created earlier,
+# with their state reset to the defaults. Sizes are rounded up to
+# buckets, so that pictures of similar sizes can be shared.
+
+from Xlib.ext import render
+import upload
+
+# Smallest bucket size in pixels
+MinBucket = 16
+
+def bucket(size):
+	"""Round size up to its bucket: a power of two, at least MinBucket."""
+	result = MinBucket
+	while result < size:
+		result = result << 1
+	return result
+
+class PooledPicture(render.Picture):
+	"""A picture handed out by a PicturePool.
+
+	Tracks its state (see render.Picture.track_state), so that releasing
+	it back to the pool only resets what was changed.
+	"""
+
+	def __init__(self, display, pid, owner = 0):
+		render.Picture.__init__(self, display, pid, owner)
+		self.track_state()
+
+	def reset(self):
+		"""Put the values, clip, transform and filter back to their defaults."""
+		self.change(**render.PictureDefaults)
+		self.set_transform(render.IdentityTransform)
+		self.set_filter(render.FilterNearest)
+
+class PicturePool:
+	"""Scratch pictures on the screen of drawable, reused between uses.
+
+	acquire() returns a picture at least as large as asked for; its
+	contents are undefined. Pictures given back with release() are kept
+	for reuse until they take more than limit bytes of server memory,
+	after which the least recently released ones are freed.
+	"""
+
+	def __init__(self, drawable, limit = 16 << 20):
+		self.drawable = drawable
+		self.display = drawable.display
+		self.limit = limit
+		# (key, picture) pairs, least recently released first
+		self.idle = []
+		self.idle_bytes = 0
+		self.held_bytes = 0
+		self.acquires = 0
+		self.reuses = 0
+		self.frees = 0
+
+	def stats(self):
+		return dict(acquires = self.acquires, reuses = self.reuses, frees = self.frees,
+			reuse_ratio = float(self.reuses) / self.acquires if self.acquires else 0.0,
+			idle = len(self.idle), idle_bytes = self.idle_bytes, held_bytes = self.held_bytes)
+
+	def acquire(self, width, height, format):
+		"""Return a picture of format (a PictFormInfo or one of render.PictStandard*)."""
+		format = upload.find_format(self.display, format)
+		key = bucket(width), bucket(height), format['depth'], format['id']
+		self.acquires = self.acquires + 1
+
+		# Prefer the most recently released picture, it's the likeliest to be in the server's caches
+		for i in range(len(self.idle) - 1, -1, -1):
+			if self.idle[i][0] == key:
+				pict = self.idle.pop(i)[1]
+				self.idle_bytes = self.idle_bytes - pict.size
+				self.reuses = self.reuses + 1
+				return pict
+
+		width, height, depth, format_id = key
+		pixmap = self.drawable.create_pixmap(width, height, depth)
+		pid = pixmap.xrender_create_picture(format_id).id
+		# The picture keeps the pixmap contents alive
+		pixmap.free()
+		pict = PooledPicture(self.display, pid, owner = 1)
+		pict.width = width
+		pict.height = height
+		pict.key = key
+		pict.size = upload.zpixmap_layout(self.display, depth, width)[1] * height
+		self.held_bytes = self.held_bytes + pict.size
+		return pict
+
+	def release(self, pict):
+		"""Give pict back to the pool."""
+		pict.reset()
+		self.idle.append((pict.key, pict))
+		self.idle_bytes = self.idle_bytes + pict.size
+		while self.idle_bytes > self.limit:
+			self.discard(self.idle.pop(0)[1])
+
+	def discard(self, pict):
+		self.idle_bytes = self.idle_bytes - pict.size
+		self.held_bytes = self.held_bytes - pict.size
+		self.frees = self.frees + 1
+		pict.free()
+
+	def clear(self):
+		"""Free every idle picture."""
+		while self.idle:
+			self.discard(self.idle.pop()[1])
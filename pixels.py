@@ -0,0 +1,131 @@
+
+# Pixel format conversions for image, picture and cursor uploads
+#
+# All functions work in place on writable buffers of 32-bit pixels:
+# bytearrays, array.arrays and NumPy arrays. Pixels are ARGB32 in
+# little-endian byte order (B, G, R, A in memory), like Xcursor files
+# and PictStandardARGB32 images on LSBFirst servers. With NumPy, the
+# arithmetic is vectorized; without it, the bytes are translated with
+# lookup tables.
+
+import array
+import re
+
+from Xlib import X
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# premultiply_table[alpha << 8 | value] == value * alpha / 255, rounded
+premultiply_table = bytearray((v * a + 127) // 255 for a in range(256) for v in range(256))
+# unpremultiply_table[alpha << 8 | value] == value * 255 / alpha, rounded and clamped
+unpremultiply_table = bytearray(min((v * 255 + a // 2) // a, 255) if a else 0 for a in range(256) for v in range(256))
+
+# A run of pixels with the same alpha
+alpha_run = re.compile(r'(?s)...(.)(?:...\1)*')
+
+def byte_view(buf):
+	"""Return a writable view of buf as individual bytes.
+
+	NumPy arrays must be C-contiguous; others, like a column slice,
+	can't be flattened without a copy, which would leave buf unchanged.
+	"""
+	if numpy is not None:
+		if isinstance(buf, numpy.ndarray):
+			if not buf.flags.c_contiguous:
+				raise ValueError('arrays must be C-contiguous to be converted in place')
+			return buf.reshape(-1).view(numpy.uint8)
+		return numpy.frombuffer(buf, numpy.uint8)
+	if isinstance(buf, array.array) and buf.itemsize != 1:
+		raise TypeError('without NumPy, arrays must have one byte items')
+	return buf
+
+def apply_table(buf, table):
+	px = byte_view(buf)
+	if numpy is not None:
+		table = numpy.frombuffer(table, numpy.uint8)
+		px = px.reshape(-1, 4)
+		index = px[:, 3:4].astype(numpy.uint16) << 8
+		px[:, :3] = table[index | px[:, :3]]
+		return
+
+	# The runs of pixels with the same alpha are found in place, and
+	# only the runs that change are copied: each is translated with the
+	# row of the table for its alpha, then gets its alpha bytes back.
+	# Single pixels are cheaper to look up one byte at a time; when the
+	# alpha changes on every pixel, finding the runs costs about as much
+	# as converting them.
+	is_array = isinstance(px, array.array)
+	for match in alpha_run.finditer(buffer(px) if is_array else px):
+		pos, end = match.span()
+		alpha = px[pos + 3]
+		# Opaque pixels don't change
+		if alpha == 255:
+			continue
+		if end - pos == 4:
+			row = alpha << 8
+			px[pos] = table[row | px[pos]]
+			px[pos + 1] = table[row | px[pos + 1]]
+			px[pos + 2] = table[row | px[pos + 2]]
+			continue
+		row = buffer(table, alpha << 8, 256)
+		if is_array:
+			run = bytearray(buffer(px, pos, end - pos)).translate(row)
+		else:
+			run = px[pos:end].translate(row)
+		run[3::4] = bytearray(chr(alpha)) * ((end - pos) // 4)
+		px[pos:end] = array.array('B', str(run)) if is_array else run
+
+def premultiply(buf):
+	"""Multiply the color channels by alpha."""
+	apply_table(buf, premultiply_table)
+
+def unpremultiply(buf):
+	"""Divide the color channels by alpha; fully transparent pixels become zero."""
+	apply_table(buf, unpremultiply_table)
+
+def swap_bytes(buf):
+	"""Reverse the byte order of each pixel, converting between ARGB and BGRA in memory."""
+	px = byte_view(buf)
+	if numpy is not None:
+		px.view(numpy.uint32).byteswap(True)
+		return
+	# Extended slice assignment does the work without a Python loop
+	px[0::4], px[3::4] = px[3::4], px[0::4]
+	px[1::4], px[2::4] = px[2::4], px[1::4]
+
+def to_image_byte_order(buf, image_byte_order):
+	"""Convert little-endian pixels to the server's image byte order (display.info.image_byte_order)."""
+	if image_byte_order == X.MSBFirst:
+		swap_bytes(buf)
+
+def rgb24_to_argb32(rgb, argb = None):
+	"""Expand packed R, G, B bytes (like PIL's "RGB" mode) into opaque ARGB32 pixels.
+
+	The pixels are written to argb if given, which must be large enough;
+	otherwise a new bytearray is returned.
+	"""
+	src = byte_view(rgb)
+	count = len(src) // 3
+	if argb is None:
+		argb = bytearray(count * 4)
+	px = byte_view(argb)
+	end = count * 4
+	if numpy is not None:
+		px[0:end:4] = src[2::3]
+		px[1:end:4] = src[1::3]
+		px[2:end:4] = src[0::3]
+		px[3:end:4] = 255
+		return argb
+	# Arrays only take arrays in slice assignments
+	if isinstance(px, array.array):
+		part = lambda data: array.array('B', str(bytearray(data)))
+	else:
+		part = bytearray
+	px[0:end:4] = part(src[2::3])
+	px[1:end:4] = part(src[1::3])
+	px[2:end:4] = part(src[0::3])
+	px[3:end:4] = part(b'\xff' * count)
+	return argb
@@ -5,7 +5,10 @@
 #
 """Rendering extension"""
 
+import array
+import itertools
 import struct
+import time
 import types
 
 from Xlib import X
@@ -17,6 +20,13 @@ extname = 'RENDER'
 PictTypeIndexed = 0
 PictTypeDirect = 1
 
+# Standard formats, as in XRenderFindStandardFormat()
+PictStandardARGB32 = 0
+PictStandardRGB24 = 1
+PictStandardA8 = 2
+PictStandardA4 = 3
+PictStandardA1 = 4
+
 PictOpClear = 0
 PictOpSrc = 1
 PictOpDst = 2
@@ -129,8 +139,10 @@ PictFormat = rq.Card32
 def PictType(arg):
     return rq.Set(arg, 1, (PictTypeIndexed, PictTypeDirect))
 
+PictOps = (PictOpClear, PictOpSrc, PictOpDst, PictOpOver, PictOpOverReverse, PictOpIn, PictOpInReverse, PictOpOut, PictOpOutReverse, PictOpAtop, PictOpAtopReverse, PictOpXor, PictOpAdd, PictOpSaturate, PictOpDisjointClear, PictOpDisjointSrc, PictOpDisjointDst, PictOpDisjointOver, PictOpDisjointOverReverse, PictOpDisjointIn, PictOpDisjointInReverse, PictOpDisjointOut, PictOpDisjointOutReverse, PictOpDisjointAtop, PictOpDisjointAtopReverse, PictOpDisjointXor, PictOpConjointClear, PictOpConjointSrc, PictOpConjointDst, PictOpConjointOver, PictOpConjointOverReverse, PictOpConjointIn, PictOpConjointInReverse, PictOpConjointOut, PictOpConjointOutReverse, PictOpConjointAtop, PictOpConjointAtopReverse, PictOpConjointXor, PictOpMultiply, PictOpScreen, PictOpOverlay, PictOpDarken, PictOpLighten, PictOpColorDodge, PictOpColorBurn, PictOpHardLight, PictOpSoftLight, PictOpDifference, PictOpExclusion, PictOpHSLHue, PictOpHSLSaturation, PictOpHSLColor, PictOpHSLLuminosity)
+
 def PictOp(arg):
-    return rq.Set(arg, 1, (PictOpClear, PictOpSrc, PictOpDst, PictOpOver, PictOpOverReverse, PictOpIn, PictOpInReverse, PictOpOut, PictOpOutReverse, PictOpAtop, PictOpAtopReverse, PictOpXor, PictOpAdd, PictOpSaturate, PictOpDisjointClear, PictOpDisjointSrc, PictOpDisjointDst, PictOpDisjointOver, PictOpDisjointOverReverse, PictOpDisjointIn, PictOpDisjointInReverse, PictOpDisjointOut, PictOpDisjointOutReverse, PictOpDisjointAtop, PictOpDisjointAtopReverse, PictOpDisjointXor, PictOpConjointClear, PictOpConjointSrc, PictOpConjointDst, PictOpConjointOver, PictOpConjointOverReverse, PictOpConjointIn, PictOpConjointInReverse, PictOpConjointOut, PictOpConjointOutReverse, PictOpConjointAtop, PictOpConjointAtopReverse, PictOpConjointXor, PictOpMultiply, PictOpScreen, PictOpOverlay, PictOpDarken, PictOpLighten, PictOpColorDodge, PictOpColorBurn, PictOpHardLight, PictOpSoftLight, PictOpDifference, PictOpExclusion, PictOpHSLHue, PictOpHSLSaturation, PictOpHSLColor, PictOpHSLLuminosity))
+    return rq.Set(arg, 1, PictOps)
 
 def SubPixel(arg):
     # XXX: Padding?
@@ -281,37 +293,68 @@ AnimCursorElt = rq.Struct(
 
 class GlyphItems(rq.ValueField):
     glyphelt = None
+    glyphcode = None
+
+    def glyph_data(self, glyphs):
+        """Return glyphs as a string of packed glyph ids.
+
+        Accepts strings (8-bit glyph ids), arrays, NumPy arrays and
+        any other sequence of integers.
+        """
+        code = rq.struct_to_array_codes[self.glyphcode]
+        if type(glyphs) is types.StringType:
+            if self.glyphcode == 'B':
+                return glyphs
+            glyphs = array.array('B', glyphs)
+        if isinstance(glyphs, array.array) and glyphs.typecode == code:
+            return glyphs.tostring()
+        # NumPy arrays; the dtype is converted without a Python loop,
+        # after the checks array.array would have made
+        if hasattr(glyphs, 'astype'):
+            size = struct.calcsize('=' + self.glyphcode)
+            if glyphs.dtype.kind not in 'iu':
+                raise TypeError('integer argument expected, got %s' % glyphs.dtype)
+            if glyphs.size and (glyphs.min() < 0 or glyphs.max() >= 1 << 8 * size):
+                raise OverflowError('glyph id out of range for %d-bit glyphs' % (8 * size))
+            return glyphs.astype('=u%d' % size).tostring()
+        return array.array(code, glyphs).tostring()
+
     def pack_value(self, value):
-        data = ''
-        args = {}
+        size = struct.calcsize('=' + self.glyphcode)
 
+        # Normalize the items and calculate the total size first,
+        # so that everything can be packed into a single buffer
+        items = []
+        dlen = 0
         for v in value:
             # Let values be simple strings, meaning a delta of 0
             if type(v) is types.StringType:
                 v = (0, 0, v)
 
             # A tuple, it should be (deltax, deltay, string)
-            # Encode it as one or more textitems
+            # Encode it as one or more glyph elements
 
             if type(v) in (types.TupleType, types.DictType) or \
                isinstance(v, rq.DictWrapper):
 
                 if type(v) is types.TupleType:
-                    deltax, deltay, str = v
+                    deltax, deltay, glyphs = v
                 else:
                     deltax = v['deltax']
                     deltay = v['deltay']
-                    str = v['glyphs']
-
-                while deltax or deltay or str:
-                    args['deltax'] = deltax
-                    args['deltay'] = deltay
-                    args['glyphs'] = str[:254]
+                    glyphs = v['glyphs']
 
-                    data = data + apply(self.glyphelt.to_binary, (), args)
+                glyphs = self.glyph_data(glyphs)
+                count = len(glyphs) // size
+                if not count and not (deltax or deltay):
+                    continue
+                items.append((deltax, deltay, glyphs, count))
 
-                    deltax = deltay = 0
-                    str = str[254:]
+                # Each element holds at most 254 glyphs, padded to four bytes
+                full, rest = divmod(count, 254)
+                dlen = dlen + full * (8 + (254 * size + 3) // 4 * 4)
+                if rest or not full:
+                    dlen = dlen + 8 + (rest * size + 3) // 4 * 4
 
             # Else an integer, i.e. a font change
             else:
@@ -319,12 +362,33 @@ class GlyphItems(rq.ValueField):
                 if type(v) is types.InstanceType:
                     v = v.__glyphset__()
 
-                # XXX: Endianness?
-                data = data + struct.pack('<B3xHHL', 255, 0, 0, v)
+                items.append(v)
+                dlen = dlen + 12
 
-        # Pad out to four byte length
-        dlen = len(data)
-        return data + '\0' * ((4 - dlen % 4) % 4), None, None
+        data = bytearray(dlen)
+        pos = 0
+        for item in items:
+            if type(item) is not types.TupleType:
+                # XXX: Endianness?
+                struct.pack_into('<B3xHHL', data, pos, 255, 0, 0, item)
+                pos = pos + 12
+                continue
+
+            deltax, deltay, glyphs, count = item
+            glyphs = memoryview(glyphs)
+            start = 0
+            while 1:
+                n = min(count - start, 254)
+                struct.pack_into('=B3xhh', data, pos, n, deltax, deltay)
+                pos = pos + 8
+                data[pos:pos + n * size] = glyphs[start * size:(start + n) * size]
+                pos = pos + (n * size + 3) // 4 * 4
+                deltax = deltay = 0
+                start = start + n
+                if start >= count:
+                    break
+
+        return str(data), None, None
 
     def parse_binary_value(self, data, display, length, format):
         values = []
@@ -348,14 +412,17 @@ class GlyphItems(rq.ValueField):
 
 class GlyphItems8(GlyphItems):
     glyphelt = GlyphElt8
+    glyphcode = 'B'
 
 
 class GlyphItems16(GlyphItems):
     glyphelt = GlyphElt16
+    glyphcode = 'H'
 
 
 class GlyphItems32(GlyphItems):
     glyphelt = GlyphElt32
+    glyphcode = 'L'
 
 
 def PictureValues(arg):
@@ -375,6 +442,302 @@ def PictureValues(arg):
         rq.Bool('component_alpha'),
         )
 
+# The values of a newly created picture. graphics_exposures is left
+# out, so that it's always sent: the X.Org server starts pictures with
+# it False, unlike a GC, and other servers may not agree.
+PictureDefaults = {
+    'repeat': RepeatNone,
+    'alpha_map': X.NONE,
+    'alpha_x_origin': 0,
+    'alpha_y_origin': 0,
+    'clip_x_origin': 0,
+    'clip_y_origin': 0,
+    'clip_mask': X.NONE,
+    'subwindow_mode': X.ClipByChildren,
+    'poly_edge': PolyEdgeSharp,
+    'poly_mode': PolyModePrecise,
+    'dither': X.NONE,
+    'component_alpha': 0,
+    }
+
+IdentityTransform = (1, 0, 0, 0, 1, 0, 0, 0, 1)
+
+
+class RawRequest(rq.Request):
+    """A request whose binary representation has already been built."""
+
+    def __init__(self, display, binary, onerror = None):
+        self._errorhandler = onerror
+        self._binary = binary
+        self._serial = None
+        display.send_request(self, onerror is not None)
+
+
+def max_request_size(display):
+    """Return the maximum request size in bytes.
+
+    python-xlib does not enable BIG-REQUESTS (request lengths are always
+    packed into 16 bits), so this is the core limit from the connection setup.
+    """
+    return display.info.max_request_length * 4
+
+def split_list(display, header_size, item_size, items):
+    """Split items into as few chunks as possible, each fitting in a single request."""
+    count = max((max_request_size(display) - header_size) // item_size, 1)
+    if len(items) <= count:
+        return [items]
+    return [items[i:i + count] for i in range(0, len(items), count)]
+
+def split_strip(display, header_size, points):
+    """Split a triangle strip, repeating the two vertices shared between chunks."""
+    count = max((max_request_size(display) - header_size) // 8, 3)
+    chunks = []
+    start = 0
+    while 1:
+        chunks.append(points[start:start + count])
+        if start + count >= len(points):
+            return chunks
+        start = start + count - 2
+
+def split_fan(display, header_size, points):
+    """Split a triangle fan, repeating the center and the last edge vertex in each chunk."""
+    count = max((max_request_size(display) - header_size) // 8, 3)
+    chunks = [points[:count]]
+    start = count - 1
+    while start + 1 < len(points):
+        if hasattr(points, 'take'):
+            chunks.append(points.take([0] + range(start, min(start + count - 1, len(points))), axis = 0))
+        else:
+            chunks.append(tuple(points[:1]) + tuple(points[start:start + count - 1]))
+        start = start + count - 2
+    return chunks
+
+# The server aligns the source with the first point of each request:
+# the left p1 of the first trapezoid, the p1 of the first triangle or
+# the first point of a strip or fan, truncated to a pixel. When a call
+# is split, src_x and src_y are moved along for every chunk by how far
+# its first point is from the first point of the whole call.
+
+def item_field(item, name, index):
+    if type(item) is types.DictType or isinstance(item, rq.DictWrapper):
+        return item[name]
+    return item[index]
+
+def trapezoid_point(trap):
+    return item_field(item_field(trap, 'left', 2), 'p1', 0)
+
+def triangle_point(triangle):
+    return item_field(triangle, 'p1', 0)
+
+def strip_point(point):
+    return point
+
+def source_anchor(point):
+    """Return the pixel the server aligns the source to when point is the first one of a request."""
+    x, y = point_values(point)
+    return int(x*2**16) >> 16, int(y*2**16) >> 16
+
+def chunk_anchor(chunk, column, first_point):
+    """Return the pixel the source is aligned to for a request holding chunk.
+
+    Arrays from fixed_array() hold the first point at column.
+    """
+    if not len(chunk):
+        return 0, 0
+    if hasattr(chunk, 'dtype'):
+        return int(chunk[0, column]) >> 16, int(chunk[0, column + 1]) >> 16
+    return source_anchor(first_point(chunk[0]))
+
+def source_offsets(chunks, column, first_point):
+    """Return (chunk, dx, dy) for each chunk, dx and dy moving the source along with it."""
+    first_x, first_y = chunk_anchor(chunks[0], column, first_point)
+    offsets = []
+    for chunk in chunks:
+        x, y = chunk_anchor(chunk, column, first_point)
+        offsets.append((chunk, x - first_x, y - first_y))
+    return offsets
+
+
+def resource_id(value):
+    """Return the resource id of a resource object, or value itself if it's an id.
+
+    Like the request fields, this takes objects that only stand in for
+    a glyph set or a picture, such as a glyphcache.GlyphCache.
+    """
+    for method in ('__resource__', '__glyphset__', '__picture__'):
+        if hasattr(value, method):
+            return getattr(value, method)()
+    return value
+
+
+# Fast-path packers for the most common fixed-layout requests.
+# They produce the same bytes as the rq.Struct definitions below,
+# without going through the generic field machinery. With strict
+# set to false, the arguments are only checked by struct.pack itself,
+# and colors and rectangles must be given as tuples.
+
+strict = 1
+
+def set_strict(value):
+    global strict
+    strict = value
+
+def check_op(op):
+    if op not in PictOps:
+        raise ValueError('field op: argument %s not in %s' % (op, PictOps))
+
+def color_values(color):
+    if type(color) is types.DictType or isinstance(color, rq.DictWrapper):
+        return color['red'], color['green'], color['blue'], color['alpha']
+    return color
+
+def rect_values(rect):
+    if type(rect) is types.DictType or isinstance(rect, rq.DictWrapper):
+        return rect['x'], rect['y'], rect['width'], rect['height']
+    return tuple(rect)
+
+_composite = struct.Struct('=BBHB3xLLLhhhhhhHH')
+_fill_rectangles = struct.Struct('=BBHB3xLHHHH')
+_create_solid_fill = struct.Struct('=BBHLHHHH')
+_set_picture_transform = struct.Struct('=BBHL9l')
+_free_picture = struct.Struct('=BBHL')
+_create_cursor = struct.Struct('=BBHLLHH')
+
+def pack_composite(opcode, op, src, mask, dst, src_x, src_y, mask_x, mask_y, dst_x, dst_y, width, height):
+    if strict:
+        check_op(op)
+    return _composite.pack(opcode, 8, 9, op, resource_id(src), resource_id(mask), resource_id(dst),
+        src_x, src_y, mask_x, mask_y, dst_x, dst_y, width, height)
+
+def pack_fill_rectangles(opcode, op, dst, color, rects):
+    if strict:
+        check_op(op)
+        color = color_values(color)
+        rects = [rect_values(rect) for rect in rects]
+    red, green, blue, alpha = color
+    header = _fill_rectangles.pack(opcode, 26, 5 + 2 * len(rects), op, resource_id(dst), red, green, blue, alpha)
+    return header + struct.pack('=' + 'hhHH' * len(rects), *itertools.chain.from_iterable(rects))
+
+def pack_create_solid_fill(opcode, pid, color):
+    if strict:
+        color = color_values(color)
+    red, green, blue, alpha = color
+    return _create_solid_fill.pack(opcode, 33, 4, pid, red, green, blue, alpha)
+
+def transform_values(transform):
+    """Return the matrix entries of transform as Fixed values."""
+    if type(transform) is types.DictType or isinstance(transform, rq.DictWrapper):
+        transform = [transform[name] for name in ('p11', 'p12', 'p13', 'p21', 'p22', 'p23', 'p31', 'p32', 'p33')]
+    elif hasattr(transform, 'dtype'):
+        return fixed_array((transform, ), 9)[0].tolist()
+    return [int(v*2**16) for v in transform]
+
+def pack_set_picture_transform(opcode, picture, transform):
+    return _set_picture_transform.pack(opcode, 28, 11, resource_id(picture), *transform_values(transform))
+
+def pack_free_picture(opcode, picture):
+    return _free_picture.pack(opcode, 7, 2, resource_id(picture))
+
+def pack_create_cursor(opcode, cid, source, x, y):
+    return _create_cursor.pack(opcode, 27, 4, cid, resource_id(source), x, y)
+
+
+# Geometry given as NumPy arrays is converted to Fixed and packed in one
+# pass, instead of going through rq.List and Fixed one value at a time.
+# Picture and RenderBatch methods taking points, triangles, traps or
+# gradient stops accept a single array in place of the tuples.
+
+_geometry = struct.Struct('=BBHB3xLLLhh')
+_add_traps = struct.Struct('=BBHLhh')
+_gradient = struct.Struct('=BBHL')
+
+def fixed_array(items, width):
+    """Return items as an (N, width) array of Fixed values if it's a single NumPy array, otherwise None.
+
+    Float arrays, and arrays of integer types other than int32, hold
+    plain values, which are converted like Fixed.check_value does.
+    int32 arrays are taken to hold Fixed values already. Values that
+    don't fit in a Fixed, NaN and infinities raise struct.error, as
+    they do when packed from tuples.
+    """
+    if len(items) != 1 or not hasattr(items[0], 'dtype'):
+        return None
+    values = items[0]
+    if values.dtype.kind == 'i' and values.dtype.itemsize == 4:
+        values = values.astype('=i4')
+    else:
+        values = values * 65536.0
+        # NaN is the only value not equal to itself
+        if (values != values).any() or not ((values > -2.0**31 - 1) & (values < 2.0**31)).all():
+            raise struct.error("'l' format requires -2147483648 <= number <= 2147483647")
+        # Truncates towards zero, like int()
+        values = values.astype('=i4')
+    return values.reshape(-1, width)
+
+def point_values(point):
+    if type(point) is types.DictType or isinstance(point, rq.DictWrapper):
+        return point['x'], point['y']
+    return tuple(point)
+
+def pack_geometry(opcode, minor, op, src, dst, mask_format, src_x, src_y, values):
+    """Pack a Trapezoids, Triangles, TriStrip or TriFan request with values from fixed_array()."""
+    if strict:
+        check_op(op)
+    data = values.tostring()
+    return _geometry.pack(opcode, minor, 6 + len(data) // 4, op, resource_id(src), resource_id(dst),
+        resource_id(mask_format), src_x, src_y) + data
+
+def pack_add_traps(opcode, picture, off_x, off_y, values):
+    data = values.tostring()
+    return _add_traps.pack(opcode, 32, 3 + len(data) // 4, resource_id(picture), off_x, off_y) + data
+
+def pack_gradient(opcode, minor, pid, fixed, stops):
+    """Pack a Create*Gradient request, with the Fixed fields before the stops in fixed.
+
+    stops is an (N, 5) NumPy array of offset, red, green, blue and alpha.
+    """
+    offsets = fixed_array((stops[:, 0],), 1).tostring()
+    colors = stops[:, 1:].astype('=u2').tostring()
+    data = struct.pack('=%dlL' % len(fixed), *([int(v*2**16) for v in fixed] + [len(stops)]))
+    return _gradient.pack(opcode, minor, 2 + (len(data) + len(offsets) + len(colors)) // 4, pid) + data + offsets + colors
+
+def stop_array(stops):
+    """Return stops as an (N, 5) array if it's a single NumPy array, otherwise None."""
+    if len(stops) != 1 or not hasattr(stops[0], 'dtype'):
+        return None
+    return stops[0].reshape(-1, 5)
+
+
+class ReplyFuture(object):
+    """Handle for the reply of a request sent with defer set.
+
+    Several deferred requests can be sent back to back, and their
+    replies then arrive in a single round trip.
+    """
+
+    def __init__(self, request):
+        self.request = request
+
+    def arrived(self):
+        return self.request._data is not None or self.request._error is not None
+
+    def done(self):
+        """Return true if the reply (or an error) has arrived, reading what the server has sent so far."""
+        if not self.arrived():
+            # Flush the request and read without blocking
+            self.request._display.pending_events()
+        return self.arrived()
+
+    def result(self):
+        """Wait for the reply and return it, or raise the error."""
+        self.request.reply()
+        return self.request
+
+def deferred(request, defer):
+    if defer:
+        return ReplyFuture(request)
+    return request
+
 
 class QueryVersion(rq.ReplyRequest):
     _request = rq.Struct(
@@ -395,13 +758,14 @@ class QueryVersion(rq.ReplyRequest):
             rq.Pad(16),
             )
 
-def query_version(self):
-    return QueryVersion(
+def query_version(self, defer = 0):
+    return deferred(QueryVersion(
         display = self.display,
-        opcode = self.display.get_extension_major(extname),
+        defer = defer,
+        opcode = self.display.render_context.opcode,
         major_version = 0,
         minor_version = 11,
-        )
+        ), defer)
 
 
 class QueryPictFormats(rq.ReplyRequest):
@@ -427,13 +791,14 @@ class QueryPictFormats(rq.ReplyRequest):
         rq.List('subpixels', SubPixelObj),
         )
 
-def query_pict_formats(self):
+def query_pict_formats(self, defer = 0):
     """Query PictFormats supported by the server.
     """
-    return QueryPictFormats(
+    return deferred(QueryPictFormats(
         display = self.display,
-        opcode = self.display.get_extension_major(extname),
-        )
+        defer = defer,
+        opcode = self.display.render_context.opcode,
+        ), defer)
 
 
 # XXX: Untested, my X sever returned BadMatch on every format I tried; no indexed PictFormats?
@@ -455,12 +820,13 @@ class QueryPictIndexValues(rq.ReplyRequest):
         rq.List('indexvalues', IndexValue),
         )
 
-def query_pict_index_values(self, format):
-    return QueryPictIndexValues(
+def query_pict_index_values(self, format, defer = 0):
+    return deferred(QueryPictIndexValues(
         display = self.display,
-        opcode = self.display.get_extension_major(extname),
+        defer = defer,
+        opcode = self.display.render_context.opcode,
         format = format,
-        )
+        ), defer)
 
 
 #QueryDithers, opcode=3 (not in spec)
@@ -481,7 +847,7 @@ def create_picture(self, format, **keys):
     pid = self.display.allocate_resource_id()
     CreatePicture(
         display = self.display,
-        opcode = self.display.get_extension_major(extname),
+        opcode = self.display.render_context.opcode,
         pid = pid,
         drawable = self,
         format = format,
@@ -645,7 +1011,7 @@ def create_glyph_set(self, format):
     gsid = self.display.allocate_resource_id()
     CreateGlyphSet(
         display = self.display,
-        opcode = self.display.get_extension_major(extname),
+        opcode = self.display.render_context.opcode,
         gsid = gsid,
         format = format,
         )
@@ -755,6 +1121,76 @@ class CompositeGlyphs32(rq.Request):
         )
 
 
+def max_glyph(glyphcmds):
+    """Return the largest glyph id used in glyphcmds."""
+    max_glyph = 0
+    for glyphcmd in glyphcmds:
+        if type(glyphcmd) is types.TupleType:
+            deltax, deltay, glyphs = glyphcmd
+        elif type(glyphcmd) is types.DictType or isinstance(glyphcmd, rq.DictWrapper):
+            glyphs = glyphcmd['glyphs']
+        else:
+            glyphs = []
+
+        # Strings are always 8-bit glyph ids
+        if type(glyphs) is types.StringType or not len(glyphs):
+            glyphs = 0
+        elif hasattr(glyphs, 'max'):
+            glyphs = int(glyphs.max())
+        else:
+            glyphs = max(glyphs)
+
+        max_glyph = max(max_glyph, glyphs)
+
+    return max_glyph
+
+
+class GlyphRun(object):
+    """Glyph commands prepared for repeated drawing with CompositeGlyphs*.
+
+    The request width is chosen and the glyph commands are packed once,
+    when the run is created. Drawing the run with
+    Picture.composite_glyph_run only packs the fixed-size request header.
+    GlyphRun objects should not be modified after creation.
+
+    A run is always sent as a single request, since the glyph positions
+    depend on the ones before them, so runs that don't fit in one raise
+    ValueError.
+    """
+
+    _header = struct.Struct('=BBHB3xLLLLhh')
+
+    def __init__(self, glyphset, mask_format, *glyphcmds):
+        max_id = max_glyph(glyphcmds)
+        if max_id < 256:
+            self.minor_opcode, items = 23, GlyphItems8
+        elif max_id < 65536:
+            self.minor_opcode, items = 24, GlyphItems16
+        else:
+            self.minor_opcode, items = 25, GlyphItems32
+
+        self.glyphset = resource_id(glyphset)
+        self.mask_format = mask_format
+        self.glyphcmds = items('glyphcmds').pack_value(glyphcmds)[0]
+        self.length = (self._header.size + len(self.glyphcmds)) // 4
+        # Request lengths are 16 bits without BIG-REQUESTS
+        if self.length > 0xffff:
+            raise ValueError('glyph run of %d bytes does not fit in a request' % (self.length * 4))
+
+    def check_size(self, display):
+        """Raise ValueError if the run is larger than the requests display takes."""
+        if self.length * 4 > max_request_size(display):
+            raise ValueError('glyph run of %d bytes is larger than the maximum request size of %d bytes'
+                % (self.length * 4, max_request_size(display)))
+
+    def to_binary(self, major_opcode, op, src, dst, src_x, src_y):
+        if strict:
+            check_op(op)
+        header = self._header.pack(major_opcode, self.minor_opcode, self.length,
+            op, resource_id(src), resource_id(dst), self.mask_format, self.glyphset, src_x, src_y)
+        return header + self.glyphcmds
+
+
 class FillRectangles(rq.Request):
     _request = rq.Struct(
         rq.Card8('opcode'),
@@ -802,19 +1238,21 @@ class QueryFilters(rq.ReplyRequest):
         rq.ReplyCode(),
         rq.Pad(1),
         rq.Card16('sequence_number'),
+        rq.ReplyLength(),
         rq.LengthOf('aliases', 4),
         rq.LengthOf('filters', 4),
-        rq.Pad(4),
+        rq.Pad(16),
         rq.List('aliases', rq.Card16),
         rq.List('filters', rq.Str),
         )
 
-def query_filters(self):
-    return QueryFilters(
+def query_filters(self, defer = 0):
+    return deferred(QueryFilters(
         display = self.display,
-        opcode = self.display.get_extension_major(extname),
+        defer = defer,
+        opcode = self.display.render_context.opcode,
         drawable = self,
-        )
+        ), defer)
 
 
 class SetPictureFilter(rq.Request):
@@ -843,7 +1281,7 @@ def create_anim_cursor(self, cursors):
     cid = self.display.allocate_resource_id()
     CreateAnimCursor(
         display = self.display,
-        opcode = self.display.get_extension_major(extname),
+        opcode = self.display.render_context.opcode,
         cid = cid,
         cursors = cursors,
         )
@@ -874,11 +1312,9 @@ class CreateSolidFill(rq.Request):
 
 def create_solid_fill(self, color):
     pid = self.display.allocate_resource_id()
-    CreateSolidFill(
+    RawRequest(
         display = self.display,
-        opcode = self.display.get_extension_major(extname),
-        pid = pid,
-        color = color,
+        binary = pack_create_solid_fill(self.display.render_context.opcode, pid, color),
         )
     cls = self.display.get_resource_class('picture', Picture)
     return cls(self.display, pid, owner = 1)
@@ -899,15 +1335,23 @@ class CreateLinearGradient(rq.Request):
 
 def create_linear_gradient(self, p1, p2, *stops):
     pid = self.display.allocate_resource_id()
-    CreateLinearGradient(
-        display = self.display,
-        opcode = self.display.get_extension_major(extname),
-        pid = pid,
-        p1 = p1,
-        p2 = p2,
-        stops = [stop[0] for stop in stops],
-        stop_colors = [stop[1] for stop in stops],
-        )
+    array = stop_array(stops)
+    if array is not None:
+        RawRequest(
+            display = self.display,
+            binary = pack_gradient(self.display.render_context.opcode, 34, pid,
+                point_values(p1) + point_values(p2), array),
+            )
+    else:
+        CreateLinearGradient(
+            display = self.display,
+            opcode = self.display.render_context.opcode,
+            pid = pid,
+            p1 = p1,
+            p2 = p2,
+            stops = [stop[0] for stop in stops],
+            stop_colors = [stop[1] for stop in stops],
+            )
     cls = self.display.get_resource_class('picture', Picture)
     return cls(self.display, pid, owner = 1)
 
@@ -929,17 +1373,25 @@ class CreateRadialGradient(rq.Request):
 
 def create_radial_gradient(self, inner_center, outer_center, inner_radius, outer_radius, *stops):
     pid = self.display.allocate_resource_id()
-    CreateRadialGradient(
-        display = self.display,
-        opcode = self.display.get_extension_major(extname),
-        pid = pid,
-        inner_center = inner_center,
-        outer_center = outer_center,
-        inner_radius = inner_radius,
-        outer_radius = outer_radius,
-        stops = [stop[0] for stop in stops],
-        stop_colors = [stop[1] for stop in stops],
-        )
+    array = stop_array(stops)
+    if array is not None:
+        RawRequest(
+            display = self.display,
+            binary = pack_gradient(self.display.render_context.opcode, 35, pid,
+                point_values(inner_center) + point_values(outer_center) + (inner_radius, outer_radius), array),
+            )
+    else:
+        CreateRadialGradient(
+            display = self.display,
+            opcode = self.display.render_context.opcode,
+            pid = pid,
+            inner_center = inner_center,
+            outer_center = outer_center,
+            inner_radius = inner_radius,
+            outer_radius = outer_radius,
+            stops = [stop[0] for stop in stops],
+            stop_colors = [stop[1] for stop in stops],
+            )
     cls = self.display.get_resource_class('picture', Picture)
     return cls(self.display, pid, owner = 1)
 
@@ -959,34 +1411,131 @@ class CreateConicalGradient(rq.Request):
 
 def create_conical_gradient(self, center, angle, *stops):
     pid = self.display.allocate_resource_id()
-    CreateConicalGradient(
-        display = self.display,
-        opcode = self.display.get_extension_major(extname),
-        pid = pid,
-        center = center,
-        angle = angle,
-        stops = [stop[0] for stop in stops],
-        stop_colors = [stop[1] for stop in stops],
-        )
+    array = stop_array(stops)
+    if array is not None:
+        RawRequest(
+            display = self.display,
+            binary = pack_gradient(self.display.render_context.opcode, 36, pid,
+                point_values(center) + (angle, ), array),
+            )
+    else:
+        CreateConicalGradient(
+            display = self.display,
+            opcode = self.display.render_context.opcode,
+            pid = pid,
+            center = center,
+            angle = angle,
+            stops = [stop[0] for stop in stops],
+            stop_colors = [stop[1] for stop in stops],
+            )
     cls = self.display.get_resource_class('picture', Picture)
     return cls(self.display, pid, owner = 1)
 
 
+class PictureState(object):
+    """Client-side shadow of the values, clip, transform and filter of a picture.
+
+    Each method takes the arguments of the corresponding request,
+    records them, and returns what still has to be sent: nothing if
+    the request wouldn't change anything. Unknown state never matches.
+    """
+
+    def __init__(self, display, known = 1):
+        self.elided = display.render_context.elided
+        if known:
+            self.values = dict(PictureDefaults)
+            self.transform = transform_values(IdentityTransform)
+            self.filter = (FilterNearest, ())
+        else:
+            self.values = {}
+            self.transform = None
+            self.filter = None
+
+    def change(self, keys):
+        """Return the values in keys that differ from the current ones."""
+        changed = {}
+        for key, value in keys.items():
+            value_id = resource_id(value)
+            if key == 'clip_mask' and value_id != X.NONE:
+                # The server converts the pixmap contents into a clip
+                # region, so setting the same pixmap again isn't a no-op
+                changed[key] = value
+                self.values[key] = None
+            elif self.values.get(key, self) != value_id:
+                changed[key] = value
+                self.values[key] = value_id
+        if not changed:
+            self.elided['change'] = self.elided['change'] + 1
+        return changed
+
+    def set_clip_rectangles(self, clip_x_origin, clip_y_origin, rectangles):
+        clip = ('rectangles', tuple([rect_values(rect) for rect in rectangles]))
+        values = self.values
+        if (values.get('clip_x_origin') == clip_x_origin and values.get('clip_y_origin') == clip_y_origin
+                and values.get('clip_mask') == clip):
+            self.elided['set_clip_rectangles'] = self.elided['set_clip_rectangles'] + 1
+            return 0
+        values['clip_x_origin'] = clip_x_origin
+        values['clip_y_origin'] = clip_y_origin
+        values['clip_mask'] = clip
+        return 1
+
+    def set_transform(self, transform):
+        transform = transform_values(transform)
+        if transform == self.transform:
+            self.elided['set_transform'] = self.elided['set_transform'] + 1
+            return 0
+        self.transform = transform
+        return 1
+
+    def set_filter(self, filter, values):
+        filter = (filter, tuple(values))
+        if filter == self.filter:
+            self.elided['set_filter'] = self.elided['set_filter'] + 1
+            return 0
+        self.filter = filter
+        return 1
+
+    def save(self):
+        return dict(self.values), self.transform, self.filter
+
+    def restore(self, saved):
+        """Go back to the state returned by save(), for requests that were never sent."""
+        self.values, self.transform, self.filter = saved
+
+
 class Picture(resource.Resource):
     __picture__ = resource.Resource.__resource__
 
+    # Shadow of the picture state, see track_state()
+    state = None
+
+    def track_state(self, known = 1):
+        """Shadow the picture state, and skip requests that wouldn't change it.
+
+        known tells whether the picture still has the state it was created
+        with; otherwise the first request of each kind is always sent.
+        """
+        self.state = PictureState(self.display, known)
+
     def change(self, **keys):
+        if self.state is not None:
+            keys = self.state.change(keys)
+            if not keys:
+                return
         ChangePicture(
             display = self.display,
-            opcode = self.display.get_extension_major(extname),
+            opcode = self.display.render_context.opcode,
             picture = self,
             values = keys,
             )
 
     def set_clip_rectangles(self, clip_x_origin, clip_y_origin, *rectangles):
+        if self.state is not None and not self.state.set_clip_rectangles(clip_x_origin, clip_y_origin, rectangles):
+            return
         SetPictureClipRectangles(
             display = self.display,
-            opcode = self.display.get_extension_major(extname),
+            opcode = self.display.render_context.opcode,
             picture = self,
             clip_x_origin = clip_x_origin,
             clip_y_origin = clip_y_origin,
@@ -994,85 +1543,78 @@ class Picture(resource.Resource):
             )
 
     def set_transform(self, transform):
-        SetPictureTransform(
+        if self.state is not None and not self.state.set_transform(transform):
+            return
+        RawRequest(
             display = self.display,
-            opcode = self.display.get_extension_major(extname),
-            picture = self,
-            transform = transform,
+            binary = pack_set_picture_transform(self.display.render_context.opcode, self, transform),
             )
 
     def set_filter(self, filter, *values):
+        if self.state is not None and not self.state.set_filter(filter, values):
+            return
         SetPictureFilter(
             display = self.display,
-            opcode = self.display.get_extension_major(extname),
+            opcode = self.display.render_context.opcode,
             picture = self,
             filter = filter,
             values = values,
             )
 
     def fill_rectangles(self, op, color, *rects):
-        FillRectangles(
-            display = self.display,
-            opcode = self.display.get_extension_major(extname),
-            op = op,
-            dst = self,
-            color = color,
-            rects = rects,
-            )
+        opcode = self.display.render_context.opcode
+        for rects in split_list(self.display, 20, 8, rects):
+            RawRequest(
+                display = self.display,
+                binary = pack_fill_rectangles(opcode, op, self, color, rects),
+                )
 
     def create_cursor(self, x, y):
         cid = self.display.allocate_resource_id()
-        CreateCursor(
+        RawRequest(
             display = self.display,
-            opcode = self.display.get_extension_major(extname),
-            cid = cid,
-            source = self,
-            x = x,
-            y = y,
+            binary = pack_create_cursor(self.display.render_context.opcode, cid, self, x, y),
             )
         cls = self.display.get_resource_class('cursor', cursor.Cursor)
         return cls(self.display, cid, owner = 1)
 
     def add_traps(self, off_x, off_y, *trapezoids):
-        AddTraps(
-            display = self.display,
-            opcode = self.display.get_extension_major(extname),
-            picture = self,
-            off_x = off_x,
-            off_y = off_y,
-            trapezoids = trapezoids,
-            )
+        values = fixed_array(trapezoids, 6)
+        if values is not None:
+            for values in split_list(self.display, 12, 24, values):
+                RawRequest(
+                    display = self.display,
+                    binary = pack_add_traps(self.display.render_context.opcode, self, off_x, off_y, values),
+                    )
+            return
+        for trapezoids in split_list(self.display, 12, 24, trapezoids):
+            AddTraps(
+                display = self.display,
+                opcode = self.display.render_context.opcode,
+                picture = self,
+                off_x = off_x,
+                off_y = off_y,
+                trapezoids = trapezoids,
+                )
 
     def free(self):
-        FreePicture(
+        RawRequest(
             display = self.display,
-            opcode = self.display.get_extension_major(extname),
-            picture = self,
+            binary = pack_free_picture(self.display.render_context.opcode, self),
             )
 
 
     def composite(self, op, src, mask, src_x, src_y, mask_x, mask_y, dst_x, dst_y, width, height):
-        Composite(
+        RawRequest(
             display = self.display,
-            opcode = self.display.get_extension_major(extname),
-            op = op,
-            src = src,
-            mask = mask,
-            dst = self,
-            src_x = src_x,
-            src_y = src_y,
-            mask_x = mask_x,
-            mask_y = mask_y,
-            dst_x = dst_x,
-            dst_y = dst_y,
-            width = width,
-            height = height,
+            binary = pack_composite(self.display.render_context.opcode, op, src, mask, self,
+                src_x, src_y, mask_x, mask_y, dst_x, dst_y, width, height),
             )
 
     def scale(self, src, color_scale, alpha_scale, src_x, src_y, dst_x, dst_y, width, height):
         Scale(
             display = self.display,
-            opcode = self.display.get_extension_major(extname),
+            opcode = self.display.render_context.opcode,
             src = src,
             dst = self,
             color_scale = color_scale,
@@ -1086,61 +1628,101 @@ class Picture(resource.Resource):
             )
 
     def trapezoids(self, op, src, mask_format, src_x, src_y, *traps):
-        Trapezoids(
-            display = self.display,
-            opcode = self.display.get_extension_major(extname),
-            op = op,
-            src = src,
-            dst = self,
-            mask_format = mask_format,
-            src_x = src_x,
-            src_y = src_y,
-            traps = traps,
-            )
+        values = fixed_array(traps, 10)
+        if values is not None:
+            for values, dx, dy in source_offsets(split_list(self.display, 24, 40, values), 2, trapezoid_point):
+                RawRequest(
+                    display = self.display,
+                    binary = pack_geometry(self.display.render_context.opcode, 10, op, src, self,
+                        mask_format, src_x + dx, src_y + dy, values),
+                    )
+            return
+        for traps, dx, dy in source_offsets(split_list(self.display, 24, 40, traps), 2, trapezoid_point):
+            Trapezoids(
+                display = self.display,
+                opcode = self.display.render_context.opcode,
+                op = op,
+                src = src,
+                dst = self,
+                mask_format = mask_format,
+                src_x = src_x + dx,
+                src_y = src_y + dy,
+                traps = traps,
+                )
 
     def triangles(self, op, src, mask_format, src_x, src_y, *triangles):
-        Triangles(
-            display = self.display,
-            opcode = self.display.get_extension_major(extname),
-            op = op,
-            src = src,
-            dst = self,
-            mask_format = mask_format,
-            src_x = src_x,
-            src_y = src_y,
-            triangles = triangles,
-            )
+        values = fixed_array(triangles, 6)
+        if values is not None:
+            for values, dx, dy in source_offsets(split_list(self.display, 24, 24, values), 0, triangle_point):
+                RawRequest(
+                    display = self.display,
+                    binary = pack_geometry(self.display.render_context.opcode, 11, op, src, self,
+                        mask_format, src_x + dx, src_y + dy, values),
+                    )
+            return
+        for triangles, dx, dy in source_offsets(split_list(self.display, 24, 24, triangles), 0, triangle_point):
+            Triangles(
+                display = self.display,
+                opcode = self.display.render_context.opcode,
+                op = op,
+                src = src,
+                dst = self,
+                mask_format = mask_format,
+                src_x = src_x + dx,
+                src_y = src_y + dy,
+                triangles = triangles,
+                )
 
     def tri_strip(self, op, src, mask_format, src_x, src_y, *points):
-        TriStrip(
-            display = self.display,
-            opcode = self.display.get_extension_major(extname),
-            op = op,
-            src = src,
-            dst = self,
-            mask_format = mask_format,
-            src_x = src_x,
-            src_y = src_y,
-            points = points,
-            )
+        values = fixed_array(points, 2)
+        if values is not None:
+            for values, dx, dy in source_offsets(split_strip(self.display, 24, values), 0, strip_point):
+                RawRequest(
+                    display = self.display,
+                    binary = pack_geometry(self.display.render_context.opcode, 12, op, src, self,
+                        mask_format, src_x + dx, src_y + dy, values),
+                    )
+            return
+        for points, dx, dy in source_offsets(split_strip(self.display, 24, points), 0, strip_point):
+            TriStrip(
+                display = self.display,
+                opcode = self.display.render_context.opcode,
+                op = op,
+                src = src,
+                dst = self,
+                mask_format = mask_format,
+                src_x = src_x + dx,
+                src_y = src_y + dy,
+                points = points,
+                )
 
     def tri_fan(self, op, src, mask_format, src_x, src_y, *points):
-        TriFan(
-            display = self.display,
-            opcode = self.display.get_extension_major(extname),
-            op = op,
-            src = src,
-            dst = self,
-            mask_format = mask_format,
-            src_x = src_x,
-            src_y = src_y,
-            points = points,
-            )
+        values = fixed_array(points, 2)
+        if values is not None:
+            for values, dx, dy in source_offsets(split_fan(self.display, 24, values), 0, strip_point):
+                RawRequest(
+                    display = self.display,
+                    binary = pack_geometry(self.display.render_context.opcode, 13, op, src, self,
+                        mask_format, src_x + dx, src_y + dy, values),
+                    )
+            return
+        for points, dx, dy in source_offsets(split_fan(self.display, 24, points), 0, strip_point):
+            TriFan(
+                display = self.display,
+                opcode = self.display.render_context.opcode,
+                op = op,
+                src = src,
+                dst = self,
+                mask_format = mask_format,
+                src_x = src_x + dx,
+                src_y = src_y + dy,
+                points = points,
+                )
 
     def composite_glyphs_8(self, op, src, mask_format, glyphset, src_x, src_y, *glyphcmds):
         CompositeGlyphs8(
             display = self.display,
-            opcode = self.display.get_extension_major(extname),
+            opcode = self.display.render_context.opcode,
             op = op,
             src = src,
             dst = self,
@@ -1154,7 +1736,7 @@ class Picture(resource.Resource):
     def composite_glyphs_16(self, op, src, mask_format, glyphset, src_x, src_y, *glyphcmds):
         CompositeGlyphs16(
             display = self.display,
-            opcode = self.display.get_extension_major(extname),
+            opcode = self.display.render_context.opcode,
             op = op,
             src = src,
             dst = self,
@@ -1168,7 +1750,7 @@ class Picture(resource.Resource):
     def composite_glyphs_32(self, op, src, mask_format, glyphset, src_x, src_y, *glyphcmds):
         CompositeGlyphs32(
             display = self.display,
-            opcode = self.display.get_extension_major(extname),
+            opcode = self.display.render_context.opcode,
             op = op,
             src = src,
             dst = self,
@@ -1180,31 +1762,24 @@ class Picture(resource.Resource):
             )
 
     def composite_glyphs(self, op, src, mask_format, glyphset, src_x, src_y, *glyphcmds):
-        max_glyph = 0
-        for glyphcmd in glyphcmds:
-            if type(glyphcmd) is types.TupleType:
-                deltax, deltay, glyphs = glyphcmd
-            elif type(glyphcmd) is types.DictType or isinstance(glyphcmd, rq.DictWrapper):
-                glyphs = glyphcmd['glyphs']
-            else:
-                glyphs = []
-
-            if glyphs:
-                glyphs = max(glyphs)
-            else:
-                glyphs = 0
-
-            max_glyph = max(max_glyph, glyphs)
+        max_id = max_glyph(glyphcmds)
 
-        if max_glyph < 256:
+        if max_id < 256:
             func = self.composite_glyphs_8
-        elif max_glyph < 65536:
+        elif max_id < 65536:
             func = self.composite_glyphs_16
         else:
             func = self.composite_glyphs_32
 
         func(op, src, mask_format, glyphset, src_x, src_y, *glyphcmds)
 
+    def composite_glyph_run(self, op, src, run, src_x, src_y):
+        run.check_size(self.display)
+        RawRequest(
+            display = self.display,
+            binary = run.to_binary(self.display.render_context.opcode, op, src, self, src_x, src_y),
+            )
+
 
 class GlyphSet(resource.Resource):
     __glyphset__ = resource.Resource.__resource__
@@ -1213,7 +1788,7 @@ class GlyphSet(resource.Resource):
         gsid = self.display.allocate_resource_id()
         ReferenceGlyphSet(
             display = self.display,
-            opcode = self.display.get_extension_major(extname),
+            opcode = self.display.render_context.opcode,
             gsid = gsid,
             existing = self,
             )
@@ -1223,30 +1798,532 @@ class GlyphSet(resource.Resource):
     def free(self):
         FreeGlyphSet(
             display = self.display,
-            opcode = self.display.get_extension_major(extname),
+            opcode = self.display.render_context.opcode,
             glyphset = self,
             )
 
     def add_glyphs(self, *glyphs):
-        AddGlyphs(
-            display = self.display,
-            opcode = self.display.get_extension_major(extname),
-            glyphset = self,
-            glyphids = [glyph[0] for glyph in glyphs],
-            glyphs = [glyph[1] for glyph in glyphs],
-            images = ''.join(glyph[2] for glyph in glyphs),
-            )
+        # Split the glyphs so that each request stays within the maximum size
+        limit = max_request_size(self.display)
+        start = 0
+        while 1:
+            size = 12
+            end = start
+            while end < len(glyphs):
+                glyph_size = 16 + len(glyphs[end][2])
+                if end > start and size + glyph_size + 3 > limit:
+                    break
+                size = size + glyph_size
+                end = end + 1
+
+            chunk = glyphs[start:end]
+            AddGlyphs(
+                display = self.display,
+                opcode = self.display.render_context.opcode,
+                glyphset = self,
+                glyphids = [glyph[0] for glyph in chunk],
+                glyphs = [glyph[1] for glyph in chunk],
+                images = ''.join(glyph[2] for glyph in chunk),
+                )
+
+            if end >= len(glyphs):
+                break
+            start = end
 
     def free_glyphs(self, *glyphs):
-        FreeGlyphs(
-            display = self.display,
-            opcode = self.display.get_extension_major(extname),
-            glyphset = self,
-            glyphs = glyphs,
-            )
+        for glyphs in split_list(self.display, 12, 4, glyphs):
+            FreeGlyphs(
+                display = self.display,
+                opcode = self.display.render_context.opcode,
+                glyphset = self,
+                glyphs = glyphs,
+                )
+
+
+# The standard formats as (type, depth, red, green, blue, alpha),
+# with each channel given as (shift, mask)
+StandardFormats = {
+    PictStandardARGB32: (PictTypeDirect, 32, (16, 255), (8, 255), (0, 255), (24, 255)),
+    PictStandardRGB24: (PictTypeDirect, 24, (16, 255), (8, 255), (0, 255), (0, 0)),
+    PictStandardA8: (PictTypeDirect, 8, (0, 0), (0, 0), (0, 0), (0, 255)),
+    PictStandardA4: (PictTypeDirect, 4, (0, 0), (0, 0), (0, 0), (0, 15)),
+    PictStandardA1: (PictTypeDirect, 1, (0, 0), (0, 0), (0, 0), (0, 1)),
+    }
+
+def format_key(type, depth, red, green, blue, alpha):
+    # The shift of a channel that isn't there doesn't matter
+    return (type, depth) + tuple([(shift, mask) if mask else (0, 0) for shift, mask in (red, green, blue, alpha)])
+
+
+class PictFormatTable(object):
+    """Indexed view of a QueryPictFormats reply.
+
+    Formats can be looked up by id (table[id]), by channel layout,
+    by standard format and by visual, without scanning the format list.
+    """
+
+    def __init__(self, reply):
+        self.formats = reply.formats
+        self.by_id = {}
+        self.by_key = {}
+        self.by_visual = {}
+
+        for info in reply.formats:
+            direct = info.direct
+            channels = [(direct[name]['shift'], direct[name]['mask']) for name in ('red', 'green', 'blue', 'alpha')]
+            self.by_id[info.id] = info
+            # Keep the first one, like a scan of the list would
+            self.by_key.setdefault(format_key(info.type, info.depth, *channels), info)
+
+        for screen in reply.screens:
+            for depth in screen.depths:
+                for visual in depth.visuals:
+                    self.by_visual[visual.visual] = self.by_id.get(visual.format)
+
+    def __getitem__(self, id):
+        return self.by_id[id]
+
+    def find(self, type, depth, red = (0, 0), green = (0, 0), blue = (0, 0), alpha = (0, 0)):
+        """Return the format with the given channels as (shift, mask), or None."""
+        return self.by_key.get(format_key(type, depth, red, green, blue, alpha))
+
+    def find_standard(self, format):
+        return self.find(*StandardFormats[format])
+
+    def find_visual(self, visual):
+        """Return the format of the visual, or None."""
+        return self.by_visual.get(visual)
+
+
+class RenderContext(object):
+    """Per-display RENDER state.
+
+    Holds the major opcode, and caches the negotiated version, the
+    PictFormats, subpixel orders and per-screen filter lists, so that
+    they are only queried from the server once. refresh() drops the
+    cached replies, and they are queried again on next use.
+
+    The context is created by init() and is available as
+    display.render_context on the protocol display, and through
+    Display.xrender_context(). elided counts the requests skipped by
+    pictures that track their state, see Picture.track_state().
+    """
+
+    def __init__(self, display, opcode):
+        self.display = display
+        self.opcode = opcode
+        # Requests skipped by pictures that track their state
+        self.elided = dict.fromkeys(('change', 'set_clip_rectangles', 'set_transform', 'set_filter'), 0)
+        self.refresh()
+
+    def bootstrap(self):
+        """Query the version, formats and the filters of every screen in one round trip.
+
+        The QueryPictIndexValues requests need the format ids, so those
+        are left to a separate query_pict_index_values call.
+        """
+        version = QueryVersion(display = self.display, defer = 1, opcode = self.opcode,
+            major_version = 0, minor_version = 11)
+        pict_formats = QueryPictFormats(display = self.display, defer = 1, opcode = self.opcode)
+        filters = [QueryFilters(display = self.display, defer = 1, opcode = self.opcode, drawable = root.root)
+            for root in self.display.info.roots]
+
+        version.reply()
+        self._version = (version.major_version, version.minor_version)
+        pict_formats.reply()
+        self._pict_formats = pict_formats
+        self._format_table = None
+        for screen, reply in enumerate(filters):
+            reply.reply()
+            self._filters[screen] = reply
+
+    def refresh(self):
+        self._version = None
+        self._pict_formats = None
+        self._format_table = None
+        self._filters = {}
+
+    def version(self):
+        """Return the negotiated (major, minor) version."""
+        if self._version is None:
+            r = QueryVersion(
+                display = self.display,
+                opcode = self.opcode,
+                major_version = 0,
+                minor_version = 11,
+                )
+            self._version = (r.major_version, r.minor_version)
+        return self._version
+
+    def pict_formats(self):
+        """Return the QueryPictFormats reply."""
+        if self._pict_formats is None:
+            self._pict_formats = QueryPictFormats(
+                display = self.display,
+                opcode = self.opcode,
+                )
+        return self._pict_formats
+
+    def formats(self):
+        """Return the PictFormatTable for the formats."""
+        if self._format_table is None:
+            self._format_table = PictFormatTable(self.pict_formats())
+        return self._format_table
+
+    def subpixel_order(self, screen = None):
+        if screen is None:
+            screen = self.display.default_screen
+        return self.pict_formats().subpixels[screen]
+
+    def filters(self, screen = None):
+        """Return the QueryFilters reply for the screen."""
+        if screen is None:
+            screen = self.display.default_screen
+        if screen not in self._filters:
+            self._filters[screen] = QueryFilters(
+                display = self.display,
+                opcode = self.opcode,
+                drawable = self.display.info.roots[screen].root,
+                )
+        return self._filters[screen]
+
+
+def get_context(self):
+    return self.display.render_context
+
+
+class RenderBatch(object):
+    """Record render requests into one buffer and send them together.
+
+    Used as a context manager, the recorded requests are queued on the
+    display connection as a single write when the block exits. The
+    methods mirror those of Picture, but take the destination picture
+    as their first argument:
+
+        with RenderBatch(display) as batch:
+            batch.fill_rectangles(pict, PictOpSrc, color, rect)
+            batch.composite(pict, PictOpOver, src, X.NONE, 0, 0, 0, 0, x, y, w, h)
+    """
+
+    def __init__(self, display):
+        # Accept Xlib.display.Display, resources or the protocol display
+        self.display = getattr(display, 'display', display)
+        self.opcode = self.display.render_context.opcode
+        self.data = bytearray()
+        self.count = 0
+        self.requests = 0
+        self.bytes = 0
+        self.encode_time = 0.0
+        # Picture states changed by the recorded requests, and what they were before
+        self.saved = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.discard()
+
+    def stats(self):
+        return dict(requests = self.requests, bytes = self.bytes, encode_time = self.encode_time)
+
+    def add(self, request, **keys):
+        """Append a request of class request, with the given field values."""
+        start = time.time()
+        self.data.extend(request._request.to_binary(opcode = self.opcode, **keys))
+        self.encode_time = self.encode_time + time.time() - start
+        self.count = self.count + 1
+
+    def add_packed(self, packer, *args):
+        """Append a request encoded by one of the pack_* functions."""
+        start = time.time()
+        self.data.extend(packer(self.opcode, *args))
+        self.encode_time = self.encode_time + time.time() - start
+        self.count = self.count + 1
+
+    def add_binary(self, binary):
+        """Append an already encoded request."""
+        self.data.extend(binary)
+        self.count = self.count + 1
+
+    def discard(self):
+        """Drop everything recorded so far, and the picture state changes made by it."""
+        for state, saved in self.saved.values():
+            state.restore(saved)
+        self.reset()
+
+    def reset(self):
+        del self.data[:]
+        self.count = 0
+        self.saved = {}
+
+    def flush(self):
+        """Queue everything recorded so far as a single write."""
+        if not self.count:
+            self.reset()
+            return
+
+        display = self.display
+        if display.socket_error:
+            raise display.socket_error
+
+        req = RawRequest.__new__(RawRequest)
+        req._errorhandler = None
+        req._binary = str(self.data)
+
+        # The server numbers each request in the buffer, so reserve
+        # a serial number for all of them
+        display.request_queue_lock.acquire()
+        req._serial = display.request_serial
+        display.request_serial = (display.request_serial + self.count) % 65536
+        display.request_queue.append((req, 0))
+        display.request_queue_lock.release()
+
+        self.requests = self.requests + self.count
+        self.bytes = self.bytes + len(self.data)
+        self.reset()
+
+    # Pictures that track their state are shadowed here as well
+
+    def shadow(self, dst):
+        """Return the state of dst, if it tracks it, saved for discard()."""
+        state = getattr(dst, 'state', None)
+        if state is not None and id(state) not in self.saved:
+            self.saved[id(state)] = (state, state.save())
+        return state
+
+    def change(self, dst, **keys):
+        state = self.shadow(dst)
+        if state is not None:
+            keys = state.change(keys)
+            if not keys:
+                return
+        self.add(ChangePicture, picture = dst, values = keys)
+
+    def set_clip_rectangles(self, dst, clip_x_origin, clip_y_origin, *rectangles):
+        state = self.shadow(dst)
+        if state is not None and not state.set_clip_rectangles(clip_x_origin, clip_y_origin, rectangles):
+            return
+        self.add(SetPictureClipRectangles, picture = dst,
+            clip_x_origin = clip_x_origin, clip_y_origin = clip_y_origin,
+            rectangles = rectangles)
+
+    def set_transform(self, dst, transform):
+        state = self.shadow(dst)
+        if state is not None and not state.set_transform(transform):
+            return
+        self.add_packed(pack_set_picture_transform, dst, transform)
+
+    def set_filter(self, dst, filter, *values):
+        state = self.shadow(dst)
+        if state is not None and not state.set_filter(filter, values):
+            return
+        self.add(SetPictureFilter, picture = dst, filter = filter, values = values)
+
+    def fill_rectangles(self, dst, op, color, *rects):
+        for rects in split_list(self.display, 20, 8, rects):
+            self.add_packed(pack_fill_rectangles, op, dst, color, rects)
+
+    def add_traps(self, dst, off_x, off_y, *trapezoids):
+        values = fixed_array(trapezoids, 6)
+        if values is not None:
+            for values in split_list(self.display, 12, 24, values):
+                self.add_packed(pack_add_traps, dst, off_x, off_y, values)
+            return
+        for trapezoids in split_list(self.display, 12, 24, trapezoids):
+            self.add(AddTraps, picture = dst, off_x = off_x, off_y = off_y, trapezoids = trapezoids)
+
+    def free(self, dst):
+        self.add_packed(pack_free_picture, dst)
+
+    def composite(self, dst, op, src, mask, src_x, src_y, mask_x, mask_y, dst_x, dst_y, width, height):
+        self.add_packed(pack_composite, op, src, mask, dst,
+            src_x, src_y, mask_x, mask_y, dst_x, dst_y, width, height)
+
+    def scale(self, dst, src, color_scale, alpha_scale, src_x, src_y, dst_x, dst_y, width, height):
+        self.add(Scale, src = src, dst = dst, color_scale = color_scale, alpha_scale = alpha_scale,
+            src_x = src_x, src_y = src_y, dst_x = dst_x, dst_y = dst_y, width = width, height = height)
+
+    def trapezoids(self, dst, op, src, mask_format, src_x, src_y, *traps):
+        values = fixed_array(traps, 10)
+        if values is not None:
+            for values, dx, dy in source_offsets(split_list(self.display, 24, 40, values), 2, trapezoid_point):
+                self.add_packed(pack_geometry, 10, op, src, dst, mask_format, src_x + dx, src_y + dy, values)
+            return
+        for traps, dx, dy in source_offsets(split_list(self.display, 24, 40, traps), 2, trapezoid_point):
+            self.add(Trapezoids, op = op, src = src, dst = dst, mask_format = mask_format,
+                src_x = src_x + dx, src_y = src_y + dy, traps = traps)
+
+    def triangles(self, dst, op, src, mask_format, src_x, src_y, *triangles):
+        values = fixed_array(triangles, 6)
+        if values is not None:
+            for values, dx, dy in source_offsets(split_list(self.display, 24, 24, values), 0, triangle_point):
+                self.add_packed(pack_geometry, 11, op, src, dst, mask_format, src_x + dx, src_y + dy, values)
+            return
+        for triangles, dx, dy in source_offsets(split_list(self.display, 24, 24, triangles), 0, triangle_point):
+            self.add(Triangles, op = op, src = src, dst = dst, mask_format = mask_format,
+                src_x = src_x + dx, src_y = src_y + dy, triangles = triangles)
+
+    def tri_strip(self, dst, op, src, mask_format, src_x, src_y, *points):
+        values = fixed_array(points, 2)
+        if values is not None:
+            for values, dx, dy in source_offsets(split_strip(self.display, 24, values), 0, strip_point):
+                self.add_packed(pack_geometry, 12, op, src, dst, mask_format, src_x + dx, src_y + dy, values)
+            return
+        for points, dx, dy in source_offsets(split_strip(self.display, 24, points), 0, strip_point):
+            self.add(TriStrip, op = op, src = src, dst = dst, mask_format = mask_format,
+                src_x = src_x + dx, src_y = src_y + dy, points = points)
+
+    def tri_fan(self, dst, op, src, mask_format, src_x, src_y, *points):
+        values = fixed_array(points, 2)
+        if values is not None:
+            for values, dx, dy in source_offsets(split_fan(self.display, 24, values), 0, strip_point):
+                self.add_packed(pack_geometry, 13, op, src, dst, mask_format, src_x + dx, src_y + dy, values)
+            return
+        for points, dx, dy in source_offsets(split_fan(self.display, 24, points), 0, strip_point):
+            self.add(TriFan, op = op, src = src, dst = dst, mask_format = mask_format,
+                src_x = src_x + dx, src_y = src_y + dy, points = points)
+
+    def composite_glyphs_8(self, dst, op, src, mask_format, glyphset, src_x, src_y, *glyphcmds):
+        self.add(CompositeGlyphs8, op = op, src = src, dst = dst, mask_format = mask_format,
+            glyphset = glyphset, src_x = src_x, src_y = src_y, glyphcmds = glyphcmds)
+
+    def composite_glyphs_16(self, dst, op, src, mask_format, glyphset, src_x, src_y, *glyphcmds):
+        self.add(CompositeGlyphs16, op = op, src = src, dst = dst, mask_format = mask_format,
+            glyphset = glyphset, src_x = src_x, src_y = src_y, glyphcmds = glyphcmds)
+
+    def composite_glyphs_32(self, dst, op, src, mask_format, glyphset, src_x, src_y, *glyphcmds):
+        self.add(CompositeGlyphs32, op = op, src = src, dst = dst, mask_format = mask_format,
+            glyphset = glyphset, src_x = src_x, src_y = src_y, glyphcmds = glyphcmds)
+
+    def composite_glyphs(self, dst, op, src, mask_format, glyphset, src_x, src_y, *glyphcmds):
+        max_id = max_glyph(glyphcmds)
+
+        if max_id < 256:
+            func = self.composite_glyphs_8
+        elif max_id < 65536:
+            func = self.composite_glyphs_16
+        else:
+            func = self.composite_glyphs_32
+
+        func(dst, op, src, mask_format, glyphset, src_x, src_y, *glyphcmds)
+
+    def composite_glyph_run(self, dst, op, src, run, src_x, src_y):
+        run.check_size(self.display)
+        self.add_packed(run.to_binary, op, src, dst, src_x, src_y)
+
+
+def rect_contains(outer, inner):
+    ox, oy, ow, oh = outer
+    ix, iy, iw, ih = inner
+    return ox <= ix and oy <= iy and ix + iw <= ox + ow and iy + ih <= oy + oh
+
+
+class RenderCoalescer(object):
+    """Merge and drop redundant FillRectangles and Composite requests.
+
+    Consecutive fill_rectangles calls with the same destination, op and
+    color are sent as one request, and pending composite calls that are
+    completely overwritten by a later PictOpSrc fill or unmasked PictOpSrc
+    composite on the same destination are dropped.
+
+    The methods mirror those of Picture, but take the destination picture
+    as their first argument. Any other method flushes the pending
+    requests before it is forwarded, as does a composite reading from
+    a picture that has pending drawing. Requests are sent through batch
+    (a RenderBatch) if given, and directly on the destination picture
+    otherwise. Requests made on the pictures without going through the
+    coalescer must be preceded by a flush().
+    """
+
+    def __init__(self, batch = None):
+        self.batch = batch
+        # Entries are [name, dst, args], in request order
+        self.pending = []
+        self.merged = 0
+        self.dropped = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            del self.pending[:]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        def forward(dst, *args, **keys):
+            self.flush()
+            self.send(name, dst, args, keys)
+        return forward
+
+    def stats(self):
+        return dict(merged = self.merged, dropped = self.dropped)
+
+    def send(self, name, dst, args, keys = {}):
+        if self.batch is not None:
+            getattr(self.batch, name)(dst, *args, **keys)
+        else:
+            getattr(dst, name)(*args, **keys)
+
+    def flush(self):
+        pending = self.pending
+        self.pending = []
+        for name, dst, args in pending:
+            self.send(name, dst, args)
+
+    def overwrite(self, dst, rects):
+        """Drop pending composites on dst that are inside one of rects."""
+        dst = resource_id(dst)
+        keep = []
+        for entry in self.pending:
+            name, entry_dst, args = entry
+            if name == 'composite' and resource_id(entry_dst) == dst:
+                area = args[7:11]
+                for rect in rects:
+                    if rect_contains(rect, area):
+                        self.dropped = self.dropped + 1
+                        break
+                else:
+                    keep.append(entry)
+            else:
+                keep.append(entry)
+        self.pending = keep
+
+    def fill_rectangles(self, dst, op, color, *rects):
+        if op == PictOpSrc:
+            self.overwrite(dst, rects)
+
+        if self.pending:
+            name, last_dst, args = self.pending[-1]
+            if name == 'fill_rectangles' and resource_id(last_dst) == resource_id(dst) \
+               and args[0] == op and args[1] == color:
+                self.pending[-1][2] = args + rects
+                self.merged = self.merged + 1
+                return
+
+        self.pending.append(['fill_rectangles', dst, (op, color) + rects])
+
+    def composite(self, dst, op, src, mask, src_x, src_y, mask_x, mask_y, dst_x, dst_y, width, height):
+        # Reading from a picture with pending drawing needs that drawing done first
+        targets = [resource_id(entry[1]) for entry in self.pending]
+        if resource_id(src) in targets or (mask and resource_id(mask) in targets):
+            self.flush()
+
+        if op == PictOpSrc and not mask:
+            self.overwrite(dst, [(dst_x, dst_y, width, height)])
+
+        self.pending.append(['composite', dst, (op, src, mask, src_x, src_y, mask_x, mask_y, dst_x, dst_y, width, height)])
 
 
 def init(disp, info):
+    disp.display.render_context = RenderContext(disp.display, info.major_opcode)
+    disp.extension_add_method('display', 'xrender_context', get_context)
     disp.extension_add_method('display', 'xrender_query_version', query_version)
     disp.extension_add_method('display', 'xrender_query_pict_formats', query_pict_formats)
     disp.extension_add_method('display', 'xrender_query_pict_index_values', query_pict_index_values)
@@ -0,0 +1,283 @@
+
+# Microbenchmarks for the render extension
+#
+# Usage: python renderbench.py [benchmark...]
+# Without arguments, all benchmarks are run.
+
+import os
+import sys
+import glob
+import math
+import time
+import array
+
+from Xlib.ext import render
+import xcursor
+import pixels
+import mesh
+
+try:
+	import numpy
+	import tessellate
+	import stroke
+	import softrender
+except ImportError:
+	numpy = tessellate = stroke = softrender = None
+
+# Cursor files to use, override with RENDERBENCH_CURSORS
+cursor_glob = os.environ.get('RENDERBENCH_CURSORS', '/usr/share/icons/*/cursors/*')
+
+def best_time(func, repeat = 5, number = 10):
+	best = None
+	for i in range(repeat):
+		start = time.time()
+		for j in range(number):
+			func()
+		elapsed = (time.time() - start) / number
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+def bench_glyph_items():
+	count = 10000
+	for field, code, limit in ((render.GlyphItems8('glyphcmds'), 'B', 256), (render.GlyphItems16('glyphcmds'), 'H', 65536), (render.GlyphItems32('glyphcmds'), 'I', 1 << 24)):
+		glyphs = [(i * 7919) % limit for i in range(count)]
+		for kind, value in (('list', glyphs), ('array', array.array(code, glyphs))):
+			elapsed = best_time(lambda: field.pack_value([(0, 0, value)]))
+			print '%-12s %-6s %10.0f glyphs/s' % (field.__class__.__name__, kind, count / elapsed)
+
+class StubDisplay:
+	"""Just enough of a display connection for sending requests."""
+
+	class info:
+		max_request_length = 65535
+
+	def __init__(self):
+		self.request_serial = 1
+		self.resource_id = 0x200000
+		self.render_context = render.RenderContext(self, 128)
+
+	def send_request(self, request, wait_for_response):
+		self.request_serial = self.request_serial + 1
+
+	def get_extension_major(self, extname):
+		return 128
+
+	def allocate_resource_id(self):
+		self.resource_id = self.resource_id + 1
+		return self.resource_id
+
+	def get_resource_class(self, class_name, default = None):
+		return default
+
+def bench_fast_requests():
+	dpy = StubDisplay()
+	pict = render.Picture(dpy, 0x100001)
+	src = render.Picture(dpy, 0x100002)
+	color = (65535, 0, 0, 65535)
+	rects = [(i, i, 10, 10) for i in range(8)]
+	transform = (1, 0.2, 0, -0.2, 1, 0, 0, 0, 1)
+
+	def generic():
+		render.Composite(display = dpy, opcode = 128, op = render.PictOpOver, src = src, mask = 0, dst = pict,
+			src_x = 0, src_y = 0, mask_x = 0, mask_y = 0, dst_x = 10, dst_y = 10, width = 100, height = 100)
+		render.FillRectangles(display = dpy, opcode = 128, op = render.PictOpSrc, dst = pict, color = color, rects = rects)
+		render.CreateSolidFill(display = dpy, opcode = 128, pid = dpy.allocate_resource_id(), color = color)
+		render.SetPictureTransform(display = dpy, opcode = 128, picture = pict, transform = transform)
+		render.CreateCursor(display = dpy, opcode = 128, cid = dpy.allocate_resource_id(), source = pict, x = 0, y = 0)
+		render.FreePicture(display = dpy, opcode = 128, picture = pict)
+
+	def fast():
+		pict.composite(render.PictOpOver, src, 0, 0, 0, 0, 0, 10, 10, 100, 100)
+		pict.fill_rectangles(render.PictOpSrc, color, *rects)
+		render.create_solid_fill(pict, color)
+		pict.set_transform(transform)
+		pict.create_cursor(0, 0)
+		pict.free()
+
+	number = 1000
+	for name, func, strict in (('generic', generic, 1), ('strict', fast, 1), ('fast', fast, 0)):
+		render.set_strict(strict)
+		elapsed = best_time(func, number = number)
+		print '%-8s %10.0f calls/s' % (name, 6 / elapsed)
+	render.set_strict(1)
+
+def cursor_files():
+	# Themes symlink many names to the same file, so skip the links
+	return [fname for fname in glob.glob(cursor_glob) if os.path.isfile(fname) and not os.path.islink(fname)]
+
+def bench_xcursor_parse():
+	fnames = cursor_files()
+	if not fnames:
+		print 'No cursor files in', cursor_glob
+		return
+	datas = [file(fname, 'rb').read() for fname in fnames]
+	total = sum(len(data) for data in datas)
+	print '%d files, %.1f MB' % (len(datas), total / 1e6)
+
+	def parse_all():
+		for data in datas:
+			xcursor.parse_cursor(data)
+	def parse_size():
+		for data in datas:
+			xcursor.parse_cursor(data, 24)
+	def parse_mmap():
+		for fname in fnames:
+			data = xcursor.open_cursor(fname)
+			xcursor.parse_cursor(data, 24)
+			data.close()
+
+	for name, func in (('all sizes', parse_all), ('size 24', parse_size), ('mmap, size 24', parse_mmap)):
+		elapsed = best_time(func, number = 1)
+		print '%-14s %8.2f ms %8.1f MB/s' % (name, elapsed * 1e3, total / 1e6 / elapsed)
+
+def bench_xcursor_prewarm():
+	fnames = cursor_files()
+	if not fnames:
+		print 'No cursor files in', cursor_glob
+		return
+	jobs = dict(enumerate(fnames))
+	print '%d files' % len(fnames)
+
+	for name, workers in (('serial', 1), ('parallel', None)):
+		start = time.time()
+		for result in xcursor.decode_cursors(jobs, 24, workers):
+			pass
+		print '%-8s %8.2f ms' % (name, (time.time() - start) * 1e3)
+
+def bench_pixels():
+	size = 256 * 256 * 4
+	buf = bytearray(os.urandom(size))
+	rgb = bytearray(os.urandom(size // 4 * 3))
+	print 'numpy' if pixels.numpy is not None else 'no numpy'
+	for name, func in (('premultiply', lambda: pixels.premultiply(buf)), ('unpremultiply', lambda: pixels.unpremultiply(buf)),
+			('swap_bytes', lambda: pixels.swap_bytes(buf)), ('rgb24_to_argb32', lambda: pixels.rgb24_to_argb32(rgb))):
+		elapsed = best_time(func, number = 1)
+		print '%-16s %8.1f Mpixels/s' % (name, size / 4 / 1e6 / elapsed)
+
+def bench_tessellate():
+	if tessellate is None:
+		print 'Needs NumPy'
+		return
+	count = 10000
+	angles = numpy.linspace(0, 2 * numpy.pi, count, endpoint = False)
+	circle = [numpy.column_stack((500 + 400 * numpy.cos(angles), 500 + 400 * numpy.sin(angles)))]
+	radius = numpy.where(numpy.arange(count) % 2, 400, 380)
+	gear = [numpy.column_stack((500 + radius * numpy.cos(angles), 500 + radius * numpy.sin(angles)))]
+	offsets = numpy.random.RandomState(0).uniform(0, 1000, (count // 10, 1, 2))
+	blobs = list(10 * numpy.column_stack((numpy.cos(angles[::1000]), numpy.sin(angles[::1000])))[None] + offsets)
+	curves = tessellate.Path()
+	curves.move_to(0, 500)
+	for i in range(count // 4):
+		x = i * 1000.0 / (count // 4)
+		curves.curve_to(x + 0.1, 0, x + 0.2, 1000, x + 0.4, 500)
+	curves.line_to(1000, 1000)
+	curves.line_to(0, 1000)
+
+	for name, shape in (('circle', circle), ('gear', gear), ('blobs', blobs), ('curves', curves)):
+		edges = len(tessellate.edges(shape)[0])
+		for kind, func in (('traps', tessellate.traps), ('triangles', tessellate.triangles)):
+			result = func(shape)
+			elapsed = best_time(lambda: func(shape), repeat = 3, number = 1)
+			print '%-7s %-9s %6d edges %7d out %8.1f ms' % (name, kind, edges, len(result), elapsed * 1e3)
+
+def bench_stroke():
+	if stroke is None:
+		print 'Needs NumPy'
+		return
+	count = 10000
+	angles = numpy.linspace(0, 2 * numpy.pi, count, endpoint = False)
+	circle = [(numpy.column_stack((500 + 400 * numpy.cos(angles), 500 + 400 * numpy.sin(angles))), 1)]
+	zigzag = [(numpy.column_stack((numpy.linspace(0, 1000, count), numpy.arange(count) % 2 * 50)), 0)]
+
+	for name, shape, keys in (('circle', circle, {}), ('zigzag miter', zigzag, {}),
+			('zigzag round', zigzag, dict(join = stroke.JoinRound, cap = stroke.CapRound)),
+			('circle dashed', circle, dict(dashes = (10, 5)))):
+		result = stroke.Stroke(shape, 4, **keys)
+		elapsed = best_time(lambda: stroke.Stroke(shape, 4, **keys), repeat = 3, number = 1)
+		print '%-14s %7d strip points %5d fans %8.1f ms' % (name, len(result.strip), len(result.fans), elapsed * 1e3)
+
+def bench_mesh():
+	grid = []
+	for y in range(100):
+		for x in range(100):
+			a, b, c, d = (x, y), (x + 1, y), (x, y + 1), (x + 1, y + 1)
+			grid.extend([(a, b, c), (b, d, c)])
+	count = 1000
+	circle = [(500 + 400 * math.cos(2 * math.pi * i / count), 500 + 400 * math.sin(2 * math.pi * i / count))
+		for i in range(count + 1)]
+	pie = [((500, 500), circle[i], circle[i + 1]) for i in range(count)]
+	display = StubDisplay()
+
+	for name, triangles in (('grid', grid), ('pie', pie)):
+		stats = mesh.Mesh(triangles).stats(display)
+		elapsed = best_time(lambda: mesh.Mesh(triangles), repeat = 3, number = 1)
+		print '%-5s %6d triangles %8d -> %7d bytes %8.1f ms' % (name, len(triangles),
+			stats['triangle_bytes'], stats['mesh_bytes'], elapsed * 1e3)
+
+def bench_fixed_arrays():
+	if numpy is None:
+		print 'Needs NumPy'
+		return
+	dpy = StubDisplay()
+	pict = render.Picture(dpy, 0x100001)
+	count = 10000
+	array = numpy.random.RandomState(0).uniform(0, 1000, (count, 6))
+	fixed = (array * 65536).astype(numpy.int32)
+	tuples = [((a[0], a[1]), (a[2], a[3]), (a[4], a[5])) for a in array.tolist()]
+	points = [(a[0], a[1]) for a in array.tolist()]
+
+	for name, func in (
+			('triangles tuples', lambda: pict.triangles(render.PictOpOver, 0, 0, 0, 0, *tuples)),
+			('triangles float', lambda: pict.triangles(render.PictOpOver, 0, 0, 0, 0, array)),
+			('triangles int32', lambda: pict.triangles(render.PictOpOver, 0, 0, 0, 0, fixed)),
+			('tri_strip tuples', lambda: pict.tri_strip(render.PictOpOver, 0, 0, 0, 0, *points)),
+			('tri_strip float', lambda: pict.tri_strip(render.PictOpOver, 0, 0, 0, 0, array[:, :2]))):
+		elapsed = best_time(func, repeat = 3, number = 3)
+		print '%-17s %10.0f items/s' % (name, count / elapsed)
+
+def bench_softrender():
+	if softrender is None:
+		print 'Needs NumPy'
+		return
+	size = 512
+	dpy = softrender.SoftDisplay()
+	dst = dpy.create_picture(size, size)
+	image = dpy.create_picture(size, size)
+	image.write(0, 0, numpy.random.RandomState(0).randint(0, 1 << 32, (size, size)).astype(numpy.uint32) | 0xff000000)
+	image.set_transform((1.5, 0.2, 0, -0.2, 1.5, 0, 0, 0, 1))
+	image.change(repeat = render.RepeatReflect)
+	gradient = dpy.xrender_create_radial_gradient((256, 256), (300, 200), 10, 300,
+		(0, (65535, 0, 0, 65535)), (1, (0, 0, 65535, 32768)))
+	fill = dpy.xrender_create_solid_fill((0, 32768, 0, 32768))
+	angles = numpy.linspace(0, 2 * numpy.pi, 1000, endpoint = False)
+	circle = [numpy.column_stack((256 + 200 * numpy.cos(angles), 256 + 200 * numpy.sin(angles)))]
+	mask_format = softrender.standard_format(render.PictStandardA8)
+
+	for name, func in (
+			('over solid', lambda: dst.composite(render.PictOpOver, fill, 0, 0, 0, 0, 0, 0, 0, size, size)),
+			('src gradient', lambda: dst.composite(render.PictOpSrc, gradient, 0, 0, 0, 0, 0, 0, 0, size, size)),
+			('over bilinear', lambda: (image.set_filter(render.FilterBilinear),
+				dst.composite(render.PictOpOver, image, 0, 0, 0, 0, 0, 0, 0, size, size))),
+			('soft light', lambda: dst.composite(render.PictOpSoftLight, gradient, 0, 0, 0, 0, 0, 0, 0, size, size)),
+			('fill circle', lambda: tessellate.fill(dst, render.PictOpOver, fill, mask_format, 0, 0, circle))):
+		elapsed = best_time(func, repeat = 3, number = 1)
+		print '%-14s %8.1f Mpixels/s' % (name, size * size / 1e6 / elapsed)
+
+benchmarks = dict(
+	glyph_items = bench_glyph_items,
+	fast_requests = bench_fast_requests,
+	xcursor_parse = bench_xcursor_parse,
+	xcursor_prewarm = bench_xcursor_prewarm,
+	pixels = bench_pixels,
+	tessellate = bench_tessellate,
+	stroke = bench_stroke,
+	mesh = bench_mesh,
+	fixed_arrays = bench_fixed_arrays,
+	softrender = bench_softrender,
+)
+
+if __name__ == '__main__':
+	for name in sys.argv[1:] or sorted(benchmarks):
+		print '==', name
+		benchmarks[name]()
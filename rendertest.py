@@ -1,6 +1,9 @@
 import Xlib.display
 from Xlib import X
 import xutil
+from pixels import premultiply
+from upload import create_picture_from_image
+from shmupload import ShmPool
 import struct
 
 def generate_glyphs(glyphids):
@@ -24,22 +27,20 @@ def generate_glyphs(glyphids):
 
 def generate_cursor(win):
 	width = height = 16
-	depth = 32
 	cursors = []
-	gc = win.create_gc()
 	for i in range(0, 1530, 15):
 		color = [min(max((abs(765 - ((i + c * 510) % 1530)) - 255), 0), 255) for c in range(3)]
 		color = struct.pack('<3B', *color)
-		pixels = ''.join(color + ('\x7f' if x == y else '\xff') if x >= y else '\x00\x00\x00\x00' for y in range(height) for x in range(width))
-		pixmap = win.create_pixmap(width, height, depth)
-		pixmap.put_image(gc, 0, 0, width, height, X.ZPixmap, depth, 0, pixels)
-		pict = pixmap.xrender_create_picture(fmt_argb32)
-		pixmap.free()
+		# Each row is transparent left of the diagonal, half transparent on it and opaque right of it
+		pixels = bytearray(''.join(['\0' * 4 * y + color + '\x7f' + (color + '\xff') * (width - y - 1)
+			for y in range(height)]))
+		# ARGB32 pictures are premultiplied
+		premultiply(pixels)
+		pict = create_picture_from_image(win, pixels, xutil.PictStandardARGB32, width, height, pool = pool)
 		# OP 27, CreateCursor
 		cursor = pict.create_cursor(0, 0)
 		cursors.append((cursor, 100))
 		pict.free()
-	gc.free()
 	# OP 31, CreateAnimCursor
 	cursor = dpy.xrender_create_anim_cursor(cursors)
 
@@ -109,6 +110,8 @@ font_.add_glyphs(*glyphs)
 font = font_.reference()
 font_.free()
 
+# Uploads go through shared memory when the server is local
+pool = ShmPool(dpy.display)
 cursor = generate_cursor(win)
 win.change_attributes(cursor = cursor)
 
@@ -0,0 +1,324 @@
+
+# MIT-SHM uploads for images and pictures
+#
+# Pixels are written into System V shared memory segments that the
+# server attaches to, so that only a small ShmPutImage request goes
+# through the socket instead of the image data. Segments are pooled and
+# reused across frames. When the server doesn't support MIT-SHM, is
+# connected to over TCP, or can't attach our segments since it's on
+# another machine after all (as with forwarded connections), images
+# fall back to upload.put_image over the socket.
+
+import socket
+
+from Xlib import X, error
+from Xlib.protocol import rq, request
+from Xlib.support import connect
+import pixels
+import upload
+
+try:
+	import ctypes
+	import ctypes.util
+	libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+	libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+	libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+	libc.shmat.restype = ctypes.c_void_p
+	libc.shmdt.argtypes = [ctypes.c_void_p]
+	libc.shmctl.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+except (ImportError, OSError, AttributeError):
+	libc = None
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+IPC_PRIVATE = 0
+IPC_CREAT = 01000
+IPC_RMID = 0
+
+# Segments are allocated in multiples of this
+PageSize = 4096
+
+class ShmQueryVersion(rq.ReplyRequest):
+	_request = rq.Struct(
+		rq.Card8('opcode'),
+		rq.Opcode(0),
+		rq.RequestLength(),
+		)
+
+	_reply = rq.Struct(
+		rq.ReplyCode(),
+		rq.Bool('shared_pixmaps'),
+		rq.Card16('sequence_number'),
+		rq.ReplyLength(),
+		rq.Card16('major_version'),
+		rq.Card16('minor_version'),
+		rq.Card16('uid'),
+		rq.Card16('gid'),
+		rq.Card8('pixmap_format'),
+		rq.Pad(15),
+		)
+
+class ShmAttach(rq.Request):
+	_request = rq.Struct(
+		rq.Card8('opcode'),
+		rq.Opcode(1),
+		rq.RequestLength(),
+		rq.Card32('shmseg'),
+		rq.Card32('shmid'),
+		rq.Bool('read_only'),
+		rq.Pad(3),
+		)
+
+class ShmDetach(rq.Request):
+	_request = rq.Struct(
+		rq.Card8('opcode'),
+		rq.Opcode(2),
+		rq.RequestLength(),
+		rq.Card32('shmseg'),
+		)
+
+class ShmPutImage(rq.Request):
+	_request = rq.Struct(
+		rq.Card8('opcode'),
+		rq.Opcode(3),
+		rq.RequestLength(),
+		rq.Drawable('drawable'),
+		rq.GC('gc'),
+		rq.Card16('total_width'),
+		rq.Card16('total_height'),
+		rq.Card16('src_x'),
+		rq.Card16('src_y'),
+		rq.Card16('src_width'),
+		rq.Card16('src_height'),
+		rq.Int16('dst_x'),
+		rq.Int16('dst_y'),
+		rq.Card8('depth'),
+		rq.Card8('format'),
+		rq.Bool('send_event'),
+		rq.Pad(1),
+		rq.Card32('shmseg'),
+		rq.Card32('offset'),
+		)
+
+def is_local(display):
+	"""Return true if display is connected through a local socket, as shared memory needs."""
+	sock = getattr(display, 'socket', None)
+	if sock is not None and sock.family == socket.AF_UNIX:
+		return 1
+	host = connect.get_display(display.get_display_name())[1]
+	return host in ('', 'unix')
+
+def sync(display):
+	"""Wait until the server has processed every request sent so far."""
+	request.GetInputFocus(display = display)
+
+class Segment:
+	"""A shared memory segment, attached to both us and the server."""
+
+	def __init__(self, display, opcode, size):
+		self.display = display
+		self.opcode = opcode
+		self.size = size
+		self.shmseg = None
+		self.shmid = libc.shmget(IPC_PRIVATE, size, IPC_CREAT | 0600)
+		if self.shmid < 0:
+			raise OSError(ctypes.get_errno(), 'shmget failed')
+		self.address = libc.shmat(self.shmid, None, 0)
+		if self.address == ctypes.c_void_p(-1).value:
+			errno = ctypes.get_errno()
+			libc.shmctl(self.shmid, IPC_RMID, None)
+			raise OSError(errno, 'shmat failed')
+		self.memory = (ctypes.c_char * size).from_address(self.address)
+
+	def attach(self):
+		"""Attach the segment to the server, returning false if it can't."""
+		catch = error.CatchError()
+		shmseg = self.display.allocate_resource_id()
+		ShmAttach(display = self.display, onerror = catch, opcode = self.opcode,
+			shmseg = shmseg, shmid = self.shmid, read_only = 1)
+		sync(self.display)
+		# Once both sides are attached, the segment can be marked for
+		# removal; it then goes away when both have detached, even if
+		# we exit without freeing it.
+		libc.shmctl(self.shmid, IPC_RMID, None)
+		if catch.get_error():
+			self.display.free_resource_id(shmseg)
+			return 0
+		self.shmseg = shmseg
+		return 1
+
+	def free(self):
+		if self.shmseg is not None:
+			ShmDetach(display = self.display, opcode = self.opcode, shmseg = self.shmseg)
+			self.display.free_resource_id(self.shmseg)
+			self.shmseg = None
+		libc.shmdt(self.address)
+		self.memory = None
+
+class ShmImage:
+	"""A ZPixmap image to draw into before sending it with ShmPool.put_image.
+
+	data is a writable buffer of height rows of stride bytes each, in
+	shared memory when the server supports it, otherwise a bytearray.
+	32-bit pixels are in little-endian byte order, like everywhere in
+	pixels and upload, whatever the server's image byte order; they are
+	swapped for big-endian servers when the image is sent.
+	"""
+
+	def __init__(self, segment, width, height, depth, bpp, stride):
+		self.segment = segment
+		self.width = width
+		self.height = height
+		self.depth = depth
+		self.bpp = bpp
+		self.stride = stride
+		if segment is None:
+			self.data = bytearray(height * stride)
+		else:
+			self.data = (ctypes.c_char * (height * stride)).from_address(segment.address)
+
+	def array(self):
+		"""Return the pixels as a (height, width) NumPy array, without copying."""
+		rows = numpy.frombuffer(self.data, numpy.uint8).reshape(self.height, self.stride)
+		pixels = rows[:, :self.width * self.bpp]
+		if self.bpp == 4:
+			return pixels.view(numpy.uint32)
+		return pixels
+
+	def write(self, data, stride = None):
+		"""Copy tightly packed rows (or rows of stride bytes) from data into the image."""
+		row = self.width * self.bpp
+		if stride is None:
+			stride = row
+		if numpy is not None:
+			src = numpy.frombuffer(data, numpy.uint8)
+			dst = numpy.frombuffer(self.data, numpy.uint8)
+			if stride == row == self.stride:
+				size = self.height * row
+				dst[:size] = src[:size]
+				return
+			for y in range(self.height):
+				dst[y * self.stride:y * self.stride + row] = src[y * stride:y * stride + row]
+			return
+		for y in range(self.height):
+			self.data[y * self.stride:y * self.stride + row] = str(buffer(data, y * stride, row))
+
+class ShmPool:
+	"""Shared memory segments for uploading images to one display.
+
+	Segments return to the pool when their image has been sent, and are
+	reused once the server is known to be done reading them. That takes
+	a round trip, which is only made once limit images are in flight,
+	so with the default of two the pool syncs once every other frame.
+	"""
+
+	def __init__(self, display, limit = 2):
+		self.display = display
+		self.limit = limit
+		self.opcode = None
+		self.version = None
+		self.free_segments = []
+		self.pending = []
+		self.syncs = 0
+		self.shm_uploads = 0
+		self.socket_uploads = 0
+		if libc is not None and is_local(display):
+			reply = request.QueryExtension(display = display, name = 'MIT-SHM')
+			if reply.present:
+				try:
+					version = ShmQueryVersion(display = display, opcode = reply.major_opcode)
+				except error.XError:
+					return
+				self.version = (version.major_version, version.minor_version)
+				self.opcode = reply.major_opcode
+
+	def available(self):
+		"""Return true if images go through shared memory."""
+		return self.opcode is not None
+
+	def stats(self):
+		return dict(syncs = self.syncs, shm_uploads = self.shm_uploads, socket_uploads = self.socket_uploads,
+			segments = len(self.free_segments) + len(self.pending))
+
+	def sync(self):
+		"""Wait for the server to finish reading every sent image, making their segments free again."""
+		if self.pending:
+			sync(self.display)
+			self.syncs = self.syncs + 1
+			self.free_segments.extend(self.pending)
+			del self.pending[:]
+
+	def segment(self, size):
+		if not self.free_segments and len(self.pending) >= self.limit:
+			self.sync()
+		for segment in self.free_segments:
+			if segment.size >= size:
+				self.free_segments.remove(segment)
+				return segment
+		# Replace a segment that's too small, so that the pool doesn't keep growing
+		if self.free_segments:
+			self.free_segments.pop(0).free()
+
+		try:
+			segment = Segment(self.display, self.opcode, (size + PageSize - 1) // PageSize * PageSize)
+		except OSError:
+			self.opcode = None
+			return None
+		if not segment.attach():
+			# The server is probably on another machine
+			segment.free()
+			self.opcode = None
+			return None
+		return segment
+
+	def image(self, width, height, depth):
+		"""Return a ShmImage to draw into."""
+		bpp, stride = upload.zpixmap_layout(self.display, depth, width)
+		segment = None
+		if self.available():
+			segment = self.segment(height * stride)
+		return ShmImage(segment, width, height, depth, bpp, stride)
+
+	def put_image(self, drawable, gc, image, x, y):
+		"""Send image to drawable, after which it must not be drawn into anymore."""
+		# upload.put_image swaps the socket fallback itself
+		if image.segment is None:
+			upload.put_image(drawable, gc, x, y, image.width, image.height, image.depth, image.data, image.stride)
+			self.socket_uploads = self.socket_uploads + 1
+			return
+		if image.bpp == 4 and self.display.info.image_byte_order != X.LSBFirst:
+			# The image won't be drawn into again, so it can be swapped in place
+			pixels.swap_bytes(image.data)
+		ShmPutImage(display = self.display, opcode = self.opcode, drawable = drawable, gc = gc,
+			total_width = image.width, total_height = image.height, src_x = 0, src_y = 0,
+			src_width = image.width, src_height = image.height, dst_x = x, dst_y = y,
+			depth = image.depth, format = X.ZPixmap, send_event = 0,
+			shmseg = image.segment.shmseg, offset = 0)
+		self.shm_uploads = self.shm_uploads + 1
+		self.pending.append(image.segment)
+		image.segment = image.data = None
+
+	def discard(self, image):
+		"""Give back the segment of an image that won't be sent."""
+		if image.segment is not None:
+			self.free_segments.append(image.segment)
+			image.segment = image.data = None
+
+	def put_buffer(self, drawable, gc, x, y, width, height, depth, data, stride = None):
+		"""Like upload.put_image, but copying data through shared memory when possible."""
+		if not self.available():
+			upload.put_image(drawable, gc, x, y, width, height, depth, data, stride)
+			self.socket_uploads = self.socket_uploads + 1
+			return
+		image = self.image(width, height, depth)
+		image.write(data, stride)
+		self.put_image(drawable, gc, image, x, y)
+
+	def free(self):
+		self.sync()
+		for segment in self.free_segments:
+			segment.free()
+		del self.free_segments[:]
@@ -0,0 +1,726 @@
+
+# Software Render compositor
+#
+# SoftPicture implements the drawing requests of render.Picture on NumPy
+# arrays, so that rendering code can run, and its output be checked,
+# without an X server. Pixels are kept as premultiplied floating point
+# RGBA, and rounded to the channel depths of the picture format after
+# every request. The rules follow the Render protocol and pixman, the
+# server's implementation; results match a server to within the
+# rounding of its 8-bit arithmetic, not bit for bit.
+#
+# Not implemented: alpha maps, clip and alpha mask pixmaps, source
+# clipping, glyphs, and indexed formats.
+#
+# Needs NumPy.
+
+import math
+import numpy
+
+from Xlib import X
+from Xlib.ext import render
+
+# Format ids of the standard formats; like the server's ids, never X.NONE
+FormatIds = {
+	render.PictStandardARGB32: 1,
+	render.PictStandardRGB24: 2,
+	render.PictStandardA8: 3,
+	render.PictStandardA4: 4,
+	render.PictStandardA1: 5,
+	}
+
+# Depths of the red, green, blue and alpha channels of each format id
+Channels = {
+	1: (8, 8, 8, 8),
+	2: (8, 8, 8, 0),
+	3: (0, 0, 0, 8),
+	4: (0, 0, 0, 4),
+	5: (0, 0, 0, 1),
+	}
+
+# Sample positions on the edge of a pixel are taken by the one before it
+Epsilon = 1.0 / 65536
+
+def standard_format(format):
+	"""Return the format id of one of render.PictStandard*, for mask_format arguments."""
+	return FormatIds[format]
+
+def sample_grid(bits):
+	"""Return the samples across and down a pixel used to rasterize into bits of alpha, as pixman does."""
+	if bits == 1:
+		return 1, 1
+	return (1 << bits // 2) + 1, (1 << bits // 2) - 1
+
+def divide(a, b, default):
+	"""Return a / b, or default where b is zero."""
+	zero = b == 0
+	return numpy.where(zero, default, a / numpy.where(zero, 1, b))
+
+# Porter-Duff factors, as (source, destination) for the low four bits
+# of the op; the Disjoint and Conjoint ops only differ in how the In and
+# Out parts are computed from the source and destination alpha.
+Zero, One, In, Out = range(4)
+
+Factors = [
+	(Zero, Zero),	# Clear
+	(One, Zero),	# Src
+	(Zero, One),	# Dst
+	(One, Out),	# Over
+	(Out, One),	# OverReverse
+	(In, Zero),	# In
+	(Zero, In),	# InReverse
+	(Out, Zero),	# Out
+	(Zero, Out),	# OutReverse
+	(In, Out),	# Atop
+	(Out, In),	# AtopReverse
+	(Out, Out),	# Xor
+	]
+
+def in_part(family, a, b):
+	"""How much of a is inside b, for the ops in family (0, 0x10 or 0x20)."""
+	if family == 0x10:
+		# max(0, 1 - (1 - b) / a)
+		return numpy.where(1 - b >= a, 0.0, 1 - divide(1 - b, a, 0.0))
+	if family == 0x20:
+		# min(1, b / a)
+		return numpy.where(b >= a, 1.0, divide(b, a, 1.0))
+	return b + 0 * a
+
+def out_part(family, a, b):
+	"""How much of a is outside b, for the ops in family (0, 0x10 or 0x20)."""
+	if family == 0x10:
+		# min(1, (1 - b) / a)
+		return numpy.where(1 - b >= a, 1.0, divide(1 - b, a, 1.0))
+	if family == 0x20:
+		# max(0, 1 - b / a)
+		return numpy.where(b >= a, 0.0, 1 - divide(b, a, 0.0))
+	return 1 - b + 0 * a
+
+def factor(kind, family, a, b):
+	if kind == Zero:
+		return 0.0
+	if kind == One:
+		return 1.0
+	if kind == In:
+		return in_part(family, a, b)
+	return out_part(family, a, b)
+
+# Separable blend functions of unpremultiplied source and destination colors
+def multiply(s, d):
+	return s * d
+
+def screen(s, d):
+	return s + d - s * d
+
+def hard_light(s, d):
+	return numpy.where(2 * s <= 1, d * 2 * s, screen(2 * s - 1, d))
+
+def overlay(s, d):
+	return hard_light(d, s)
+
+def darken(s, d):
+	return numpy.minimum(s, d)
+
+def lighten(s, d):
+	return numpy.maximum(s, d)
+
+def color_dodge(s, d):
+	return numpy.where(d == 0, 0.0, numpy.where(s >= 1, 1.0, numpy.minimum(1, divide(d, 1 - s, 1.0))))
+
+def color_burn(s, d):
+	return numpy.where(d >= 1, 1.0, numpy.where(s <= 0, 0.0, 1 - numpy.minimum(1, divide(1 - d, s, 1.0))))
+
+def soft_light(s, d):
+	dark = numpy.where(d <= 0.25, ((16 * d - 12) * d + 4) * d, numpy.sqrt(d))
+	return numpy.where(2 * s <= 1, d - (1 - 2 * s) * d * (1 - d), d + (2 * s - 1) * (dark - d))
+
+def difference(s, d):
+	return numpy.abs(s - d)
+
+def exclusion(s, d):
+	return s + d - 2 * s * d
+
+# Non-separable blend functions, of (N, 3) colors
+def lum(c):
+	return (0.3 * c[:, 0] + 0.59 * c[:, 1] + 0.11 * c[:, 2])[:, None]
+
+def sat(c):
+	return (c.max(axis = 1) - c.min(axis = 1))[:, None]
+
+def clip_color(c):
+	l = lum(c)
+	low = c.min(axis = 1)[:, None]
+	high = c.max(axis = 1)[:, None]
+	c = numpy.where(low < 0, l + divide((c - l) * l, l - low, 0.0), c)
+	return numpy.where(high > 1, l + divide((c - l) * (1 - l), high - l, 0.0), c)
+
+def set_lum(c, l):
+	return clip_color(c + (l - lum(c)))
+
+def set_sat(c, s):
+	low = c.min(axis = 1)[:, None]
+	return divide((c - low) * s, sat(c), 0.0)
+
+def hsl_hue(s, d):
+	return set_lum(set_sat(s, sat(d)), lum(d))
+
+def hsl_saturation(s, d):
+	return set_lum(set_sat(d, sat(s)), lum(d))
+
+def hsl_color(s, d):
+	return set_lum(s, lum(d))
+
+def hsl_luminosity(s, d):
+	return set_lum(d, lum(s))
+
+Blends = {
+	render.PictOpMultiply: multiply,
+	render.PictOpScreen: screen,
+	render.PictOpOverlay: overlay,
+	render.PictOpDarken: darken,
+	render.PictOpLighten: lighten,
+	render.PictOpColorDodge: color_dodge,
+	render.PictOpColorBurn: color_burn,
+	render.PictOpHardLight: hard_light,
+	render.PictOpSoftLight: soft_light,
+	render.PictOpDifference: difference,
+	render.PictOpExclusion: exclusion,
+	}
+
+NonSeparable = {
+	render.PictOpHSLHue: hsl_hue,
+	render.PictOpHSLSaturation: hsl_saturation,
+	render.PictOpHSLColor: hsl_color,
+	render.PictOpHSLLuminosity: hsl_luminosity,
+	}
+
+def combine(op, s, sa, d):
+	"""Return the result of op on (N, 4) premultiplied RGBA colors.
+
+	s is the source, already multiplied by the mask, and sa its alpha,
+	(N, 1), or (N, 4) with a component alpha mask; d is the destination.
+	"""
+	da = d[:, 3:]
+	if op == render.PictOpAdd:
+		return numpy.minimum(s + d, 1)
+	if op == render.PictOpSaturate:
+		return s * numpy.minimum(1, divide(1 - da, sa, 1.0)) + d
+	if op in Blends or op in NonSeparable:
+		result = s * (1 - da) + d * (1 - sa)
+		if op in Blends:
+			term = sa * da * Blends[op](divide(s, sa, 0.0), divide(d, da, 0.0))
+		else:
+			sa = sa[:, -1:]
+			term = numpy.zeros(s.shape)
+			term[:, :3] = sa * da * NonSeparable[op](divide(s[:, :3], sa, 0.0), divide(d[:, :3], da, 0.0))
+		result = result + term
+		result[:, 3:] = s[:, 3:] + da - s[:, 3:] * da
+		return result
+	family = op & 0xf0
+	fa, fb = Factors[op & 0x0f]
+	return s * factor(fa, family, sa, da) + d * factor(fb, family, da, sa)
+
+def zero_source_changes(op):
+	"""Return true if a transparent source changes the destination with op, as with Clear or In."""
+	if op & 0xf0 in (0, 0x10, 0x20) and op & 0x0f < len(Factors):
+		return Factors[op & 0x0f][1] in (Zero, In)
+	return 0
+
+def line_x(lines, y):
+	"""Return the x of (x1, y1, x2, y2) lines at y."""
+	x1, y1, x2, y2 = lines[:, 0], lines[:, 1], lines[:, 2], lines[:, 3]
+	return x1 + divide((y - y1) * (x2 - x1), y2 - y1, 0.0)
+
+def rasterize(width, height, top, bottom, left, right, bits, ordered = 1):
+	"""Return the coverage of trapezoids on a (height, width) grid, summed.
+
+	top and bottom are (N,) arrays, left and right (N, 4) arrays of
+	lines. Pixels are sampled on the grid pixman uses for bits of alpha,
+	and each sample row is cut at the edges into a span of samples. With
+	ordered false, the sides may be in either order.
+	"""
+	nx, ny = sample_grid(bits)
+	first = numpy.clip(numpy.ceil(top * ny - 0.5), 0, height * ny).astype(numpy.intp)
+	last = numpy.clip(numpy.ceil(bottom * ny - 0.5), 0, height * ny).astype(numpy.intp)
+	counts = numpy.maximum(last - first, 0)
+	shape = numpy.repeat(numpy.arange(len(top)), counts)
+	row = numpy.arange(len(shape)) - numpy.repeat(numpy.cumsum(counts) - counts - first, counts)
+	y = (row + 0.5) / ny
+	xl = line_x(left[shape], y)
+	xr = line_x(right[shape], y)
+	if not ordered:
+		xl, xr = numpy.minimum(xl, xr), numpy.maximum(xl, xr)
+	j0 = numpy.clip(numpy.ceil(xl * nx - 0.5), 0, width * nx).astype(numpy.intp)
+	j1 = numpy.clip(numpy.ceil(xr * nx - 0.5), 0, width * nx).astype(numpy.intp)
+	keep = j1 > j0
+	j0, j1, row = j0[keep], j1[keep], row[keep] // ny
+
+	# Samples in the pixels at either end of a span are added directly,
+	# full pixels in between as a run in a difference array
+	p0, r0 = j0 // nx, j0 % nx
+	p1, r1 = j1 // nx, j1 % nx
+	same = p0 == p1
+	stride = width + 2
+	size = height * stride
+	split = ~same
+	ends = numpy.bincount(numpy.concatenate((row[same] * stride + p0[same], row[split] * stride + p0[split],
+		row[split] * stride + p1[split])), numpy.concatenate(((j1 - j0)[same], (nx - r0)[split], r1[split])),
+		minlength = size)
+	runs = numpy.bincount(numpy.concatenate((row[split] * stride + p0[split] + 1, row[split] * stride + p1[split])),
+		numpy.concatenate((numpy.repeat(nx, split.sum()), numpy.repeat(-nx, split.sum()))), minlength = size)
+	runs = numpy.cumsum(runs[:size].reshape(height, stride), axis = 1)
+	count = runs + ends[:size].reshape(height, stride)
+	return count[:, :width] / float(nx * ny)
+
+def geometry(items, width):
+	"""Return points, triangles or traps (tuples or a NumPy array) as an (N, width) float array.
+
+	Values are rounded to Fixed like they are when sent.
+	"""
+	values = render.fixed_array(items, width)
+	if values is None:
+		flat = []
+		def walk(value):
+			if type(value) in (tuple, list):
+				for v in value:
+					walk(v)
+			else:
+				flat.append(int(value*2**16))
+		walk(items)
+		values = numpy.array(flat, numpy.int64).reshape(-1, width)
+	return values / 65536.0
+
+def triangle_traps(triangles):
+	"""Split (N, 6) triangles into the top, bottom, left and right of two trapezoids each, sides unordered."""
+	points = triangles.reshape(-1, 3, 2)
+	order = numpy.argsort(points[:, :, 1], axis = 1, kind = 'mergesort')
+	points = points[numpy.arange(len(points))[:, None], order]
+	a, b, c = points[:, 0], points[:, 1], points[:, 2]
+	edge = numpy.hstack((a, c))
+	top = numpy.concatenate((a[:, 1], b[:, 1]))
+	bottom = numpy.concatenate((b[:, 1], c[:, 1]))
+	left = numpy.concatenate((numpy.hstack((a, b)), numpy.hstack((b, c))))
+	right = numpy.concatenate((edge, edge))
+	groups = numpy.concatenate((numpy.arange(len(points)), numpy.arange(len(points))))
+	return top, bottom, left, right, groups
+
+def color_values(color):
+	if hasattr(color, 'keys') or hasattr(color, '_data'):
+		color = color['red'], color['green'], color['blue'], color['alpha']
+	return numpy.array(color, float) / 65535
+
+def stop_values(stops):
+	"""Return the offsets and unpremultiplied colors of gradient stops, as (N,) and (N, 4) arrays."""
+	array = render.stop_array(stops)
+	if array is not None:
+		offsets = render.fixed_array((array[:, 0], ), 1)[:, 0] / 65536.0
+		return offsets, array[:, 1:].astype(float) / 65535
+	offsets = numpy.array([int(offset*2**16) for offset, color in stops]) / 65536.0
+	return offsets, numpy.array([color_values(color) for offset, color in stops]).reshape(-1, 4)
+
+def point_values(point):
+	return numpy.array(render.point_values(point), float)
+
+class SoftPicture:
+	"""A picture drawn on in software, with the methods of render.Picture.
+
+	Sources and masks are other SoftPictures. Formats are the ids from
+	standard_format(), or X.NONE for mask_format.
+	"""
+
+	def __init__(self, width, height, format = 1):
+		self.width = width
+		self.height = height
+		self.format = format
+		self.bits = numpy.array(Channels[format])
+		self.levels = (1 << self.bits) - 1.0
+		# Missing channels read as 0, or 1 for alpha
+		self.unit = numpy.where(self.bits > 0, 1 / numpy.maximum(self.levels, 1), 0)
+		self.missing = numpy.array((0, 0, 0, self.bits[3] == 0), float)
+		self.pixels = numpy.zeros((height, width, 4))
+		self.pixels[:, :, 3] = self.bits[3] == 0
+		self.repeat = render.RepeatNone
+		self.clip = None
+		self.clip_x_origin = 0
+		self.clip_y_origin = 0
+		self.poly_edge = render.PolyEdgeSharp
+		self.component_alpha = 0
+		self.matrix = None
+		self.filter = render.FilterNearest
+		self.filter_values = ()
+
+	# Picture state
+
+	def change(self, **keys):
+		for key, value in keys.items():
+			if key in ('clip_mask', 'alpha_map'):
+				if value != X.NONE:
+					raise ValueError('%s pixmaps are not supported' % key)
+				if key == 'clip_mask':
+					self.clip = None
+			elif key in ('repeat', 'clip_x_origin', 'clip_y_origin', 'poly_edge', 'component_alpha'):
+				setattr(self, key, value)
+
+	def set_clip_rectangles(self, clip_x_origin, clip_y_origin, *rectangles):
+		self.clip_x_origin = clip_x_origin
+		self.clip_y_origin = clip_y_origin
+		self.clip = [render.rect_values(rect) for rect in rectangles]
+
+	def set_transform(self, transform):
+		values = render.transform_values(transform)
+		if values == render.transform_values(render.IdentityTransform):
+			self.matrix = None
+		else:
+			self.matrix = numpy.array(values, float).reshape(3, 3) / 65536
+
+	def set_filter(self, filter, *values):
+		if filter not in (render.FilterNearest, render.FilterBilinear, render.FilterConvolution,
+				render.FilterFast, render.FilterGood, render.FilterBest):
+			raise ValueError('unknown filter %r' % (filter, ))
+		self.filter = filter
+		self.filter_values = values
+
+	def free(self):
+		self.pixels = None
+
+	# Pixel access
+
+	def array(self):
+		"""Return a copy of the pixels, as a (height, width, 4) array of premultiplied RGBA in 0..1."""
+		return self.pixels.copy()
+
+	def argb32(self):
+		"""Return the pixels as a (height, width) array of premultiplied ARGB32, as a depth 32 image."""
+		values = numpy.round(self.pixels * 255).astype(numpy.uint32)
+		return values[:, :, 3] << 24 | values[:, :, 0] << 16 | values[:, :, 1] << 8 | values[:, :, 2]
+
+	def write(self, x, y, pixels):
+		"""Store a (height, width) array of premultiplied ARGB32 pixels at (x, y)."""
+		pixels = numpy.asarray(pixels, numpy.uint32)
+		height, width = pixels.shape
+		values = numpy.empty((height, width, 4))
+		for i, shift in enumerate((16, 8, 0, 24)):
+			values[:, :, i] = (pixels >> shift & 0xff) / 255.0
+		py, px = numpy.mgrid[y:y + height, x:x + width]
+		self.store(px.ravel(), py.ravel(), values.reshape(-1, 4))
+
+	def store(self, px, py, values):
+		"""Round values to the channel depths of the format and store them at px, py."""
+		values = numpy.clip(values, 0, 1)
+		values *= self.levels
+		numpy.round(values, out = values)
+		values *= self.unit
+		values += self.missing
+		self.pixels.reshape(-1, 4)[py * self.width + px] = values
+
+	def texels(self, ix, iy):
+		"""Return the pixels at integer coordinates, with the repeat mode applied."""
+		width, height = self.width, self.height
+		inside = None
+		if self.repeat == render.RepeatNormal:
+			ix, iy = ix % width, iy % height
+		elif self.repeat == render.RepeatPad:
+			ix, iy = numpy.clip(ix, 0, width - 1), numpy.clip(iy, 0, height - 1)
+		elif self.repeat == render.RepeatReflect:
+			ix, iy = ix % (2 * width), iy % (2 * height)
+			ix = numpy.where(ix >= width, 2 * width - 1 - ix, ix)
+			iy = numpy.where(iy >= height, 2 * height - 1 - iy, iy)
+		else:
+			inside = (ix >= 0) & (ix < width) & (iy >= 0) & (iy < height)
+			ix, iy = numpy.clip(ix, 0, width - 1), numpy.clip(iy, 0, height - 1)
+		values = self.pixels[iy, ix]
+		if inside is not None:
+			values = values * inside[:, None]
+		return values
+
+	def colors(self, x, y):
+		"""Return the (N, 4) colors at points in picture space, with the filter applied."""
+		if self.filter in (render.FilterBilinear, render.FilterGood, render.FilterBest):
+			x, y = x - 0.5, y - 0.5
+			x0, y0 = numpy.floor(x), numpy.floor(y)
+			fx, fy = (x - x0)[:, None], (y - y0)[:, None]
+			x0, y0 = x0.astype(numpy.intp), y0.astype(numpy.intp)
+			return ((self.texels(x0, y0) * (1 - fx) + self.texels(x0 + 1, y0) * fx) * (1 - fy)
+				+ (self.texels(x0, y0 + 1) * (1 - fx) + self.texels(x0 + 1, y0 + 1) * fx) * fy)
+		x0 = numpy.floor(x - Epsilon).astype(numpy.intp)
+		y0 = numpy.floor(y - Epsilon).astype(numpy.intp)
+		if self.filter == render.FilterConvolution:
+			width, height = int(self.filter_values[0]), int(self.filter_values[1])
+			kernel = self.filter_values[2:]
+			x0, y0 = x0 - (width - 1) // 2, y0 - (height - 1) // 2
+			result = numpy.zeros((len(x), 4))
+			for j in range(height):
+				for i in range(width):
+					if kernel[j * width + i]:
+						result = result + kernel[j * width + i] * self.texels(x0 + i, y0 + j)
+			return numpy.clip(result, 0, 1)
+		return self.texels(x0, y0)
+
+	def fetch(self, x, y):
+		"""Return the (N, 4) colors at pixel centers x, y, through the transform."""
+		if self.matrix is None:
+			return self.colors(x, y)
+		m = self.matrix
+		w = m[2, 0] * x + m[2, 1] * y + m[2, 2]
+		valid = w != 0
+		w = numpy.where(valid, w, 1)
+		result = self.colors((m[0, 0] * x + m[0, 1] * y + m[0, 2]) / w, (m[1, 0] * x + m[1, 1] * y + m[1, 2]) / w)
+		return result * valid[:, None]
+
+	# Drawing
+
+	def region(self, x0, y0, x1, y1):
+		"""Return the coordinates of the pixels in a rectangle that are inside the picture and its clip."""
+		x0, y0 = max(x0, 0), max(y0, 0)
+		x1, y1 = min(x1, self.width), min(y1, self.height)
+		if x1 <= x0 or y1 <= y0:
+			empty = numpy.zeros(0, numpy.intp)
+			return empty, empty
+		py, px = numpy.mgrid[y0:y1, x0:x1]
+		px, py = px.ravel(), py.ravel()
+		if self.clip is not None:
+			inside = numpy.zeros(len(px), bool)
+			for x, y, width, height in self.clip:
+				x, y = x + self.clip_x_origin, y + self.clip_y_origin
+				inside |= (px >= x) & (px < x + width) & (py >= y) & (py < y + height)
+			px, py = px[inside], py[inside]
+		return px, py
+
+	def blend(self, op, src, dx, dy, px, py, mask = None):
+		"""Composite src, offset by (dx, dy), onto the pixels px, py through mask values."""
+		if not len(px):
+			return
+		s = src.fetch(px + dx + 0.5, py + dy + 0.5)
+		sa = s[:, 3:]
+		if mask is not None:
+			# A component alpha mask gives every channel an alpha of its own
+			s = s * mask
+			sa = sa * mask
+		self.store(px, py, combine(op, s, sa, self.pixels.reshape(-1, 4).take(py * self.width + px, axis = 0)))
+
+	def composite(self, op, src, mask, src_x, src_y, mask_x, mask_y, dst_x, dst_y, width, height):
+		render.check_op(op)
+		px, py = self.region(dst_x, dst_y, dst_x + width, dst_y + height)
+		values = None
+		if mask is not None and mask != X.NONE and len(px):
+			values = mask.fetch(px - dst_x + mask_x + 0.5, py - dst_y + mask_y + 0.5)
+			if not mask.component_alpha:
+				values = values[:, 3:]
+		self.blend(op, src, src_x - dst_x, src_y - dst_y, px, py, values)
+
+	def fill_rectangles(self, op, color, *rects):
+		render.check_op(op)
+		fill = SolidFill(color)
+		for x, y, width, height in [render.rect_values(rect) for rect in rects]:
+			px, py = self.region(x, y, x + width, y + height)
+			self.blend(op, fill, 0, 0, px, py)
+
+	def shapes(self, op, src, mask_format, src_x, src_y, first, top, bottom, left, right, groups, ordered):
+		"""Composite src through the coverage of trapezoids.
+
+		With a mask format, the coverage of all of them is added up in
+		one mask, composited over their bounds; otherwise each group of
+		trapezoids is composited on its own, antialiased if poly_edge is
+		smooth. Ops for which a transparent source still changes the
+		destination are composited over the whole picture.
+		"""
+		render.check_op(op)
+		valid = bottom > top
+		top, bottom, left, right, groups = top[valid], bottom[valid], left[valid], right[valid], groups[valid]
+		dx, dy = render.source_anchor(first)
+		dx, dy = src_x - dx, src_y - dy
+		if mask_format:
+			bits = Channels[mask_format][3]
+			units = [slice(0, len(top))]
+		else:
+			bits = 8 if self.poly_edge == render.PolyEdgeSmooth else 1
+			# Groups keep their order, with their trapezoids next to each other
+			order = numpy.argsort(groups, kind = 'mergesort')
+			top, bottom, left, right, groups = top[order], bottom[order], left[order], right[order], groups[order]
+			ends = list(numpy.flatnonzero(numpy.diff(groups)) + 1) + [len(groups)]
+			units = [slice(start, end) for start, end in zip([0] + ends[:-1], ends) if end > start]
+		levels = (1 << bits) - 1.0
+		unbounded = zero_source_changes(op)
+		for unit in units:
+			t, b, l, r = top[unit], bottom[unit], left[unit], right[unit]
+			x0 = x1 = y0 = y1 = 0
+			if len(t):
+				sides = numpy.concatenate((line_x(l, t), line_x(l, b), line_x(r, t), line_x(r, b)))
+				x0, x1 = max(int(math.floor(sides.min())), 0), min(int(math.ceil(sides.max())), self.width)
+				y0, y1 = max(int(math.floor(t.min())), 0), min(int(math.ceil(b.max())), self.height)
+			if x1 > x0 and y1 > y0:
+				# Rasterize within the bounds only
+				offset = numpy.array((x0, y0, x0, y0))
+				coverage = rasterize(x1 - x0, y1 - y0, t - y0, b - y0, l - offset, r - offset, bits, ordered)
+				coverage = numpy.round(numpy.minimum(coverage, 1) * levels) / levels
+			elif unbounded:
+				x0 = x1 = y0 = y1 = 0
+				coverage = numpy.zeros((0, 0))
+			else:
+				continue
+			if unbounded:
+				full = numpy.zeros((self.height, self.width))
+				full[y0:y1, x0:x1] = coverage
+				coverage, x0, y0, x1, y1 = full, 0, 0, self.width, self.height
+			px, py = self.region(x0, y0, x1, y1)
+			self.blend(op, src, dx, dy, px, py, coverage[py - y0, px - x0][:, None])
+
+	def trapezoids(self, op, src, mask_format, src_x, src_y, *traps):
+		traps = geometry(traps, 10)
+		if not len(traps):
+			return
+		self.shapes(op, src, mask_format, src_x, src_y, traps[0, 2:4], traps[:, 0], traps[:, 1],
+			traps[:, 2:6], traps[:, 6:10], numpy.arange(len(traps)), 1)
+
+	def triangles(self, op, src, mask_format, src_x, src_y, *triangles):
+		triangles = geometry(triangles, 6)
+		if not len(triangles):
+			return
+		top, bottom, left, right, groups = triangle_traps(triangles)
+		self.shapes(op, src, mask_format, src_x, src_y, triangles[0, :2], top, bottom, left, right, groups, 0)
+
+	def tri_strip(self, op, src, mask_format, src_x, src_y, *points):
+		points = geometry(points, 2)
+		if len(points) < 3:
+			return
+		triangles = numpy.hstack((points[:-2], points[1:-1], points[2:]))
+		top, bottom, left, right, groups = triangle_traps(triangles)
+		self.shapes(op, src, mask_format, src_x, src_y, points[0], top, bottom, left, right, groups, 0)
+
+	def tri_fan(self, op, src, mask_format, src_x, src_y, *points):
+		points = geometry(points, 2)
+		if len(points) < 3:
+			return
+		triangles = numpy.hstack((numpy.repeat(points[:1], len(points) - 2, 0), points[1:-1], points[2:]))
+		top, bottom, left, right, groups = triangle_traps(triangles)
+		self.shapes(op, src, mask_format, src_x, src_y, points[0], top, bottom, left, right, groups, 0)
+
+	def add_traps(self, off_x, off_y, *trapezoids):
+		"""Add the coverage of traps to the picture, like PictOpAdd with white."""
+		traps = geometry(trapezoids, 6) + (off_x, off_x, off_y, off_x, off_x, off_y)
+		if not len(traps):
+			return
+		top, bottom = traps[:, 2], traps[:, 5]
+		left = numpy.column_stack((traps[:, 0], top, traps[:, 3], bottom))
+		right = numpy.column_stack((traps[:, 1], top, traps[:, 4], bottom))
+		coverage = rasterize(self.width, self.height, top, bottom, left, right, max(self.bits[3], 1))
+		py, px = numpy.nonzero(coverage)
+		self.store(px, py, numpy.minimum(self.pixels[py, px] + coverage[py, px][:, None], 1))
+
+class SolidFill(SoftPicture):
+	"""A picture of a single premultiplied color, as made by CreateSolidFill."""
+
+	def __init__(self, color):
+		SoftPicture.__init__(self, 1, 1)
+		self.color = color_values(color)
+
+	def fetch(self, x, y):
+		return numpy.tile(self.color, (len(x), 1))
+
+def gradient_colors(repeat, stops, t, valid):
+	"""Return the premultiplied colors at positions t along a gradient, transparent where not valid."""
+	offsets, colors = stops
+	if repeat == render.RepeatNormal:
+		t = t - numpy.floor(t)
+	elif repeat == render.RepeatReflect:
+		t = numpy.abs(t - 2 * numpy.floor(t / 2 + 0.5))
+	elif repeat == render.RepeatPad:
+		t = numpy.clip(t, 0, 1)
+	else:
+		valid = valid & (t >= 0) & (t <= 1)
+	# Stops are interpolated unpremultiplied, then premultiplied
+	result = numpy.column_stack([numpy.interp(t, offsets, colors[:, i]) for i in range(4)])
+	result[:, :3] = result[:, :3] * result[:, 3:]
+	return result * valid[:, None]
+
+class LinearGradient(SoftPicture):
+	"""A gradient along the line from p1 to p2."""
+
+	def __init__(self, p1, p2, stops):
+		SoftPicture.__init__(self, 1, 1)
+		self.stops = stop_values(stops)
+		self.p1, self.p2 = point_values(p1), point_values(p2)
+
+	def colors(self, x, y):
+		dx, dy = self.p2 - self.p1
+		length = dx * dx + dy * dy
+		t = ((x - self.p1[0]) * dx + (y - self.p1[1]) * dy) / (length or 1)
+		return gradient_colors(self.repeat, self.stops, t, numpy.ones(len(x), bool))
+
+class RadialGradient(SoftPicture):
+	"""A gradient between two circles, the position being the largest t whose circle goes through a point."""
+
+	def __init__(self, inner_center, outer_center, inner_radius, outer_radius, stops):
+		SoftPicture.__init__(self, 1, 1)
+		self.stops = stop_values(stops)
+		self.c1, self.c2 = point_values(inner_center), point_values(outer_center)
+		self.r1, self.r2 = float(inner_radius), float(outer_radius)
+
+	def colors(self, x, y):
+		cdx, cdy = self.c2 - self.c1
+		dr = self.r2 - self.r1
+		pdx, pdy = x - self.c1[0], y - self.c1[1]
+		a = cdx * cdx + cdy * cdy - dr * dr
+		b = pdx * cdx + pdy * cdy + self.r1 * dr
+		c = pdx * pdx + pdy * pdy - self.r1 * self.r1
+		if a == 0:
+			t = divide(c, 2 * b, 0.0)
+			return gradient_colors(self.repeat, self.stops, t, (b != 0) & (self.r1 + t * dr >= 0))
+		disc = b * b - a * c
+		root = numpy.sqrt(numpy.maximum(disc, 0))
+		t1 = (b + root) / a
+		t2 = (b - root) / a
+		high, low = numpy.maximum(t1, t2), numpy.minimum(t1, t2)
+		ok_high = (self.r1 + high * dr >= 0) & (disc >= 0)
+		ok_low = (self.r1 + low * dr >= 0) & (disc >= 0)
+		if self.repeat == render.RepeatNone:
+			# Only solutions inside the gradient count
+			ok_high = ok_high & (high >= 0) & (high <= 1)
+			ok_low = ok_low & (low >= 0) & (low <= 1)
+		return gradient_colors(self.repeat, self.stops, numpy.where(ok_high, high, low), ok_high | ok_low)
+
+class ConicalGradient(SoftPicture):
+	"""A gradient around a center, counterclockwise from angle (in degrees)."""
+
+	def __init__(self, center, angle, stops):
+		SoftPicture.__init__(self, 1, 1)
+		self.stops = stop_values(stops)
+		self.center = point_values(center)
+		self.angle = math.radians(angle)
+
+	def colors(self, x, y):
+		t = numpy.arctan2(y - self.center[1], x - self.center[0]) + self.angle
+		t = t % (2 * math.pi)
+		return gradient_colors(self.repeat, self.stops, 1 - t / (2 * math.pi), numpy.ones(len(x), bool))
+
+class SoftDisplay:
+	"""Creates SoftPictures, with the picture creating methods of a display.
+
+	Helpers taking a display, like BrushCache, work with it unchanged.
+	"""
+
+	def __init__(self):
+		self.last_id = 0
+
+	def add(self, pict):
+		self.last_id = self.last_id + 1
+		pict.id = self.last_id
+		return pict
+
+	def create_picture(self, width, height, format = render.PictStandardARGB32, **keys):
+		"""Return a new picture of one of render.PictStandard*, cleared to transparent."""
+		pict = self.add(SoftPicture(width, height, standard_format(format)))
+		pict.change(**keys)
+		return pict
+
+	def xrender_create_solid_fill(self, color):
+		return self.add(SolidFill(color))
+
+	def xrender_create_linear_gradient(self, p1, p2, *stops):
+		return self.add(LinearGradient(p1, p2, stops))
+
+	def xrender_create_radial_gradient(self, inner_center, outer_center, inner_radius, outer_radius, *stops):
+		return self.add(RadialGradient(inner_center, outer_center, inner_radius, outer_radius, stops))
+
+	def xrender_create_conical_gradient(self, center, angle, *stops):
+		return self.add(ConicalGradient(center, angle, stops))
@@ -0,0 +1,215 @@
+# Checks of the software renderer against the Render formulas, without
+# an X server. Colors are premultiplied RGBA in [0, 1].
+
+import math
+import numpy
+from Xlib.ext import render
+import softrender
+import tessellate
+
+dpy = softrender.SoftDisplay()
+a8 = softrender.standard_format(render.PictStandardA8)
+white = dpy.xrender_create_solid_fill((65535, 65535, 65535, 65535))
+half = dpy.xrender_create_solid_fill((0, 0, 0, 32768))
+
+def close(a, b, tolerance = 1.5 / 255):
+	assert numpy.allclose(a, b, atol = tolerance), (a, b)
+
+def alpha_sum(pict):
+	return pict.array()[:, :, 3].sum()
+
+# Over with a translucent source on an opaque destination
+d = dpy.create_picture(4, 4)
+d.fill_rectangles(render.PictOpSrc, (0, 0, 65535, 65535), (0, 0, 4, 4))
+d.fill_rectangles(render.PictOpOver, (32768, 0, 0, 32768), (1, 1, 2, 2))
+close(d.array()[1, 1], (0.5, 0, 0.5, 1))
+close(d.array()[0, 0], (0, 0, 1, 1))
+
+# Porter-Duff, Disjoint and Conjoint ops, worked out by hand for a gray
+# source and destination of (color, alpha): in the first pair, 1 - da
+# < sa and sa < da; in the second, 1 - da == sa and sa > da.
+first = (0.25, 0.5), (0.5, 0.75)
+second = (0.5, 0.75), (0.125, 0.25)
+ops = (
+	(first, render.PictOpOver, 0.5, 0.875),
+	(first, render.PictOpIn, 0.1875, 0.375),
+	(first, render.PictOpOut, 0.0625, 0.125),
+	(first, render.PictOpAtop, 0.4375, 0.75),
+	(first, render.PictOpXor, 0.3125, 0.5),
+	(first, render.PictOpDisjointOver, 0.25 + 1 / 3., 1),
+	(first, render.PictOpDisjointIn, 0.125, 0.25),
+	(first, render.PictOpDisjointOut, 0.125, 0.25),
+	(first, render.PictOpDisjointAtop, 0.125 + 1 / 3., 0.75),
+	(first, render.PictOpDisjointXor, 0.125 + 1 / 3., 0.75),
+	(first, render.PictOpConjointOver, 0.25 + 1 / 6., 0.75),
+	(first, render.PictOpConjointIn, 0.25, 0.5),
+	(first, render.PictOpConjointOut, 0, 0),
+	(first, render.PictOpConjointAtop, 0.25 + 1 / 6., 0.75),
+	(first, render.PictOpConjointXor, 1 / 6., 0.25),
+	(second, render.PictOpOver, 0.53125, 0.8125),
+	(second, render.PictOpIn, 0.125, 0.1875),
+	(second, render.PictOpOut, 0.375, 0.5625),
+	(second, render.PictOpAtop, 0.15625, 0.25),
+	(second, render.PictOpXor, 0.40625, 0.625),
+	(second, render.PictOpDisjointOver, 0.625, 1),
+	(second, render.PictOpDisjointIn, 0, 0),
+	(second, render.PictOpDisjointOut, 0.5, 0.75),
+	(second, render.PictOpDisjointAtop, 0.125, 0.25),
+	(second, render.PictOpDisjointXor, 0.625, 1),
+	(second, render.PictOpConjointOver, 0.5, 0.75),
+	(second, render.PictOpConjointIn, 1 / 6., 0.25),
+	(second, render.PictOpConjointOut, 1 / 3., 0.5),
+	(second, render.PictOpConjointAtop, 1 / 6., 0.25),
+	(second, render.PictOpConjointXor, 1 / 3., 0.5),
+	)
+for ((sc, sa), (dc, da)), op, color, alpha in ops:
+	s = numpy.array([[sc, sc, sc, sa]])
+	d = numpy.array([[dc, dc, dc, da]])
+	close(softrender.combine(op, s, s[:, 3:], d)[0], (color, color, color, alpha), 1e-9)
+s = numpy.array([[0.3, 0.3, 0.3, 0.6]])
+d = numpy.array([[0.5, 0.5, 0.5, 0.7]])
+close(softrender.combine(render.PictOpAdd, s, s[:, 3:], d)[0], (0.8, 0.8, 0.8, 1), 1e-9)
+
+# Blend modes, worked out from the unpremultiplied formulas of the PDF
+# blend modes for a source of (0.2, 0.5, 0.8) and a destination of
+# (0.2, 0.4, 0.8), at alphas of 0.5 and 0.75
+s = numpy.array([[0.1, 0.25, 0.4, 0.5]])
+d = numpy.array([[0.15, 0.3, 0.6, 0.75]])
+blends = (
+	(render.PictOpMultiply, (0.115, 0.2875, 0.64)),
+	(render.PictOpColorDodge, (0.19375, 0.5125, 0.775)),
+	(render.PictOpColorBurn, (0.1, 0.2125, 0.68125)),
+	(render.PictOpSoftLight, (0.139, 0.3625, 0.721246)),
+	(render.PictOpHSLHue, (0.152875, 0.377875, 0.677875)),
+	(render.PictOpHSLLuminosity, (0.197125, 0.384625, 0.722125)),
+	)
+for op, color in blends:
+	close(softrender.combine(op, s, s[:, 3:], d)[0], color + (0.875, ), 1e-6)
+print 'ops ok'
+
+# Coverage adds up to the area of a triangle, with any edge and mask
+area = abs((60.7 - 3.3) * (58.9 - 2.1) - (20.2 - 3.3) * (10.5 - 2.1)) / 2
+for edge, mask_format in ((render.PolyEdgeSmooth, 0), (render.PolyEdgeSharp, 0), (render.PolyEdgeSmooth, a8)):
+	d = dpy.create_picture(64, 64, render.PictStandardA8, poly_edge = edge)
+	d.triangles(render.PictOpAdd, white, mask_format, 0, 0, ((3.3, 2.1), (60.7, 10.5), (20.2, 58.9)))
+	close(alpha_sum(d), area, 2)
+
+# Two triangles of a strip cover a rectangle exactly
+d = dpy.create_picture(16, 16, render.PictStandardA8)
+d.tri_strip(render.PictOpOver, white, a8, 0, 0, (2.5, 2), (10.5, 2), (2.5, 9), (10.5, 9))
+close(alpha_sum(d), 8 * 7)
+
+# Overlapping shapes blend twice without a mask, once through one
+triangles = (((0, 0), (8, 0), (0, 8)), ((0, 0), (8, 0), (0, 8)))
+d = dpy.create_picture(8, 8, render.PictStandardA8)
+d.triangles(render.PictOpOver, half, 0, 0, 0, *triangles)
+close(d.array()[1, 1, 3], 0.75)
+d = dpy.create_picture(8, 8, render.PictStandardA8)
+d.triangles(render.PictOpOver, half, a8, 0, 0, *triangles)
+close(d.array()[1, 1, 3], 0.5)
+
+# Ops that change the destination under a transparent source reach outside the shapes
+for op, changed in ((render.PictOpSrc, 1), (render.PictOpIn, 1), (render.PictOpDisjointClear, 1), (render.PictOpOver, 0)):
+	for mask_format in (0, a8):
+		d = dpy.create_picture(8, 8)
+		d.fill_rectangles(render.PictOpSrc, (0, 0, 65535, 65535), (0, 0, 8, 8))
+		d.triangles(op, white, mask_format, 0, 0, ((1, 1), (3, 1), (1, 3)))
+		assert (d.array()[7, 7, 3] == 0) == changed, (op, mask_format)
+
+# Trapezoids and traps of the same shape agree, and arrays give the same as tuples
+trap = (2.5, 20.25, ((3, 0), (1, 30)), ((25, 0), (29.5, 30)))
+d = dpy.create_picture(32, 32, render.PictStandardA8)
+d.trapezoids(render.PictOpAdd, white, a8, 0, 0, trap)
+e = dpy.create_picture(32, 32, render.PictStandardA8)
+e.add_traps(0, 0, ((3 - 2.5 * 2 / 30., 25 + 2.5 * 4.5 / 30, 2.5), (3 - 20.25 * 2 / 30., 25 + 20.25 * 4.5 / 30, 20.25)))
+close(d.array(), e.array(), 1e-9)
+e = dpy.create_picture(32, 32, render.PictStandardA8)
+e.trapezoids(render.PictOpAdd, white, a8, 0, 0, numpy.array([[2.5, 20.25, 3, 0, 1, 30, 25, 0, 29.5, 30]]))
+assert (d.array() == e.array()).all()
+
+# A tessellated circle covers its area
+d = dpy.create_picture(100, 100, render.PictStandardA8, poly_edge = render.PolyEdgeSmooth)
+angles = numpy.linspace(0, 2 * math.pi, 200, endpoint = False)
+tessellate.fill(d, render.PictOpAdd, white, a8, 0, 0, [numpy.column_stack((50 + 40 * numpy.cos(angles), 50 + 40 * numpy.sin(angles)))])
+close(alpha_sum(d), math.pi * 40 * 40, 5)
+print 'coverage ok'
+
+# A filled shape takes the source from where src_x and src_y put it on the destination
+img = dpy.create_picture(2, 2)
+img.write(0, 0, numpy.array([[0xffff0000, 0xff00ff00], [0xff0000ff, 0xffffffff]], numpy.uint32))
+img.change(repeat = render.RepeatNormal)
+d = dpy.create_picture(6, 6)
+tessellate.fill(d, render.PictOpOver, img, 0, 1, 0, [((3, 1), (6, 1), (6, 6), (3, 6))])
+d.composite(render.PictOpSrc, img, 0, 1, 0, 0, 0, 0, 0, 3, 6)
+assert (d.argb32()[1:] == numpy.tile(img.argb32(), (3, 4))[1:, 1:7]).all()
+
+# Linear gradient from black to white over 10 pixels, with each repeat mode
+black_to_white = ((0, (0, 0, 0, 65535)), (1, (65535, 65535, 65535, 65535)))
+g = dpy.xrender_create_linear_gradient((0, 0), (10, 0), *black_to_white)
+d = dpy.create_picture(12, 1)
+d.composite(render.PictOpSrc, g, 0, 0, 0, 0, 0, 0, 0, 12, 1)
+close(d.array()[0, :10, 0], numpy.arange(0.05, 1, 0.1))
+close(d.array()[0, 10:, 3], (0, 0))
+g.change(repeat = render.RepeatPad)
+d.composite(render.PictOpSrc, g, 0, 0, 0, 0, 0, 0, 0, 12, 1)
+close(d.array()[0, 10:, 0], (1, 1))
+g.change(repeat = render.RepeatReflect)
+d.composite(render.PictOpSrc, g, 0, 0, 0, 0, 0, 0, 0, 12, 1)
+close(d.array()[0, 10:, 0], (0.95, 0.85))
+
+# Radial gradient from red at the center to blue at a radius of 5
+g = dpy.xrender_create_radial_gradient((5, 5), (5, 5), 0, 5,
+	numpy.array([[0, 65535, 0, 0, 65535], [1, 0, 0, 65535, 65535]]))
+d = dpy.create_picture(11, 11)
+d.composite(render.PictOpSrc, g, 0, 0, 0, 0, 0, 0, 0, 11, 11)
+x = numpy.arange(11) + 0.5
+distance = numpy.hypot(x - 5, 0.5) / 5
+close(d.array()[5, :, 0], numpy.where(distance <= 1, 1 - distance, 0), 0.01)
+close(d.array()[0, 0, 3], 0)
+
+# Conical gradient, counterclockwise from the angle
+g = dpy.xrender_create_conical_gradient((5, 5), 0, *black_to_white)
+d.composite(render.PictOpSrc, g, 0, 0, 0, 0, 0, 0, 0, 11, 11)
+py, px = numpy.mgrid[0:11, 0:11] + 0.5
+t = 1 - numpy.arctan2(py - 5, px - 5) % (2 * math.pi) / (2 * math.pi)
+close(d.array()[:, :, 0], t, 0.01)
+print 'gradients ok'
+
+# Repeat, transforms and filters of an image source
+img = dpy.create_picture(2, 2)
+img.write(0, 0, numpy.array([[0xffff0000, 0xff00ff00], [0xff0000ff, 0xffffffff]], numpy.uint32))
+d = dpy.create_picture(4, 4)
+img.change(repeat = render.RepeatNormal)
+d.composite(render.PictOpSrc, img, 0, 0, 0, 0, 0, 0, 0, 4, 4)
+assert (d.argb32() == numpy.tile(img.argb32(), (2, 2))).all()
+img.change(repeat = render.RepeatNone)
+d.composite(render.PictOpSrc, img, 0, 0, 0, 0, 0, 0, 0, 4, 4)
+assert d.argb32()[3, 3] == 0
+# Scaled up twice
+img.set_transform((0.5, 0, 0, 0, 0.5, 0, 0, 0, 1))
+d.composite(render.PictOpSrc, img, 0, 0, 0, 0, 0, 0, 0, 4, 4)
+assert (d.argb32() == img.argb32().repeat(2, 0).repeat(2, 1)).all()
+img.set_filter(render.FilterBilinear)
+img.change(repeat = render.RepeatPad)
+d.composite(render.PictOpSrc, img, 0, 0, 0, 0, 0, 0, 0, 4, 4)
+close(d.array()[0, :, 0], (1, 0.75, 0.25, 0))
+img.set_transform(render.IdentityTransform)
+img.set_filter(render.FilterConvolution, 3, 3, *([1 / 9.] * 9))
+d.composite(render.PictOpSrc, img, 0, 0, 0, 0, 0, 0, 0, 2, 2)
+close(d.array()[0, 0], (5 / 9., 3 / 9., 3 / 9., 1))
+
+# Clip rectangles are relative to the clip origin
+d = dpy.create_picture(4, 4)
+d.set_clip_rectangles(1, 1, (0, 0, 2, 1))
+d.fill_rectangles(render.PictOpSrc, (65535, 0, 0, 65535), (0, 0, 4, 4))
+assert (d.argb32() != 0).sum() == 2 and d.argb32()[1, 1] and d.argb32()[1, 2]
+
+# A component alpha mask lets each channel through on its own
+m = dpy.create_picture(1, 1)
+m.write(0, 0, numpy.array([[0xff00ff00]], numpy.uint32))
+m.change(component_alpha = 1, repeat = render.RepeatNormal)
+d = dpy.create_picture(2, 2)
+d.fill_rectangles(render.PictOpSrc, (0, 0, 0, 65535), (0, 0, 2, 2))
+d.composite(render.PictOpOver, white, m, 0, 0, 0, 0, 0, 0, 2, 2)
+assert d.argb32()[0, 0] == 0xff00ff00
+print 'sources ok'
@@ -0,0 +1,241 @@
+
+# Stroker for lines and outlines
+#
+# Render has no line primitive, so strokes are drawn as triangles. Every
+# segment becomes a quad, and consecutive quads share a triangle strip,
+# with the strip bent around bevel and miter joins. The strips of all
+# the polylines of a stroke are stitched into one with degenerate
+# triangles, so that a stroke is a single TriStrip request, plus a
+# TriFan for every round join and cap. At round joins the strip goes
+# through degenerate triangles instead of the bevel, so that it doesn't
+# overlap the fan.
+#
+# Needs NumPy.
+
+import math
+import numpy
+
+from Xlib.ext import render
+import tessellate
+
+JoinMiter = 0
+JoinRound = 1
+JoinBevel = 2
+
+CapButt = 0
+CapRound = 1
+CapSquare = 2
+
+def dash(points, closed, dashes, offset = 0):
+	"""Split a polyline into the open polylines of its dashes.
+
+	dashes alternates the lengths of the on and off parts, starting
+	with an on part; offset is how far into the pattern the line starts.
+	"""
+	points = numpy.asarray(points, float)
+	if closed:
+		points = numpy.vstack((points, points[:1]))
+	dist = numpy.concatenate(([0], numpy.cumsum(numpy.hypot(*numpy.diff(points, axis = 0).T))))
+	total = dist[-1]
+	period = float(sum(dashes))
+	if len(dashes) % 2:
+		# An odd pattern repeats with on and off swapped
+		dashes = list(dashes) * 2
+		period = period * 2
+	bounds = numpy.concatenate(([0], numpy.cumsum(dashes)))
+	start = -(offset % period)
+	periods = start + period * numpy.arange(int(math.ceil((total - start) / period)))
+	on = numpy.clip((periods[:, None] + bounds[None, 0:-1:2]).ravel(), 0, total)
+	off = numpy.clip((periods[:, None] + bounds[None, 1::2]).ravel(), 0, total)
+	keep = off > on
+	on, off = on[keep], off[keep]
+
+	x = numpy.interp(on, dist, points[:, 0]), numpy.interp(off, dist, points[:, 0])
+	y = numpy.interp(on, dist, points[:, 1]), numpy.interp(off, dist, points[:, 1])
+	first = numpy.searchsorted(dist, on, 'right')
+	last = numpy.searchsorted(dist, off, 'left')
+	return [numpy.vstack(((x[0][i], y[0][i]), points[first[i]:last[i]], (x[1][i], y[1][i])))
+		for i in range(len(on))]
+
+def arcs(centers, start, end, radius, tolerance):
+	"""Return fans from start to end around centers, the short way round."""
+	a0 = numpy.arctan2(start[:, 1] - centers[:, 1], start[:, 0] - centers[:, 0])
+	a1 = numpy.arctan2(end[:, 1] - centers[:, 1], end[:, 0] - centers[:, 0])
+	sweep = (a1 - a0 + math.pi) % (2 * math.pi) - math.pi
+	step = 2 * math.acos(max(1 - tolerance / radius, -1))
+	counts = numpy.maximum(numpy.ceil(numpy.abs(sweep) / step), 1).astype(numpy.intp)
+
+	fan = numpy.repeat(numpy.arange(len(centers)), counts + 1)
+	firsts = numpy.cumsum(counts + 1) - (counts + 1)
+	t = (numpy.arange(len(fan)) - firsts[fan]) / counts[fan].astype(float)
+	angles = a0[fan] + sweep[fan] * t
+	points = centers[fan] + radius * numpy.column_stack((numpy.cos(angles), numpy.sin(angles)))
+	# Hit the end points exactly, so that fans and strips meet
+	points[firsts] = start
+	points[firsts + counts] = end
+	return [numpy.vstack((centers[i:i + 1], pts)) for i, pts in enumerate(numpy.split(points, firsts[1:]))]
+
+def stroke_polyline(points, closed, width, join = JoinMiter, cap = CapButt, miter_limit = 10.0, tolerance = 0.1):
+	"""Return (strip, fans) covering a stroke along points."""
+	points = numpy.asarray(points, float)
+	keep = numpy.ones(len(points), bool)
+	keep[1:] = (points[1:] != points[:-1]).any(axis = 1)
+	points = points[keep]
+	if closed and len(points) > 2 and (points[0] == points[-1]).all():
+		points = points[:-1]
+	if len(points) < 2:
+		return numpy.zeros((0, 2)), []
+	closed = closed and len(points) > 2
+
+	half = width / 2.0
+	start = points
+	end = numpy.roll(points, -1, 0)
+	if not closed:
+		start = start[:-1]
+		end = end[:-1]
+	d = end - start
+	u = d / numpy.hypot(d[:, 0], d[:, 1])[:, None]
+	# Left normals
+	n = numpy.column_stack((-u[:, 1], u[:, 0])) * half
+	ls, rs, le, re = start + n, start - n, end + n, end - n
+	fans = []
+
+	if not closed:
+		if cap == CapSquare:
+			ls[0] -= u[0] * half
+			rs[0] -= u[0] * half
+			le[-1] += u[-1] * half
+			re[-1] += u[-1] * half
+		elif cap == CapRound:
+			# Go around the back of each end point through a point behind it
+			back = numpy.array([start[0] - u[0] * half, end[-1] + u[-1] * half])
+			centers = numpy.array([start[0], end[-1]])
+			fans.extend(arcs(centers, numpy.array([ls[0], re[-1]]), back, half, tolerance))
+			fans.extend(arcs(centers, back, numpy.array([rs[0], le[-1]]), half, tolerance))
+
+	# Joins between segment i and the next one
+	count = len(u) if closed else len(u) - 1
+	# Round joins repeat the points around them, to skip the bevel
+	before = numpy.zeros(len(u), bool)
+	after = numpy.zeros(len(u), bool)
+	if count:
+		i = numpy.arange(count)
+		j = (i + 1) % len(u)
+		cross = u[i, 0] * u[j, 1] - u[i, 1] * u[j, 0]
+		dot = (u[i] * u[j]).sum(axis = 1)
+		# The outer side of a join is the one the line turns away from
+		outer_left = cross < 0
+		turned = numpy.abs(cross) > 1e-9
+		center = end[i]
+		if join == JoinMiter:
+			cos_half = numpy.sqrt(numpy.maximum((1 + dot) / 2, 0))
+			miter = turned & (cos_half * miter_limit > 1)
+			sign = numpy.where(outer_left, 1.0, -1.0)[:, None]
+			tip = center + sign * (n[i] + n[j]) / numpy.maximum(1 + dot, 1e-9)[:, None]
+			left = i[miter & outer_left]
+			right = i[miter & ~outer_left]
+			le[left] = tip[left]
+			ls[j[left]] = tip[left]
+			re[right] = tip[right]
+			rs[j[right]] = tip[right]
+		elif join == JoinRound:
+			k = i[turned]
+			outer_end = numpy.where(outer_left[k][:, None], le[k], re[k])
+			outer_start = numpy.where(outer_left[k][:, None], ls[j[k]], rs[j[k]])
+			if len(k):
+				fans.extend(arcs(center[k], outer_end, outer_start, half, tolerance))
+				after[k] = 1
+				before[j[k]] = 1
+
+	keep = numpy.ones((len(u), 6), bool)
+	keep[:, 1] = before
+	keep[:, 5] = after
+	if closed:
+		# The join before the first segment comes at the end of the strip
+		keep[0, 1] = 0
+	strip = numpy.stack((ls, ls, rs, le, re, re), axis = 1)[keep]
+	if closed:
+		strip = numpy.vstack([strip] + [ls[:1]] * (1 + before[0]) + [rs[:1]])
+	return strip, fans
+
+def stitch(strips):
+	"""Join triangle strips into one, with degenerate triangles in between."""
+	strips = [strip for strip in strips if len(strip)]
+	if not strips:
+		return numpy.zeros((0, 2))
+	pieces = [strips[0]]
+	for strip in strips[1:]:
+		pieces.append(pieces[-1][-1:])
+		pieces.append(strip[:1])
+		pieces.append(strip)
+	return numpy.concatenate(pieces)
+
+def fan_strips(fan):
+	"""Split a fan into strips of two triangles, the most a strip can take from one."""
+	center = fan[:1]
+	return [numpy.vstack((fan[i:i + 1], center, fan[i + 1:i + 3])) for i in range(1, len(fan) - 1, 2)]
+
+class Stroke:
+	"""Triangles covering the stroke of a path or of polylines.
+
+	The geometry is computed once, and can be drawn any number of times
+	at different positions. The source is aligned with the first point
+	of the stroke, as for a single request, so it moves along with the
+	stroke; to keep it fixed on the destination, subtract the offset
+	from src_x and src_y.
+	"""
+
+	def __init__(self, shape, width, join = JoinMiter, cap = CapButt, miter_limit = 10.0,
+			dashes = None, dash_offset = 0, tolerance = 0.1):
+		if isinstance(shape, tessellate.Path):
+			polylines = shape.polylines(tolerance)
+		else:
+			polylines = [(points, closed) for points, closed in shape]
+		if dashes:
+			polylines = [(piece, 0) for points, closed in polylines
+				for piece in dash(points, closed, dashes, dash_offset)]
+
+		strips = []
+		self.fans = []
+		for points, closed in polylines:
+			strip, fans = stroke_polyline(points, closed, width, join, cap, miter_limit, tolerance)
+			strips.append(strip)
+			self.fans.extend(fans)
+		self.strip = stitch(strips)
+
+	def requests(self):
+		"""Return the number of TriStrip and TriFan requests a draw sends, before splitting."""
+		return int(len(self.strip) > 0) + len(self.fans)
+
+	def single_strip(self):
+		"""Return the strip with the fans stitched into it."""
+		strips = [self.strip]
+		for fan in self.fans:
+			strips.extend(fan_strips(fan))
+		return stitch(strips)
+
+	def draw(self, pict, op, src, mask_format, src_x, src_y, dx = 0, dy = 0):
+		"""Draw the stroke on pict, moved by (dx, dy).
+
+		Without a mask format every triangle is composited on its own,
+		and the strip and the fans are sent as separate requests. With
+		one, the server composites through one mask per request, so the
+		fans are stitched into the strip and the stroke is sent as a
+		single TriStrip, unless it is too big for one request.
+		"""
+		offset = numpy.array((dx, dy), float)
+		if mask_format:
+			strip = self.single_strip()
+			if len(strip):
+				pict.tri_strip(op, src, mask_format, src_x, src_y, strip + offset)
+			return
+		if not len(self.strip):
+			return
+		strip = self.strip + offset
+		first_x, first_y = render.source_anchor(strip[0])
+		pict.tri_strip(op, src, mask_format, src_x, src_y, strip)
+		# Each fan aligns the source with its center
+		for fan in self.fans:
+			fan = fan + offset
+			x, y = render.source_anchor(fan[0])
+			pict.tri_fan(op, src, mask_format, src_x + x - first_x, src_y + y - first_y, fan)
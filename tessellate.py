@@ -0,0 +1,234 @@
+
+# Fill tessellator for polygons and paths
+#
+# Turns filled shapes into the geometry taken by Picture.add_traps,
+# Picture.trapezoids and Picture.triangles. Curves are flattened to a
+# tolerance, and the resulting edges are cut into horizontal bands at
+# every vertex and edge crossing. Within a band no edges cross, so the
+# spans that are inside the shape under the fill rule are trapezoids.
+# All of this is done on NumPy arrays, one pass over every band at once.
+#
+# Needs NumPy.
+
+import numpy
+
+from Xlib.ext import render
+
+# Fill rules
+NonZero = 0
+EvenOdd = 1
+
+# Edges closer than this (a Fixed unit) are considered to touch
+Epsilon = 1.0 / 65536
+
+def flatten_cubics(ctrl, tolerance):
+	"""Flatten cubic Bezier curves given as a (K, 4, 2) array of control points.
+
+	Returns the points of every curve, without their start points, and
+	the number of points of each curve.
+	"""
+	p0, p1, p2, p3 = ctrl[:, 0], ctrl[:, 1], ctrl[:, 2], ctrl[:, 3]
+	# The distance from the chord is at most 3/4 of the largest second difference over n**2
+	dd = numpy.maximum(numpy.hypot(*(p0 - 2 * p1 + p2).T), numpy.hypot(*(p1 - 2 * p2 + p3).T))
+	counts = numpy.maximum(numpy.ceil(numpy.sqrt(0.75 * dd / tolerance)), 1).astype(numpy.intp)
+
+	curve = numpy.repeat(numpy.arange(len(ctrl)), counts)
+	starts = numpy.cumsum(counts) - counts
+	t = ((numpy.arange(len(curve)) - starts[curve] + 1) / counts[curve].astype(float))[:, None]
+	s = 1 - t
+	points = (s * s * s * p0[curve] + 3 * s * s * t * p1[curve]
+		+ 3 * s * t * t * p2[curve] + t * t * t * p3[curve])
+	return points, counts
+
+class Path:
+	"""A shape made of straight and curved subpaths.
+
+	Every subpath is closed implicitly when it's filled; when stroked,
+	only the ones ended with close() are.
+	"""
+
+	def __init__(self):
+		# Subpaths are lists of pieces: points of straight lines, or indexes into curves
+		self.subpaths = []
+		self.closed = []
+		self.curves = []
+		self.current = None
+
+	def move_to(self, x, y):
+		self.subpaths.append([[(x, y)]])
+		self.closed.append(0)
+		self.current = (x, y)
+
+	def line_to(self, x, y):
+		pieces = self.subpaths[-1]
+		if type(pieces[-1]) is not list:
+			pieces.append([])
+		pieces[-1].append((x, y))
+		self.current = (x, y)
+
+	def curve_to(self, x1, y1, x2, y2, x3, y3):
+		"""Add a cubic Bezier curve from the current point."""
+		self.subpaths[-1].append(len(self.curves))
+		self.curves.append((self.current, (x1, y1), (x2, y2), (x3, y3)))
+		self.current = (x3, y3)
+
+	def quad_to(self, x1, y1, x2, y2):
+		"""Add a quadratic Bezier curve from the current point."""
+		x0, y0 = self.current
+		self.curve_to(x0 + 2 / 3.0 * (x1 - x0), y0 + 2 / 3.0 * (y1 - y0),
+			x2 + 2 / 3.0 * (x1 - x2), y2 + 2 / 3.0 * (y1 - y2), x2, y2)
+
+	def close(self):
+		self.closed[-1] = 1
+		x, y = self.subpaths[-1][0][0]
+		self.move_to(x, y)
+
+	def polylines(self, tolerance = 0.1):
+		"""Return the subpaths as (points, closed) pairs, points being (N, 2) arrays with curves flattened."""
+		if self.curves:
+			points, counts = flatten_cubics(numpy.array(self.curves, float), tolerance)
+			curves = numpy.split(points, numpy.cumsum(counts)[:-1])
+		polylines = []
+		for pieces, closed in zip(self.subpaths, self.closed):
+			polyline = numpy.concatenate([numpy.array(piece, float).reshape(-1, 2) if type(piece) is list
+				else curves[piece] for piece in pieces])
+			if len(polyline) > 1:
+				polylines.append((polyline, closed))
+		return polylines
+
+	def polygons(self, tolerance = 0.1):
+		"""Return the subpaths as (N, 2) arrays of points, with curves flattened."""
+		return [polygon for polygon, closed in self.polylines(tolerance) if len(polygon) > 2]
+
+def edges(polygons):
+	"""Return the non-horizontal edges of polygons as (x0, y0, x1, y1, direction) arrays, top to bottom."""
+	if isinstance(polygons, Path):
+		polygons = polygons.polygons()
+	start = numpy.concatenate([numpy.asarray(polygon, float) for polygon in polygons])
+	end = numpy.concatenate([numpy.roll(numpy.asarray(polygon, float), -1, 0) for polygon in polygons])
+	keep = start[:, 1] != end[:, 1]
+	start = start[keep]
+	end = end[keep]
+	down = start[:, 1] < end[:, 1]
+	top = numpy.where(down[:, None], start, end)
+	bottom = numpy.where(down[:, None], end, start)
+	return top[:, 0], top[:, 1], bottom[:, 0], bottom[:, 1], numpy.where(down, 1, -1)
+
+def spans(polygons, rule = NonZero):
+	"""Decompose polygons into the trapezoids covered by them under rule.
+
+	polygons is a Path, or a sequence of (N, 2) point sequences. Returns
+	arrays of the top and bottom y, the x at the top and bottom of the
+	left and right sides, and the indexes of the left and right edges in
+	the arrays returned by edges().
+	"""
+	x0, y0, x1, y1, direction = found = edges(polygons)
+	if not len(x0):
+		empty = numpy.zeros(0)
+		return empty, empty, empty, empty, empty, empty, found, empty.astype(int), empty.astype(int)
+	slope = (x1 - x0) / (y1 - y0)
+	ys = numpy.unique(numpy.concatenate((y0, y1)))
+
+	while 1:
+		# Pair every edge with every band it goes through
+		first = numpy.searchsorted(ys, y0)
+		counts = numpy.searchsorted(ys, y1) - first
+		edge = numpy.repeat(numpy.arange(len(x0)), counts)
+		band = numpy.arange(len(edge)) - numpy.repeat(numpy.cumsum(counts) - counts - first, counts)
+		top = ys[band]
+		bottom = ys[band + 1]
+		xt = x0[edge] + (top - y0[edge]) * slope[edge]
+		xb = x0[edge] + (bottom - y0[edge]) * slope[edge]
+
+		order = numpy.lexsort((xt + xb, band))
+		edge, band, top, bottom, xt, xb = edge[order], band[order], top[order], bottom[order], xt[order], xb[order]
+
+		# Neighbours that swap places within a band cross, so the band is split there
+		same = band[1:] == band[:-1]
+		crossed = same & ((xt[1:] < xt[:-1] - Epsilon) | (xb[1:] < xb[:-1] - Epsilon))
+		if not crossed.any():
+			break
+		k = numpy.nonzero(crossed)[0]
+		dt = xt[k + 1] - xt[k]
+		db = xb[k + 1] - xb[k]
+		cross = top[k] + dt / (dt - db) * (bottom[k] - top[k])
+		cross = cross[(cross > top[k]) & (cross < bottom[k])]
+		count = len(ys)
+		ys = numpy.unique(numpy.concatenate((ys, cross)))
+		if len(ys) == count:
+			break
+
+	# Each band crosses the outline the same number of times in each direction,
+	# so the running sum of the directions is the winding number of every span
+	winding = numpy.cumsum(direction[edge])[:-1]
+	if rule == EvenOdd:
+		inside = same & (winding & 1 == 1)
+	else:
+		inside = same & (winding != 0)
+	k = numpy.nonzero(inside)[0]
+	left, right = edge[k], edge[k + 1]
+	top, bottom, lt, lb, rt, rb = top[k], bottom[k], xt[k], xb[k], xt[k + 1], xb[k + 1]
+
+	# Bands only split the edges going through them, so a span between the
+	# same two edges in consecutive bands merges with the one above it
+	order = numpy.lexsort((top, right, left))
+	left, right, top, bottom, lt, lb, rt, rb = [a[order] for a in (left, right, top, bottom, lt, lb, rt, rb)]
+	start = numpy.ones(len(top), bool)
+	start[1:] = (left[1:] != left[:-1]) | (right[1:] != right[:-1]) | (top[1:] != bottom[:-1])
+	first = numpy.nonzero(start)[0]
+	last = numpy.append(first[1:], len(top)) - 1
+	return top[first], bottom[last], lt[first], lb[last], rt[first], rb[last], found, left[first], right[first]
+
+def traps(polygons, rule = NonZero):
+	"""Return the fill of polygons as an (N, 6) array of Traps.
+
+	The columns are the left, right and y of the top span, and the
+	left, right and y of the bottom span, as taken by Picture.add_traps.
+	"""
+	top, bottom, left_top, left_bottom, right_top, right_bottom = spans(polygons, rule)[:6]
+	return numpy.column_stack((left_top, right_top, top, left_bottom, right_bottom, bottom))
+
+def trapezoids(polygons, rule = NonZero):
+	"""Return the fill of polygons as an (N, 10) array of Trapezoids.
+
+	The columns are top, bottom, the two points of the left line and
+	the two points of the right line, as taken by Picture.trapezoids.
+	"""
+	top, bottom, lt, lb, rt, rb, found, left, right = spans(polygons, rule)
+	x0, y0, x1, y1 = found[:4]
+	return numpy.column_stack((top, bottom, x0[left], y0[left], x1[left], y1[left],
+		x0[right], y0[right], x1[right], y1[right]))
+
+def triangles(polygons, rule = NonZero):
+	"""Return the fill of polygons as an (N, 6) array of Triangles, taken by Picture.triangles."""
+	top, bottom, lt, lb, rt, rb = spans(polygons, rule)[:6]
+	# Every trapezoid is split along a diagonal; triangles with no area are dropped
+	upper = numpy.column_stack((lt, top, rt, top, rb, bottom))[rt - lt > Epsilon]
+	lower = numpy.column_stack((lt, top, rb, bottom, lb, bottom))[rb - lb > Epsilon]
+	return numpy.concatenate((upper, lower))
+
+def trap_list(array):
+	"""Convert an array from traps() into the tuples taken by Picture.add_traps."""
+	return [((a[0], a[1], a[2]), (a[3], a[4], a[5])) for a in array.tolist()]
+
+def trapezoid_list(array):
+	"""Convert an array from trapezoids() into the tuples taken by Picture.trapezoids."""
+	return [(a[0], a[1], ((a[2], a[3]), (a[4], a[5])), ((a[6], a[7]), (a[8], a[9]))) for a in array.tolist()]
+
+def triangle_list(array):
+	"""Convert an array from triangles() into the tuples taken by Picture.triangles."""
+	return [((a[0], a[1]), (a[2], a[3]), (a[4], a[5])) for a in array.tolist()]
+
+def fill(pict, op, src, mask_format, src_x, src_y, polygons, rule = NonZero):
+	"""Fill polygons (a Path or point sequences) on pict with src, using Triangles requests.
+
+	Unlike a plain Triangles request, whose source is aligned with the
+	first point, src_x and src_y are the source pixel that lands on the
+	origin of pict, so the source stays put whatever the shape.
+	"""
+	tris = triangles(polygons, rule)
+	if not len(tris):
+		return
+	# The server subtracts the pixel of the first point from the source position
+	x, y = render.source_anchor(tris[0, :2])
+	pict.triangles(op, src, mask_format, src_x + x, src_y + y, tris)
@@ -0,0 +1,154 @@
+
+# Uploading client-side images into render Pictures
+#
+# create_picture_from_image() takes NumPy arrays, PIL images or plain
+# buffers, picks the matching PictFormat, and sends the pixels with
+# PutImage requests split into strips that fit in the maximum request
+# size. Pixel data is expected in little-endian byte order (B, G, R, A
+# in memory for 32-bit pixels) and is swapped for big-endian servers.
+
+from Xlib import X
+from Xlib.ext import render
+import pixels
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# Size of a PutImage request without the image data
+PutImageSize = 24
+
+def zpixmap_layout(display, depth, width):
+	"""Return (bytes per pixel, padded bytes per row) of depth ZPixmap images."""
+	for fmt in display.info.pixmap_formats:
+		if fmt.depth == depth:
+			break
+	else:
+		raise ValueError('server has no pixmap format for depth %d' % depth)
+	if fmt.bits_per_pixel % 8:
+		raise ValueError('depth %d pixels are not whole bytes' % depth)
+	bpp = fmt.bits_per_pixel // 8
+	pad = fmt.scanline_pad // 8
+	return bpp, (width * bpp + pad - 1) // pad * pad
+
+def put_image(drawable, gc, x, y, width, height, depth, data, stride = None):
+	"""Send a ZPixmap image in strips that each fit in one PutImage request.
+
+	data holds height rows of stride bytes each, tightly packed rows by
+	default. Strips are sent straight out of data when the rows already
+	have the server's scanline padding and byte order; otherwise each
+	strip is copied and padded. Returns the number of requests sent.
+	"""
+	display = drawable.display
+	bpp, padded = zpixmap_layout(display, depth, width)
+	row = width * bpp
+	if stride is None:
+		stride = row
+	if len(data) < stride * (height - 1) + row:
+		raise ValueError('image data too short for %dx%d pixels' % (width, height))
+	swap = bpp == 4 and display.info.image_byte_order != X.LSBFirst
+
+	rows = max((render.max_request_size(display) - PutImageSize) // padded, 1)
+	count = 0
+	for top in range(0, height, rows):
+		n = min(rows, height - top)
+		if stride == padded and not swap and (top + n) * stride <= len(data):
+			strip = buffer(data, top * stride, n * stride)
+		else:
+			strip = bytearray(n * padded)
+			for i in range(n):
+				pos = (top + i) * stride
+				strip[i * padded:i * padded + row] = buffer(data, pos, row)
+			if swap:
+				pixels.swap_bytes(strip)
+			strip = str(strip)
+		drawable.put_image(gc, x, y + top, width, n, X.ZPixmap, depth, 0, strip)
+		count = count + 1
+	return count
+
+def find_format(display, format):
+	"""Return the PictFormInfo for format, which can be one of render.PictStandard*."""
+	if isinstance(format, (int, long)):
+		fmt = display.render_context.formats().find_standard(format)
+		if fmt is None:
+			raise ValueError('server has no standard format %d' % format)
+		return fmt
+	return format
+
+def pil_image_data(image):
+	"""Return (data, width, height, standard format) for a PIL image."""
+	if image.mode not in ('RGB', 'RGBA', 'L'):
+		image = image.convert('RGBA')
+	tobytes = getattr(image, 'tobytes', None) or image.tostring
+	width, height = image.size
+	if image.mode == 'RGBA':
+		data = bytearray(tobytes('raw', 'BGRA'))
+		pixels.premultiply(data)
+		return data, width, height, render.PictStandardARGB32
+	if image.mode == 'RGB':
+		return tobytes('raw', 'BGRX'), width, height, render.PictStandardRGB24
+	# Grayscale images become alpha masks
+	return tobytes(), width, height, render.PictStandardA8
+
+def array_image_data(image):
+	"""Return (data, width, height, standard format) for a NumPy array.
+
+	Arrays of shape (height, width) of uint32 are ARGB32 pixels, and of
+	uint8 A8 pixels. Arrays of shape (height, width, 4) of uint8 are
+	ARGB32 pixels in B, G, R, A order, and of shape (height, width, 3)
+	RGB24 pixels in R, G, B order. Alpha must already be premultiplied.
+	"""
+	height, width = image.shape[:2]
+	if image.dtype == numpy.uint32 and image.ndim == 2:
+		fmt = render.PictStandardARGB32
+	elif image.dtype == numpy.uint8 and image.ndim == 2:
+		fmt = render.PictStandardA8
+	elif image.dtype == numpy.uint8 and image.ndim == 3 and image.shape[2] == 4:
+		fmt = render.PictStandardARGB32
+	elif image.dtype == numpy.uint8 and image.ndim == 3 and image.shape[2] == 3:
+		data = pixels.rgb24_to_argb32(numpy.ascontiguousarray(image))
+		return data, width, height, render.PictStandardRGB24
+	else:
+		raise ValueError('unsupported image array of %s with shape %s' % (image.dtype, image.shape))
+	# Only arrays that aren't laid out in rows already are copied
+	return buffer(numpy.ascontiguousarray(image)), width, height, fmt
+
+def create_picture_from_image(drawable, data, format = None, width = None, height = None, stride = None, pool = None, **keys):
+	"""Upload an image into a new Picture on the screen of drawable.
+
+	data can be a NumPy array or a PIL image, whose size and format are
+	taken from the image, or a buffer of 32-bit or 8-bit pixels, which
+	needs width and height (format defaults to ARGB32). format is one of
+	render.PictStandard*, or a PictFormInfo such as the entries returned
+	by xutil.render_find_format, and overrides the format picked for the
+	image. With a shmupload.ShmPool as pool, the pixels are sent through
+	shared memory when possible. keys are passed on to create_picture.
+	"""
+	if numpy is not None and isinstance(data, numpy.ndarray):
+		data, width, height, standard = array_image_data(data)
+	elif hasattr(data, 'mode') and hasattr(data, 'size'):
+		data, width, height, standard = pil_image_data(data)
+	elif width is None or height is None:
+		raise ValueError('width and height are needed for image buffers')
+	else:
+		standard = render.PictStandardARGB32
+
+	if format is None:
+		format = standard
+	format = find_format(drawable.display, format)
+
+	pixmap = drawable.create_pixmap(width, height, format['depth'])
+	try:
+		gc = pixmap.create_gc()
+		try:
+			if pool is not None:
+				pool.put_buffer(pixmap, gc, 0, 0, width, height, format['depth'], data, stride)
+			else:
+				put_image(pixmap, gc, 0, 0, width, height, format['depth'], data, stride)
+		finally:
+			gc.free()
+		return pixmap.xrender_create_picture(format['id'], **keys)
+	finally:
+		# The picture keeps the pixmap contents alive
+		pixmap.free()
@@ -1,90 +1,378 @@
+import os
+import mmap
 import struct
-from Xlib import X
+import hashlib
+from collections import OrderedDict
+import upload
 
-def chunk(data, size):
-	assert size <= len(data)
-	return data[:size], data[size:]
+try:
+	from concurrent import futures
+except ImportError:
+	futures = None
 
-def unpack(data, size, fmt):
-	this, rest = chunk(data, size)
-	return struct.unpack(fmt, this), rest
+XcursorMagic = 'Xcur'
+XcursorCommentType = 0xfffe0001
+XcursorImageType = 0xfffd0002
 
-def parse_cursor(data):
-	magic, data = chunk(data, 4)
-	assert magic == 'Xcur'
+def parse_toc(data):
+	assert data[:4] == XcursorMagic
 
-	(header_size, version, toc_count), data = unpack(data, 12, '<III')
+	header_size, version, toc_count = struct.unpack_from('<III', data, 4)
 	#print 'HDR: size, version, count =', (header_size, version, toc_count)
 	assert header_size == 16
+	assert header_size + toc_count * 12 <= len(data)
 
-	tocs = []
-	for i in range(toc_count):
-		item, data = unpack(data, 12, '<III')
-		type, subtype, position = item
-		tocs.append(item)
-		#print 'TOC: type, subtype, position =', item
+	# type, subtype, position
+	return [struct.unpack_from('<III', data, header_size + i * 12) for i in range(toc_count)]
 
-	assert tocs[0][2] == header_size + toc_count * 12
+def nominal_sizes(tocs):
+	return sorted(set(subtype for type, subtype, position in tocs if type == XcursorImageType))
+
+def best_size(tocs, size):
+	# Like XcursorFindBestSize, the closest size wins, the smaller one on ties
+	sizes = nominal_sizes(tocs)
+	if not sizes:
+		return None
+	return min(sizes, key = lambda s: (abs(s - size), s))
+
+def parse_cursor(data, size = None):
+	"""Parse the images of an Xcursor file.
+
+	data can be a string, buffer or mmap; the returned pixels are
+	buffers into it, so nothing is copied. If size is given, only the
+	images of the nominal size closest to it are parsed.
+	"""
+	tocs = parse_toc(data)
+	if size is not None:
+		size = best_size(tocs, size)
 
 	imgs = []
-	pos = header_size + toc_count * 12
 	for toc_type, toc_subtype, toc_position in tocs:
-		assert toc_position == pos
-
-		item, data = unpack(data, 16, '<IIII')
-		header_size, type, subtype, version = item
-		#print 'CHUNK: size, type, subtype, version =', item
+		if toc_type != XcursorImageType:
+			continue
+		if size is not None and toc_subtype != size:
+			continue
 
-		assert header_size == {0xfffe0001: 20, 0xfffd0002: 36}[type]
+		header_size, type, subtype, version = struct.unpack_from('<IIII', data, toc_position)
+		#print 'CHUNK: size, type, subtype, version =', (header_size, type, subtype, version)
+		assert header_size == 36
 		assert toc_type == type
 		assert toc_subtype == subtype
+		assert version == 1
 
-		if type == 0xfffe0001:
-			assert subtype in (1, 2, 3)
-			assert version == 1
-			item, data = unpack(data, 4, '<I')
-			length, = item
-			string, data = chunk(data, length)
-			#print 'STR:', repr(string)
-		if type == 0xfffd0002:
-			assert version == 1
-			item, data = unpack(data, 20, '<IIIII')
-			width, height, xhot, yhot, delay = item
-			#print 'IMG: width, height, xhot, yhot, delay =', item
-			assert width <= 0x7fff
-			assert height <= 0x7fff
-			assert xhot <= width
-			assert yhot <= height
-			length = width * height * 4
-			pixels, data = chunk(data, length)
-			imgs.append((width, height, xhot, yhot, delay, pixels))
-
-		pos += header_size + length
-
-	assert len(data) == 0
+		width, height, xhot, yhot, delay = struct.unpack_from('<IIIII', data, toc_position + 16)
+		#print 'IMG: width, height, xhot, yhot, delay =', (width, height, xhot, yhot, delay)
+		assert width <= 0x7fff
+		assert height <= 0x7fff
+		assert xhot <= width
+		assert yhot <= height
+
+		start = toc_position + header_size
+		length = width * height * 4
+		assert start + length <= len(data)
+		imgs.append((width, height, xhot, yhot, delay, buffer(data, start, length)))
 
 	return imgs
 
+# Sizes of the requests used for uploading cursor images, without the image data
+RequestSizes = dict(create_gc = 16, free_gc = 8, create_pixmap = 16, free_pixmap = 8,
+	put_image = 24, create_picture = 20, free_picture = 8, create_cursor = 16)
+
+class CursorUploader:
+	"""Uploads cursor images, sharing one GC, and one pixmap and picture per image size.
+
+	CreateCursor copies the picture contents, so the same picture can be
+	drawn over for every image. The image data is split into PutImage
+	requests that fit in the maximum request size by upload.put_image.
+
+	The requests and bytes sent are counted, along with what uploading
+	every image on its own (with its own GC, pixmap and picture) would
+	have cost.
+	"""
+
+	def __init__(self, win, format_id):
+		self.win = win
+		self.format_id = format_id
+		self.gc = None
+		self.pictures = {}
+		self.requests = 0
+		self.bytes = 0
+		self.unshared_requests = 0
+		self.unshared_bytes = 0
+
+	def stats(self):
+		return dict(requests = self.requests, bytes = self.bytes,
+			saved_requests = self.unshared_requests - self.requests,
+			saved_bytes = self.unshared_bytes - self.bytes)
+
+	def sent(self, request, data = 0, count = 1):
+		self.requests = self.requests + count
+		self.bytes = self.bytes + RequestSizes[request] * count + (data + 3) // 4 * 4
+
+	def unshared(self, length):
+		self.unshared_requests = self.unshared_requests + len(RequestSizes)
+		self.unshared_bytes = self.unshared_bytes + sum(RequestSizes.values()) + (length + 3) // 4 * 4
+
+	def picture(self, width, height):
+		if self.gc is None:
+			self.gc = self.win.create_gc()
+			self.sent('create_gc')
+		key = width, height
+		if key not in self.pictures:
+			pixmap = self.win.create_pixmap(width, height, 32)
+			pict = pixmap.xrender_create_picture(self.format_id)
+			self.pictures[key] = pixmap, pict
+			self.sent('create_pixmap')
+			self.sent('create_picture')
+		return self.pictures[key]
+
+	def create_cursor(self, width, height, xhot, yhot, pixels):
+		pixmap, pict = self.picture(width, height)
+
+		count = upload.put_image(pixmap, self.gc, 0, 0, width, height, 32, pixels)
+		self.sent('put_image', len(pixels), count)
+
+		cursor = pict.create_cursor(xhot, yhot)
+		self.sent('create_cursor')
+		self.unshared(len(pixels))
+		return cursor
+
+	def free(self):
+		for pixmap, pict in self.pictures.values():
+			pict.free()
+			pixmap.free()
+			self.sent('free_picture')
+			self.sent('free_pixmap')
+		self.pictures.clear()
+		if self.gc is not None:
+			self.gc.free()
+			self.sent('free_gc')
+			self.gc = None
+
 def create_cursor(win, format_id, width, height, xhot, yhot, pixels):
-	gc = win.create_gc()
-	pixmap = win.create_pixmap(width, height, 32)
-	pixmap.put_image(gc, 0, 0, width, height, X.ZPixmap, 32, 0, pixels)
-	gc.free()
-	pict = pixmap.create_picture(format_id)
-	pixmap.free()
-	cursor = pict.create_cursor(xhot, yhot)
-	pict.free()
-	return cursor
-
-def load_cursor(dpy, win, format_id, fname):
-	data = file(fname, 'rb').read()
+	uploader = CursorUploader(win, format_id)
+	try:
+		return uploader.create_cursor(width, height, xhot, yhot, pixels)
+	finally:
+		uploader.free()
+
+def create_anim_cursor(dpy, uploader, imgs):
+	"""Create a cursor from parsed images, animated if there's more than one.
+
+	Images with identical contents share one cursor.
+	"""
 	cursors = []
-	for (width, height, xhot, yhot, delay, pixels) in parse_cursor(data):
-		cursor = create_cursor(win, format_id, width, height, xhot, yhot, pixels)
+	frames = {}
+	for (width, height, xhot, yhot, delay, pixels) in imgs:
+		key = width, height, xhot, yhot, hashlib.sha1(pixels).digest()
+		cursor = frames.get(key)
+		if cursor is None:
+			cursor = frames[key] = uploader.create_cursor(width, height, xhot, yhot, pixels)
+		else:
+			uploader.unshared(len(pixels))
 		cursors.append((cursor, delay))
+
 	if len(cursors) <= 1:
 		return cursors[0][0]
-	return dpy.create_anim_cursor(cursors)
+
+	anim = dpy.xrender_create_anim_cursor(cursors)
+	# The animated cursor keeps its own references to the frames
+	for cursor in frames.values():
+		cursor.free()
+	return anim
+
+def open_cursor(fname):
+	f = file(fname, 'rb')
+	try:
+		return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+	finally:
+		f.close()
+
+def load_cursor(dpy, win, format_id, fname, size = None, uploader = None):
+	"""Load a cursor from a file.
+
+	If an uploader is given, it's used for uploading the images, and it
+	is left for the caller to free. This way its stats can be read and
+	its resources shared between several cursors.
+	"""
+	data = open_cursor(fname)
+	try:
+		if uploader is not None:
+			return create_anim_cursor(dpy, uploader, parse_cursor(data, size))
+		uploader = CursorUploader(win, format_id)
+		try:
+			return create_anim_cursor(dpy, uploader, parse_cursor(data, size))
+		finally:
+			uploader.free()
+	finally:
+		data.close()
+
+# Themes
+
+# The default search path of libXcursor, overridden by XCURSOR_PATH
+default_path = '~/.local/share/icons:~/.icons:/usr/share/icons:/usr/share/pixmaps'
+
+def cursor_path():
+	return [os.path.expanduser(d) for d in os.environ.get('XCURSOR_PATH', default_path).split(':') if d]
+
+def theme_inherits(theme, path):
+	for d in path:
+		fname = os.path.join(d, theme, 'index.theme')
+		if not os.path.isfile(fname):
+			continue
+		for line in file(fname):
+			if line.startswith('Inherits'):
+				key, sep, value = line.partition('=')
+				if key.strip() == 'Inherits':
+					return [name.strip() for name in value.replace(';', ',').split(',') if name.strip()]
+		return []
+	return []
+
+def find_cursor(theme, name, path = None):
+	"""Return the file for cursor name in theme or the themes it inherits, or None.
+
+	Like libXcursor, the "default" theme is tried last.
+	"""
+	if path is None:
+		path = cursor_path()
+	seen = set()
+	todo = [theme, 'default']
+	while todo:
+		theme = todo.pop(0)
+		if theme in seen:
+			continue
+		seen.add(theme)
+		for d in path:
+			fname = os.path.join(d, theme, 'cursors', name)
+			if os.path.isfile(fname):
+				return fname
+		# Depth-first, so inherited themes come before the ones later in the list
+		todo[:0] = theme_inherits(theme, path)
+	return None
+
+def default_size(screen):
+	"""Return the nominal cursor size for the screen, like libXcursor does without Xcursor.size."""
+	size = os.environ.get('XCURSOR_SIZE')
+	if size:
+		return int(size)
+	return min(screen.width_in_pixels, screen.height_in_pixels) // 48
+
+class CursorCache:
+	"""Cursors loaded from themes, kept on the server for reuse.
+
+	Cursors are cached per (theme, name, size, display); once there
+	are more than limit of them, the least recently used ones are freed.
+	"""
+
+	def __init__(self, theme = 'default', path = None, limit = 64):
+		self.theme = theme
+		self.path = path
+		self.limit = limit
+		self.files = {}
+		self.cursors = OrderedDict()
+
+	def find(self, theme, name):
+		key = theme, name
+		if key not in self.files:
+			self.files[key] = find_cursor(theme, name, self.path)
+		return self.files[key]
+
+	def load(self, dpy, win, format_id, name, size = None, theme = None):
+		if theme is None:
+			theme = self.theme
+		if size is None:
+			size = default_size(dpy.screen())
+
+		key = theme, name, size, dpy
+		cursor = self.cursors.pop(key, None)
+		if cursor is None:
+			fname = self.find(theme, name)
+			if fname is None:
+				raise ValueError('cursor %s not found in theme %s' % (name, theme))
+			cursor = load_cursor(dpy, win, format_id, fname, size)
+		self.store(key, cursor)
+		return cursor
+
+	def store(self, key, cursor):
+		# (Re)inserting marks the cursor as the most recently used
+		self.cursors[key] = cursor
+
+		while len(self.cursors) > self.limit:
+			key, old = self.cursors.popitem(last = False)
+			old.free()
+
+	def prewarm(self, dpy, win, format_id, names, size = None, theme = None, workers = None):
+		"""Load the named cursors, decoding their files in a process pool.
+
+		The cursors are created here as the decoded files come in.
+		Names that aren't found in the theme are skipped. Without
+		concurrent.futures, the files are decoded one by one.
+		"""
+		if theme is None:
+			theme = self.theme
+		if size is None:
+			size = default_size(dpy.screen())
+
+		fnames = {}
+		for name in names:
+			if (theme, name, size, dpy) in self.cursors:
+				continue
+			fname = self.find(theme, name)
+			if fname is not None:
+				fnames[name] = fname
+
+		uploader = CursorUploader(win, format_id)
+		try:
+			for name, (imgs, pixels) in decode_cursors(fnames, size, workers):
+				self.store((theme, name, size, dpy), create_anim_cursor(dpy, uploader, decoded_images(imgs, pixels)))
+		finally:
+			uploader.free()
+
+	def clear(self):
+		for cursor in self.cursors.values():
+			cursor.free()
+		self.cursors.clear()
+
+# Decoding cursors in worker processes
+
+def decode_cursor(fname, size):
+	"""Parse a cursor file into (images, pixels).
+
+	images has the (width, height, xhot, yhot, delay) of each image, and
+	pixels their data concatenated into one string, so that the result
+	is cheap to send from a worker process.
+	"""
+	data = open_cursor(fname)
+	try:
+		imgs = parse_cursor(data, size)
+		return [img[:5] for img in imgs], ''.join([str(img[5]) for img in imgs])
+	finally:
+		data.close()
+
+def decoded_images(imgs, pixels):
+	"""Turn the result of decode_cursor back into images like parse_cursor returns."""
+	pos = 0
+	result = []
+	for (width, height, xhot, yhot, delay) in imgs:
+		length = width * height * 4
+		result.append((width, height, xhot, yhot, delay, buffer(pixels, pos, length)))
+		pos = pos + length
+	return result
+
+def decode_cursors(fnames, size, workers = None):
+	"""Decode the files in fnames ({name: fname}), yielding (name, decoded) as they finish."""
+	if futures is None or workers == 1:
+		for name, fname in fnames.items():
+			yield name, decode_cursor(fname, size)
+		return
+
+	pool = futures.ProcessPoolExecutor(workers)
+	try:
+		jobs = dict((pool.submit(decode_cursor, fname, size), name) for name, fname in fnames.items())
+		for job in futures.as_completed(jobs):
+			yield jobs[job], job.result()
+	finally:
+		pool.shutdown()
 
 if __name__ == '__main__':
 	data = file('/usr/share/icons/Oxygen_Black/cursors/wait', 'rb').read()
@@ -1,14 +1,21 @@
 
 # Utility functions defined in Xlib but not python-xlib
 
+import weakref
+
+# Index of (depth, visual class) -> visual id, per screen object. The
+# indexes go away along with their screens.
+_visuals = weakref.WeakKeyDictionary()
+
 def match_visual_info(screen, depth, visual_class):
-	for depth_info in screen.allowed_depths:
-		if depth_info.depth != depth:
-			continue
-		for visual_info in depth_info.visuals:
-			if visual_info.visual_class != visual_class:
-				continue
-			return visual_info.visual_id
+	visuals = _visuals.get(screen)
+	if visuals is None:
+		visuals = {}
+		for depth_info in screen.allowed_depths:
+			for visual_info in depth_info.visuals:
+				visuals.setdefault((depth_info.depth, visual_info.visual_class), visual_info.visual_id)
+		_visuals[screen] = visuals
+	return visuals.get((depth, visual_class))
 
 # XRender* utility functions
 
@@ -22,15 +29,16 @@ PictTypeIndexed = 0
 PictTypeDirect = 1
 
 def render_find_format(dpy, **kwargs):
-	res = dpy.xrender_query_pict_formats()
+	# The formats are only queried once per display, see render.RenderContext
+	formats = dpy.xrender_context().formats()
+	keys = [(key.split('_') if '_' in key else [key], value) for key, value in kwargs.iteritems()]
 	matches = []
-	for item in res.formats:
-		for key, value in kwargs.iteritems():
-			if '_' in key:
-				key1, key2 = key.split('_')
-				val = item['direct'][key1][key2]
+	for item in formats.formats:
+		for key, value in keys:
+			if len(key) == 2:
+				val = item['direct'][key[0]][key[1]]
 			else:
-				val = item[key]
+				val = item[key[0]]
 			if val != value:
 				break
 		else:
@@ -38,12 +46,7 @@ def render_find_format(dpy, **kwargs):
 	return matches
 
 def render_find_standard_format(dpy, fmt):
-	standard_formats = [
-		dict(type=PictTypeDirect, depth=32, alpha_shift=24, red_shift=16, green_shift=8, blue_shift=0, alpha_mask=255, red_mask=255, green_mask=255, blue_mask=255),
-		dict(type=PictTypeDirect, depth=24,                 red_shift=16, green_shift=8, blue_shift=0, alpha_mask=0,   red_mask=255, green_mask=255, blue_mask=255),
-		dict(type=PictTypeDirect, depth=8,  alpha_shift=0,                                             alpha_mask=255, red_mask=0,   green_mask=0,   blue_mask=0),
-		dict(type=PictTypeDirect, depth=4,  alpha_shift=0,                                             alpha_mask=15,  red_mask=0,   green_mask=0,   blue_mask=0),
-		dict(type=PictTypeDirect, depth=1,  alpha_shift=0,                                             alpha_mask=1,   red_mask=0,   green_mask=0,   blue_mask=0),
-	]
-	return render_find_format(dpy, **standard_formats[fmt])[0]
+	return dpy.xrender_context().formats().find_standard(fmt)
 
+def render_find_visual_format(dpy, visual):
+	return dpy.xrender_context().formats().find_visual(visual)